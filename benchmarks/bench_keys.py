@@ -0,0 +1,117 @@
+"""Compare certificate issuance time and TLS handshake cost per key algorithm.
+
+Usage: python benchmarks/bench_keys.py [N_CERTS [N_HANDSHAKES]]
+
+Certificates are issued by a fresh CA using the same algorithm, with keys
+generated in the foreground (no key pool), so the issuance figures include key
+generation. Handshakes are mutually authenticated, like those between etcd
+peers, and run in memory to leave the network out of the measurement. The
+handshake part needs Python 3.5 or later.
+
+"""
+
+from __future__ import print_function
+
+import ssl
+import sys
+import tempfile
+import time
+
+from containercluster import ca
+
+
+class ForegroundKeys(object):
+
+    def __init__(self, key_algorithm):
+        self.key_algorithm = key_algorithm
+
+    def get(self):
+        return ca.generate_key(self.key_algorithm)
+
+
+def make_ca(key_algorithm):
+    authority = ca.CA(tempfile.mkdtemp(), key_algorithm)
+    authority.key_pool = lambda algorithm: ForegroundKeys(algorithm)
+    return authority
+
+
+def bench_issuance(authority, key_algorithm, n):
+    authority.cert_path
+    start = time.time()
+    for i in range(n):
+        authority.generate_cert(u"node%d" % (i,),
+                                [u"127.0.0.1", u"node%d.example.com" % (i,)],
+                                key_algorithm)
+    return (time.time() - start) / n
+
+
+def tls_context(authority, cert_path, key_path, server_side):
+    if server_side:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    else:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.verify_mode = ssl.CERT_REQUIRED
+    ctx.load_verify_locations(authority.cert_path)
+    ctx.load_cert_chain(cert_path, key_path)
+    return ctx
+
+
+def handshake(server_ctx, client_ctx):
+    server_in, server_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+    client_in, client_out = ssl.MemoryBIO(), ssl.MemoryBIO()
+    server = server_ctx.wrap_bio(server_in, server_out, server_side=True)
+    client = client_ctx.wrap_bio(client_in, client_out,
+                                 server_hostname=u"localhost")
+    done = set()
+    while len(done) < 2:
+        for name, conn in (("client", client), ("server", server)):
+            if name in done:
+                continue
+            try:
+                conn.do_handshake()
+                done.add(name)
+            except ssl.SSLWantReadError:
+                pass
+        server_in.write(client_out.read())
+        client_in.write(server_out.read())
+
+
+def bench_handshakes(authority, key_algorithm, n):
+    cert_path, key_path = authority.generate_cert(u"localhost",
+                                                  [u"localhost"],
+                                                  key_algorithm)
+    server_ctx = tls_context(authority, cert_path, key_path, True)
+    client_ctx = tls_context(authority, cert_path, key_path, False)
+    start = time.time()
+    for _ in range(n):
+        handshake(server_ctx, client_ctx)
+    return (time.time() - start) / n
+
+
+def main():
+    n_certs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    n_handshakes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print("%-12s %14s %14s" % ("algorithm", "issue (ms)", "handshake (ms)"))
+    for key_algorithm in ca.KEY_ALGORITHMS:
+        try:
+            ca.check_key_algorithm(key_algorithm)
+        except ValueError as exc:
+            print("%-12s %s" % (key_algorithm, exc))
+            continue
+        authority = make_ca(key_algorithm)
+        issue = bench_issuance(authority, key_algorithm, n_certs)
+        if hasattr(ssl, "MemoryBIO"):
+            try:
+                hs = "%14.2f" % (bench_handshakes(authority, key_algorithm,
+                                                  n_handshakes) * 1000,)
+            except ssl.SSLError as exc:
+                hs = "%14s" % ("unsupported",)
+                print("%s: %s" % (key_algorithm, exc), file=sys.stderr)
+        else:
+            hs = "%14s" % ("n/a",)
+        print("%-12s %14.2f %s" % (key_algorithm, issue * 1000, hs))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
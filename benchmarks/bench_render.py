@@ -0,0 +1,92 @@
+"""Measure cloud-config rendering for all nodes of a large cluster.
+
+Usage: python benchmarks/bench_render.py [N_NODES [ROUNDS]]
+
+Compares rendering through the cluster's bound templates with re-reading and
+%-formatting the template for every node, as was done before templates were
+cached. No provider is involved: nodes are made up, and the cluster gets
+fixed etcd and master addresses.
+
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+import ipaddress
+
+from containercluster import config, core, render
+
+
+def make_cluster(n_nodes):
+    # Leave etcd discovery, which needs network access, out of the way.
+    config.make_discovery_token = lambda size: "0123456789abcdef"
+    conf = config.Config(tempfile.mkdtemp())
+    conf.add_cluster("bench", "alpha", 3, "512mb", n_nodes - 4, "1gb",
+                     "digitalocean", "lon1",
+                     ipaddress.ip_network(u"172.16.0.0/16"), 24,
+                     ipaddress.ip_network(u"172.16.1.0/24"),
+                     ipaddress.ip_network(u"172.16.254.0/24"),
+                     ipaddress.ip_network(u"172.17.0.0/24"),
+                     ipaddress.ip_address(u"172.17.0.10"),
+                     ipaddress.ip_address(u"172.17.0.1"))
+    cluster = core.Cluster("bench", None, conf)
+    cluster._etcd_endpoint = ",".join("https://10.0.0.%d:2379" % (i,)
+                                      for i in range(1, 4))
+    cluster._master_ip = "10.0.1.1"
+    nodes = [core.NODE_TYPES[n["type"]](n["name"], None, cluster, conf)
+             for n in conf.clusters["bench"]["nodes"]]
+    return cluster, nodes
+
+
+def legacy_render(node):
+    # Rendering as done before the render module.
+    fname = os.path.join(render.TEMPLATES_DIR,
+                         "%s-cloud-config.yaml" % (node.node_type,))
+    with open(fname, "rt") as f:
+        template = f.read()
+    cluster = node.config.clusters[node.cluster.name]
+    vars = node.cluster.cloud_config_vars(
+        k for k in node.cloud_config_keys if k not in core.NODE_CONFIG_KEYS)
+    vars["network_config"] = json.dumps({
+        "Network": str(cluster["network"]),
+        "SubnetLen": cluster["subnet_length"],
+        "SubnetMin": str(cluster["subnet_min"].network_address),
+        "SubnetMax": str(cluster["subnet_max"].network_address),
+        "Backend": {"Type": "vxlan", "VNI": 1, "Port": 8472},
+    })
+    vars.update(node.node_config_vars)
+    return template % vars
+
+
+def bench(render_node, nodes, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        for node in nodes:
+            render_node(node)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    n_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    cluster, nodes = make_cluster(n_nodes)
+    for node in nodes:
+        assert node.cloud_config_data == legacy_render(node)
+    legacy = bench(legacy_render, nodes, rounds)
+    cached = bench(lambda node: node.cloud_config_data, nodes, rounds)
+    print("%d nodes, best of %d rounds" % (len(nodes), rounds))
+    print("%-10s %10.2f ms" % ("legacy", legacy * 1000))
+    print("%-10s %10.2f ms" % ("render", cached * 1000))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
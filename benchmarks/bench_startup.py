@@ -0,0 +1,118 @@
+"""Check the time taken to import what the command line needs.
+
+Usage: python benchmarks/bench_startup.py [BUDGET_MS [ROUNDS]]
+
+Runs `container-cluster --help` and `container-cluster env` with ``-X
+importtime``, and adds up the import times of the modules which a bare
+interpreter does not import. `env` runs against a made-up cluster with a
+recorded environment, in a temporary home directory. Fails when the best of
+``ROUNDS`` runs exceeds ``BUDGET_MS`` milliseconds (150 by default), or when
+heavy dependencies, which the commands should import when needed only, are
+imported.
+
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import ipaddress
+
+from containercluster import config
+
+
+# Only imported when talking to a cloud, issuing certificates, or connecting
+# to nodes.
+HEAVY_MODULES = ("cryptography", "libcloud", "paramiko", "requests")
+
+COMMANDS = (
+    ("--help", ["-m", "containercluster.cmdline", "--help"]),
+    ("env", ["-m", "containercluster.cmdline", "env", "bench"]),
+)
+
+
+def make_home():
+    # Leave etcd discovery, which needs network access, out of the way.
+    config.make_discovery_token = lambda size: "0123456789abcdef"
+    home = tempfile.mkdtemp()
+    conf = config.Config(home)
+    conf.add_cluster("bench", "alpha", 3, "512mb", 2, "1gb",
+                     "digitalocean", "lon1",
+                     ipaddress.ip_network(u"172.16.0.0/16"), 24,
+                     ipaddress.ip_network(u"172.16.1.0/24"),
+                     ipaddress.ip_network(u"172.16.254.0/24"),
+                     ipaddress.ip_network(u"172.17.0.0/24"),
+                     ipaddress.ip_address(u"172.17.0.10"),
+                     ipaddress.ip_address(u"172.17.0.1"))
+    conf.save()
+    admin_cert_path, admin_key_path = conf.admin_tls_paths()
+    conf.record_env("bench", {
+        "ca_cert_path": conf.ca_cert_path,
+        "admin_cert_path": admin_cert_path,
+        "admin_key_path": admin_key_path,
+        "etcd_endpoint": "https://10.0.0.1:2379",
+        "master_ip": "10.0.1.1",
+    })
+    return home
+
+
+def import_times(args, home):
+    """Return the cumulative import time, in microseconds, of each top-level
+    module imported by running Python with ``args``, and the names of all
+    modules imported.
+
+    """
+    env = dict(os.environ)
+    env["HOME"] = home
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in (os.getcwd(), env.get("PYTHONPATH")) if p)
+    p = subprocess.Popen([sys.executable, "-X", "importtime"] + args,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         env=env)
+    _, stderr = p.communicate()
+    if p.returncode:
+        raise Exception("Python %s failed: %s" % (" ".join(args), stderr))
+    times = {}
+    modules = set()
+    for line in stderr.decode("utf-8").splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip() == "cumulative":
+            continue
+        modules.add(name.strip())
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative)
+    return times, modules
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 150.0
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    home = make_home()
+    baseline, _ = import_times(["-c", "pass"], home)
+    ok = True
+    for name, args in COMMANDS:
+        best = None
+        for _ in range(rounds):
+            times, modules = import_times(args, home)
+            elapsed = sum(t for m, t in times.items() if m not in baseline)
+            best = elapsed if best is None else min(best, elapsed)
+        best /= 1000.0
+        status = "ok" if best <= budget else "OVER BUDGET"
+        print("%-10s %10.2f ms (budget %.0f ms) %s" %
+              (name, best, budget, status))
+        ok = ok and best <= budget
+        heavy = sorted(set(m.split(".")[0] for m in modules) &
+                       set(HEAVY_MODULES))
+        if heavy:
+            print("%-10s imports %s" % (name, ", ".join(heavy)))
+            ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
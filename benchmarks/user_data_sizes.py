@@ -0,0 +1,29 @@
+"""Report the size of the user data of each node type.
+
+Usage: python benchmarks/user_data_sizes.py
+
+Compares the cloud-config sent as user data with the boot cloud-config which
+unpacks it, as sent to clusters created with ``--compress-user-data``.
+
+"""
+
+from __future__ import print_function
+
+import sys
+
+from containercluster import core
+
+from bench_render import make_cluster
+
+
+def main():
+    cluster, nodes = make_cluster(5)
+    print("%-10s %10s %12s %8s" % ("type", "plain", "compressed", "ratio"))
+    for node_type, plain, compressed in core.user_data_sizes(nodes):
+        print("%-10s %10d %12d %7d%%" % (node_type, plain, compressed,
+                                         100 * compressed // plain))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,309 @@
+import atexit
+import binascii
+import collections
 import datetime
+import errno
+import logging
+import multiprocessing
 import os
 import threading
 import uuid
 
 import ipaddress
+import yaml
 
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+from containercluster import metrics, trace, utils
+
+
+# Only needed when issuing or indexing certificates.
+x509 = utils.lazy_import("cryptography.x509")
+oid = utils.lazy_import("cryptography.x509.oid")
+backends = utils.lazy_import("cryptography.hazmat.backends")
+hashes = utils.lazy_import("cryptography.hazmat.primitives.hashes")
+serialization = utils.lazy_import(
+    "cryptography.hazmat.primitives.serialization")
+ec = utils.lazy_import("cryptography.hazmat.primitives.asymmetric.ec")
+rsa = utils.lazy_import("cryptography.hazmat.primitives.asymmetric.rsa")
+ed25519 = utils.lazy_import(
+    "cryptography.hazmat.primitives.asymmetric.ed25519")
 
 
 __all__ = [
     "CA",
+    "DEFAULT_KEY_ALGORITHM",
+    "KEY_ALGORITHMS",
+    "KeyPool",
 ]
 
 
 ONE_DAY = datetime.timedelta(1, 0, 0)
 
+# Validity period of new certificates.
+VALIDITY = 3650 * ONE_DAY
+
+# Certificates expiring within this period are reissued.
+RENEW_BEFORE = 30 * ONE_DAY
+
+
+DEFAULT_KEY_POOL_SIZE = 8
+
+
+DEFAULT_KEY_ALGORITHM = "rsa-2048"
+
+KEY_ALGORITHMS = ("rsa-2048", "rsa-4096", "ecdsa-p256", "ed25519")
+
+
+CERTS_ISSUED = metrics.counter(
+    "containercluster_certificates_issued_total",
+    "Certificates issued by the CA.",
+    ("key_algorithm",))
+
+CERT_ISSUE_SECONDS = metrics.histogram(
+    "containercluster_certificate_issue_seconds",
+    "Time taken to issue certificates, including key generation.",
+    ("key_algorithm",))
+
+
+def has_ed25519():
+    """Return whether the installed cryptography supports Ed25519 keys.
+
+    """
+    try:
+        ed25519.Ed25519PrivateKey
+    except ImportError:
+        return False
+    return True
+
+
+def default_backend():
+    return backends.default_backend()
+
+
+def check_key_algorithm(algorithm):
+    if algorithm not in KEY_ALGORITHMS:
+        raise ValueError("Invalid key algorithm '%s'. Valid values: %s" %
+                         (algorithm, ", ".join(KEY_ALGORITHMS)))
+    if algorithm == "ed25519" and not has_ed25519():
+        raise ValueError("Key algorithm '%s' not supported by this version "
+                         "of `cryptography`" % (algorithm,))
+
+
+def generate_key(algorithm):
+    check_key_algorithm(algorithm)
+    if algorithm.startswith("rsa-"):
+        return rsa.generate_private_key(public_exponent=65537,
+                                        key_size=int(algorithm[4:]),
+                                        backend=default_backend())
+    elif algorithm == "ecdsa-p256":
+        return ec.generate_private_key(ec.SECP256R1(), default_backend())
+    else:
+        return ed25519.Ed25519PrivateKey.generate()
+
+
+def private_key_pem(key):
+    # Ed25519 keys have no "traditional" OpenSSL encoding.
+    if has_ed25519() and isinstance(key, ed25519.Ed25519PrivateKey):
+        fmt = serialization.PrivateFormat.PKCS8
+    else:
+        fmt = serialization.PrivateFormat.TraditionalOpenSSL
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=fmt,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+
+def generate_key_pem(algorithm):
+    return private_key_pem(generate_key(algorithm))
+
+
+def signature_hash(key):
+    """The hash algorithm to sign certificates with ``key``.
+
+    """
+    if has_ed25519() and isinstance(key, ed25519.Ed25519PrivateKey):
+        return None
+    return hashes.SHA256()
+
+
+class KeyPool(object):
+    """Pool of private keys generated in the background.
+
+    Keys are generated by ``processes`` worker processes (by default, one
+    per CPU), started when the first key is needed. As keys are handed out,
+    as many are generated ahead of time, up to ``size``, so that getting a
+    key seldom waits for its generation while runs needing few keys do not
+    generate many. Keys already generated when the pool is closed are
+    spilled to ``spill_dir``, if given, and handed out first the next time,
+    by any process.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, size=DEFAULT_KEY_POOL_SIZE, processes=None,
+                 spill_dir=None, key_algorithm=DEFAULT_KEY_ALGORITHM):
+        if size < 1:
+            raise ValueError("Invalid key pool size: %r" % (size,))
+        check_key_algorithm(key_algorithm)
+        self.size = size
+        self.processes = processes
+        self.spill_dir = spill_dir
+        self.key_algorithm = key_algorithm
+        self._lock = threading.Lock()
+        self._process_pool = None
+        self._pending = collections.deque()
+        self._handed_out = 0
+
+    def get(self):
+        """Return a new private key.
+
+        """
+        with self._lock:
+            pem = self._unspill()
+            if pem is None:
+                self._start()
+                if not self._pending:
+                    self._generate()
+                result = self._pending.popleft()
+                self._handed_out += 1
+                while len(self._pending) < min(self.size, self._handed_out):
+                    self._generate()
+        if pem is None:
+            pem = result.get()
+        return serialization.load_pem_private_key(data=pem,
+                                                  password=None,
+                                                  backend=default_backend())
+
+    def close(self, wait=False):
+        """Stop the worker processes, spilling unused keys to disk.
+
+        Keys still being generated are dropped, unless ``wait`` is true.
+
+        """
+        with self._lock:
+            if self._process_pool is None:
+                return
+            pending, self._pending = self._pending, collections.deque()
+            if self.spill_dir is not None:
+                for result in pending:
+                    if wait or result.ready():
+                        self._spill(result.get())
+            self._process_pool.terminate()
+            self._process_pool.join()
+            self._process_pool = None
+
+    def _start(self):
+        if self._process_pool is not None:
+            return
+        self.log.debug("Starting key generation processes")
+        # Forking a process with other threads running may leave locks held
+        # by them locked forever in the child: workers are spawned instead,
+        # where supported.
+        get_context = getattr(multiprocessing, "get_context", None)
+        if get_context is not None:
+            self._process_pool = get_context("spawn").Pool(self.processes)
+        else:
+            self._process_pool = multiprocessing.Pool(self.processes)
+        atexit.register(self.close)
+
+    def _generate(self):
+        self._pending.append(self._process_pool.apply_async(
+            generate_key_pem, (self.key_algorithm,)
+        ))
+
+    def _spill(self, pem):
+        if not os.access(self.spill_dir, os.F_OK):
+            os.makedirs(self.spill_dir, 0o700)
+        fname = os.path.join(self.spill_dir, "%s.pem" % (uuid.uuid4(),))
+        fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(pem)
+
+    def _unspill(self):
+        if self.spill_dir is None or not os.access(self.spill_dir, os.F_OK):
+            return None
+        for fname in sorted(os.listdir(self.spill_dir)):
+            if not fname.endswith(".pem"):
+                continue
+            fname = os.path.join(self.spill_dir, fname)
+            # Other processes may be after the same key: whoever renames it
+            # first gets it.
+            claimed = "%s.%d.claimed" % (fname, os.getpid())
+            try:
+                os.rename(fname, claimed)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                continue
+            with open(claimed, "rb") as f:
+                pem = f.read()
+            os.unlink(claimed)
+            self.log.debug("Using spilled key %s", fname)
+            return pem
+        return None
+
+
+_key_pools = {}
+
+_key_pools_lock = threading.Lock()
+
+
+def shared_key_pool(spill_dir, key_algorithm=DEFAULT_KEY_ALGORITHM):
+    """Return the process-wide pool of ``key_algorithm`` keys.
+
+    Unused keys are spilled to a subdirectory of ``spill_dir`` named after
+    the algorithm.
+
+    """
+    spill_dir = os.path.join(spill_dir, key_algorithm)
+    with _key_pools_lock:
+        try:
+            return _key_pools[spill_dir]
+        except KeyError:
+            pool = _key_pools[spill_dir] = KeyPool(spill_dir=spill_dir,
+                                                   key_algorithm=key_algorithm)
+            return pool
+
 
 class CA(object):
+    """Certificate authority kept in ``ca_dir``.
 
-    _lock = threading.RLock()
+    ``key_algorithm`` is only used to create the CA key, when the CA does not
+    exist yet. Certificates are issued with their own key algorithm.
 
-    def __init__(self, ca_dir):
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Locks serialising the creation of each certificate, indexed by path.
+    _locks = {}
+
+    _locks_lock = threading.Lock()
+
+    def __init__(self, ca_dir, key_algorithm=DEFAULT_KEY_ALGORITHM):
+        check_key_algorithm(key_algorithm)
         self.ca_dir = ca_dir
+        self.key_algorithm = key_algorithm
+        self._ca_key = None
+        self._certs_dir = None
+        self._index = None
+        self._index_stamp = None
+        self._pems = {}
+        self._pems_lock = threading.Lock()
+
+    @classmethod
+    def _lock_for(cls, path):
+        with cls._locks_lock:
+            try:
+                return cls._locks[path]
+            except KeyError:
+                lock = cls._locks[path] = threading.Lock()
+                return lock
+
+    def key_pool(self, key_algorithm):
+        return shared_key_pool(os.path.join(self.ca_dir, "key-pool"),
+                               key_algorithm)
 
     @property
     def cert_path(self):
@@ -38,155 +315,319 @@ class CA(object):
         _, fname = self._ensure_ca_cert()
         return fname
 
-    def generate_cert(self, host_name, alt_names=None):
+    def generate_cert(self, host_name, alt_names=None, key_algorithm=None):
+        """Return the paths of the certificate and key for ``host_name``.
+
+        Certificates with keys other than ``DEFAULT_KEY_ALGORITHM`` have the
+        algorithm in their file names, so that clusters using different
+        algorithms do not share them.
+
+        Existing certificates are looked up in the index, and are only
+        reissued (keeping their keys) when their subject alternative names
+        differ from ``alt_names`` or when they are about to expire.
+
+        """
         if alt_names is None:
             alt_names = []
-        cert_path = os.path.join(self.certs_dir, host_name + ".pem")
-        key_path = os.path.join(self.certs_dir, host_name + "-key.pem")
-        with CA._lock:
-            if not (os.access(cert_path, os.F_OK) and
-                    os.access(key_path, os.F_OK)):
-                key = rsa.generate_private_key(public_exponent=65537,
-                                               key_size=2048,
-                                               backend=default_backend())
-                public_key = key.public_key()
-                with open(key_path, "wb") as f:
-                    f.write(key.private_bytes(
-                        encoding=serialization.Encoding.PEM,
-                        format=serialization.PrivateFormat.TraditionalOpenSSL,
-                        encryption_algorithm=serialization.NoEncryption()
-                    ))
-
-                _, ca_key_path = self._ensure_ca_cert()
-                with open(ca_key_path, "rb") as f:
-                    ca_key = serialization.load_pem_private_key(
-                        data=f.read(),
-                        password=None,
-                        backend=default_backend()
-                    )
-                    ca_public_key = ca_key.public_key()
-                b = self._builder()
-                b = b.public_key(public_key)
-                b = b.subject_name(x509.Name([
-                    x509.NameAttribute(NameOID.ORGANIZATION_NAME, u"Container cluster"),
-                    x509.NameAttribute(NameOID.COMMON_NAME, u"%s" % (host_name,))
-                ]))
-                b = b.add_extension(
-                    x509.BasicConstraints(ca=False,
-                                          path_length=None),
-                    critical=True
-                )
-                b = b.add_extension(
-                    x509.KeyUsage(digital_signature=True,
-                                  content_commitment=False,
-                                  key_encipherment=True,
-                                  data_encipherment=False,
-                                  key_agreement=False,
-                                  key_cert_sign=False,
-                                  crl_sign=False,
-                                  encipher_only=False,
-                                  decipher_only=False),
-                    critical=True
-                )
-                b = b.add_extension(
-                    x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH,
-                                           ExtendedKeyUsageOID.CLIENT_AUTH]),
-                    critical=False
-                )
-                b = b.add_extension(
-                    x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_public_key),
-                    critical=False
-                )
-                b = b.add_extension(
-                    x509.SubjectKeyIdentifier.from_public_key(public_key),
-                    critical=False
-                )
-                if alt_names:
-                    b = b.add_extension(
-                        x509.SubjectAlternativeName([
-                            x509_name(name) for name in alt_names
-                        ]),
-                        critical=False
-                    )
-                cert = b.sign(private_key=ca_key,
-                              algorithm=hashes.SHA256(),
-                              backend=default_backend())
-                with open(cert_path, "wb") as f:
-                    f.write(cert.public_bytes(serialization.Encoding.PEM))
+        if key_algorithm is None:
+            key_algorithm = DEFAULT_KEY_ALGORITHM
+        check_key_algorithm(key_algorithm)
+        base_name = host_name
+        if key_algorithm != DEFAULT_KEY_ALGORITHM:
+            base_name = "%s.%s" % (host_name, key_algorithm)
+        cert_path = os.path.join(self.certs_dir, base_name + ".pem")
+        key_path = os.path.join(self.certs_dir, base_name + "-key.pem")
+        with trace.span("CA.generate_cert", cert=base_name):
+            return self._generate_cert(host_name, alt_names, key_algorithm,
+                                       base_name, cert_path, key_path)
+
+    def _generate_cert(self, host_name, alt_names, key_algorithm, base_name,
+                       cert_path, key_path):
+        with trace.locked(self._lock_for(cert_path), "CA.lock",
+                          cert=base_name):
+            entry = self._lookup(base_name, cert_path, key_path)
+            if entry is None:
+                self.log.debug("Issuing certificate %s", cert_path)
+            elif entry["alt_names"] != normalize_alt_names(alt_names):
+                self.log.info("Reissuing certificate %s: Alternative names "
+                              "changed from %s to %s", cert_path,
+                              entry["alt_names"],
+                              normalize_alt_names(alt_names))
+            elif entry["not_after"] - RENEW_BEFORE < utcnow():
+                self.log.info("Reissuing certificate %s: Expires on %s",
+                              cert_path, entry["not_after"])
+            else:
+                return cert_path, key_path
+            with CERT_ISSUE_SECONDS.time(key_algorithm=key_algorithm):
+                cert = self._issue_cert(host_name, alt_names, key_algorithm,
+                                        cert_path, key_path)
+            CERTS_ISSUED.inc(key_algorithm=key_algorithm)
+            self._update_index(base_name,
+                               cert_index_entry(cert, cert_path, key_path))
 
         return cert_path, key_path
 
+    def read_pem(self, path):
+        """Return the contents of the PEM file ``path``.
+
+        Contents are cached in memory until the file changes.
+
+        """
+        st = os.stat(path)
+        stamp = (st.st_mtime, st.st_size)
+        with self._pems_lock:
+            cached = self._pems.get(path)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+        with open(path, "rt") as f:
+            data = f.read()
+        with self._pems_lock:
+            self._pems[path] = (stamp, data)
+        return data
+
+    def cert_info(self, cert_path):
+        """Return the index entry of the certificate ``cert_path``, or
+        ``None``.
+
+        """
+        name = os.path.basename(cert_path)[:-len(".pem")]
+        with self._lock_for(self.index_path):
+            return self._load_index().get(name)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.ca_dir, "index.yaml")
+
+    def _lookup(self, name, cert_path, key_path):
+        # Return the index entry of an existing certificate, indexing it if
+        # it is not in the index yet or if its file changed.
+        if not (os.access(cert_path, os.F_OK) and
+                os.access(key_path, os.F_OK)):
+            return None
+        with self._lock_for(self.index_path):
+            entry = self._load_index().get(name)
+        if entry is not None and entry["mtime"] == os.stat(cert_path).st_mtime:
+            return entry
+        self.log.debug("Indexing certificate %s", cert_path)
+        with open(cert_path, "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+        entry = cert_index_entry(cert, cert_path, key_path)
+        self._update_index(name, entry)
+        return entry
+
+    def _load_index(self):
+        # Must be called with the index lock held.
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            self._index, self._index_stamp = {}, None
+            return self._index
+        stamp = (st.st_mtime, st.st_size)
+        if self._index is None or stamp != self._index_stamp:
+            with open(self.index_path, "rt") as f:
+                self._index = yaml.safe_load(f) or {}
+            self._index_stamp = stamp
+        return self._index
+
+    def _update_index(self, name, entry):
+        index_path = self.index_path
+        with self._lock_for(index_path):
+            index = dict(self._load_index())
+            index[name] = entry
+            tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+            with open(tmp_path, "wt") as f:
+                yaml.safe_dump(index, f, default_flow_style=False)
+            os.rename(tmp_path, index_path)
+            st = os.stat(index_path)
+            self._index, self._index_stamp = index, (st.st_mtime, st.st_size)
+
+    def _issue_cert(self, host_name, alt_names, key_algorithm, cert_path,
+                    key_path):
+        if os.access(key_path, os.F_OK):
+            with open(key_path, "rb") as f:
+                key = serialization.load_pem_private_key(
+                    data=f.read(),
+                    password=None,
+                    backend=default_backend()
+                )
+        else:
+            key = self.key_pool(key_algorithm).get()
+            with open(key_path, "wb") as f:
+                f.write(private_key_pem(key))
+        public_key = key.public_key()
+
+        ca_key = self._ca_signing_key()
+        ca_public_key = ca_key.public_key()
+        b = self._builder()
+        b = b.public_key(public_key)
+        b = b.subject_name(x509.Name([
+            x509.NameAttribute(oid.NameOID.ORGANIZATION_NAME,
+                               u"Container cluster"),
+            x509.NameAttribute(oid.NameOID.COMMON_NAME, u"%s" % (host_name,))
+        ]))
+        b = b.add_extension(
+            x509.BasicConstraints(ca=False,
+                                  path_length=None),
+            critical=True
+        )
+        b = b.add_extension(
+            x509.KeyUsage(digital_signature=True,
+                          content_commitment=False,
+                          key_encipherment=isinstance(key, rsa.RSAPrivateKey),
+                          data_encipherment=False,
+                          key_agreement=False,
+                          key_cert_sign=False,
+                          crl_sign=False,
+                          encipher_only=False,
+                          decipher_only=False),
+            critical=True
+        )
+        b = b.add_extension(
+            x509.ExtendedKeyUsage([oid.ExtendedKeyUsageOID.SERVER_AUTH,
+                                   oid.ExtendedKeyUsageOID.CLIENT_AUTH]),
+            critical=False
+        )
+        b = b.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_public_key),
+            critical=False
+        )
+        b = b.add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(public_key),
+            critical=False
+        )
+        if alt_names:
+            b = b.add_extension(
+                x509.SubjectAlternativeName([
+                    x509_name(name) for name in alt_names
+                ]),
+                critical=False
+            )
+        cert = b.sign(private_key=ca_key,
+                      algorithm=signature_hash(ca_key),
+                      backend=default_backend())
+        with open(cert_path, "wb") as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        return cert
+
     def _ensure_ca_cert(self):
         cert_path = os.path.join(self.ca_dir, "ca.pem")
         key_path = os.path.join(self.ca_dir, "ca-key.pem")
-        with CA._lock:
-            if not (os.access(cert_path, os.F_OK) and
-                    os.access(key_path, os.F_OK)):
-                key = rsa.generate_private_key(public_exponent=65537,
-                                               key_size=2048,
-                                               backend=default_backend())
-                public_key = key.public_key()
-                with open(key_path, "wb") as f:
-                    f.write(key.private_bytes(
-                        encoding=serialization.Encoding.PEM,
-                        format=serialization.PrivateFormat.TraditionalOpenSSL,
-                        encryption_algorithm=serialization.NoEncryption()
-                    ))
-
-                b = self._builder()
-                b = b.subject_name(self.issuer)
-                b = b.public_key(public_key)
-                b = b.add_extension(x509.BasicConstraints(ca=True,
-                                                          path_length=2),
-                                    critical=True)
-                b = b.add_extension(x509.KeyUsage(digital_signature=False,
-                                                  content_commitment=False,
-                                                  key_encipherment=False,
-                                                  data_encipherment=False,
-                                                  key_agreement=False,
-                                                  key_cert_sign=True,
-                                                  crl_sign=True,
-                                                  encipher_only=False,
-                                                  decipher_only=False),
-                                    critical=True)
-                b = b.add_extension(
-                    x509.SubjectKeyIdentifier.from_public_key(public_key),
-                    critical=False
-                )
-                b = b.add_extension(
-                    x509.AuthorityKeyIdentifier.from_issuer_public_key(public_key),
-                    critical=False
-                )
-                cert = b.sign(private_key=key,
-                              algorithm=hashes.SHA256(),
-                              backend=default_backend())
-                with open(cert_path, "wb") as f:
-                    f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with self._lock_for(cert_path):
+            if self._ca_key is None and not (os.access(cert_path, os.F_OK) and
+                                             os.access(key_path, os.F_OK)):
+                self._ca_key = self._create_ca_cert(cert_path, key_path)
 
         return cert_path, key_path
 
+    def _create_ca_cert(self, cert_path, key_path):
+        key = self.key_pool(self.key_algorithm).get()
+        public_key = key.public_key()
+        with open(key_path, "wb") as f:
+            f.write(private_key_pem(key))
+
+        b = self._builder()
+        b = b.subject_name(self.issuer)
+        b = b.public_key(public_key)
+        b = b.add_extension(x509.BasicConstraints(ca=True,
+                                                  path_length=2),
+                            critical=True)
+        b = b.add_extension(x509.KeyUsage(digital_signature=False,
+                                          content_commitment=False,
+                                          key_encipherment=False,
+                                          data_encipherment=False,
+                                          key_agreement=False,
+                                          key_cert_sign=True,
+                                          crl_sign=True,
+                                          encipher_only=False,
+                                          decipher_only=False),
+                            critical=True)
+        b = b.add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(public_key),
+            critical=False
+        )
+        b = b.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(public_key),
+            critical=False
+        )
+        cert = b.sign(private_key=key,
+                      algorithm=signature_hash(key),
+                      backend=default_backend())
+        with open(cert_path, "wb") as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        return key
+
+    def _ca_signing_key(self):
+        """The CA private key, loaded only once per instance.
+
+        """
+        cert_path, key_path = self._ensure_ca_cert()
+        with self._lock_for(cert_path):
+            if self._ca_key is None:
+                with open(key_path, "rb") as f:
+                    self._ca_key = serialization.load_pem_private_key(
+                        data=f.read(),
+                        password=None,
+                        backend=default_backend()
+                    )
+            return self._ca_key
+
     def _builder(self):
         b = x509.CertificateBuilder()
         b = b.issuer_name(self.issuer)
         b = b.not_valid_before(datetime.datetime.today() - ONE_DAY)
-        b = b.not_valid_after(datetime.datetime(2026, 1, 1))
+        b = b.not_valid_after(datetime.datetime.today() + VALIDITY)
         b = b.serial_number(int(uuid.uuid4()))
         return b
 
     @property
     def issuer(self):
         return x509.Name([
-            x509.NameAttribute(NameOID.ORGANIZATION_NAME, u"Container cluster"),
-            x509.NameAttribute(NameOID.COMMON_NAME, u"Container cluster CA"),
+            x509.NameAttribute(oid.NameOID.ORGANIZATION_NAME,
+                               u"Container cluster"),
+            x509.NameAttribute(oid.NameOID.COMMON_NAME,
+                               u"Container cluster CA"),
         ])
 
     @property
     def certs_dir(self):
-        dname = os.path.join(self.ca_dir, "certs")
-        with CA._lock:
-            if not os.access(dname, os.F_OK):
-                os.mkdir(dname)
-        return dname
+        if self._certs_dir is None:
+            dname = os.path.join(self.ca_dir, "certs")
+            with self._lock_for(dname):
+                if not os.access(dname, os.F_OK):
+                    os.mkdir(dname)
+            self._certs_dir = dname
+        return self._certs_dir
+
+
+def normalize_alt_names(alt_names):
+    return sorted(set(u"%s" % (x509_name(name).value,) for name in alt_names))
+
+
+def cert_index_entry(cert, cert_path, key_path):
+    try:
+        ext = cert.extensions.get_extension_for_class(
+            x509.SubjectAlternativeName
+        )
+        alt_names = sorted(set(u"%s" % (n.value,) for n in ext.value))
+    except x509.ExtensionNotFound:
+        alt_names = []
+    not_after = getattr(cert, "not_valid_after_utc", None)
+    if not_after is None:
+        not_after = cert.not_valid_after
+    return {
+        "cert": os.path.basename(cert_path),
+        "key": os.path.basename(key_path),
+        "alt_names": alt_names,
+        "fingerprint": binascii.hexlify(
+            cert.fingerprint(hashes.SHA256())
+        ).decode("ascii"),
+        "not_after": not_after.replace(tzinfo=None),
+        "mtime": os.stat(cert_path).st_mtime,
+    }
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
 
 
 def x509_name(name):
@@ -1,14 +1,18 @@
+from __future__ import print_function
+
 import argparse
 import logging
 import logging.config
 import sys
+import time
 
-import ipaddress
-
-from containercluster import config, core
+# Modules needed to parse the command line only. Each command imports what it
+# needs to run, so that `--help` and quick commands such as `env` do not pay
+# for importing the rest.
+from containercluster import ca, config, metrics, trace, utils
 
 from containercluster.providers import (
-    default_provider, get_provider, provider_names
+    DEFAULT_PROVIDER, get_provider, get_provider_class, provider_names
 )
 
 
@@ -17,10 +21,17 @@ __all__ = [
 ]
 
 
+COMMAND_SECONDS = metrics.histogram(
+    "containercluster_command_seconds",
+    "Duration of container-cluster commands.",
+    ("command", "status"))
+
+
 def main():
     """Manages the life-cycle of CoreOS-based container clusters.
 
     """
+    default_provider = get_provider_class(DEFAULT_PROVIDER)
     p = argparse.ArgumentParser(prog="container-cluster",
                                 description=main.__doc__)
     g = p.add_mutually_exclusive_group()
@@ -28,7 +39,26 @@ def main():
                    help="only display program errors", default=False)
     g.add_argument("--debug", action="store_true",
                    help="trace program execution", default=False)
-    subp = p.add_subparsers()
+    p.add_argument("--max-workers", metavar="NUM", type=int,
+                   help=("maximum number of nodes operated on concurrently "
+                         "(default: %(default)s)"),
+                   default=utils.DEFAULT_MAX_WORKERS)
+    p.add_argument("--state-store", metavar="STORE",
+                   choices=config.store_names(),
+                   help=("where cluster definitions are kept; one of %s "
+                         "(default: %%(default)s)" %
+                         (", ".join(config.store_names()),)),
+                   default=config.DEFAULT_STORE)
+    p.add_argument("--trace", metavar="FILE",
+                   help=("write a Chrome trace-event file of the command's "
+                         "spans to FILE"),
+                   default=None)
+    p.add_argument("--metrics-file", metavar="FILE",
+                   help=("write the metrics of the command to FILE, in the "
+                         "format of the textfile collector of the "
+                         "Prometheus node exporter"),
+                   default=None)
+    subp = p.add_subparsers(dest="command")
 
     create_p = subp.add_parser("create", description=create_cluster.__doc__)
     create_p.add_argument("name", metavar="NAME", help="cluster name")
@@ -40,20 +70,20 @@ def main():
                           default=3)
     create_p.add_argument("--size-etcd", metavar="SIZE",
                           help="size for etc nodes (default: %(default)s)",
-                          default=default_provider().default_etcd_size)
+                          default=default_provider.default_etcd_size)
     create_p.add_argument("--num-workers", metavar="NUM", type=int,
                           help="number of worker nodes (default: %(default)s)",
                           default=2)
     create_p.add_argument("--size-workers", metavar="SIZE",
                           help="size for worker nodes (default: %(default)s)",
-                          default=default_provider().default_worker_size)
+                          default=default_provider.default_worker_size)
     create_p.add_argument("--location", metavar="LOCATION",
                           help="instance location (default: %(default)s)",
-                          default=default_provider().default_location)
+                          default=default_provider.default_location)
     create_p.add_argument("--provider", metavar="PROVIDER",
                           help="cloud provider (default: %(default)s)",
                           choices=provider_names(),
-                          default=default_provider().name)
+                          default=default_provider.name)
     create_p.add_argument("--flannel-network", metavar="xxx.xxx.xxx.xxx/nn",
                           help="flannel network (default: %(default)s)",
                           default="172.16.0.0/16")
@@ -77,6 +107,23 @@ def main():
                           help=("virtual IP for Kubernetes API "
                                 "(default: %(default)s)"),
                           default="172.17.0.1")
+    create_p.add_argument("--single-wave", action="store_true",
+                          help=("create all nodes at once, and configure "
+                                "master and worker nodes when provisioning "
+                                "them"),
+                          default=False)
+    create_p.add_argument("--key-algorithm", metavar="ALGORITHM",
+                          choices=ca.KEY_ALGORITHMS,
+                          help=("key algorithm for the TLS certificates of "
+                                "the cluster, and for the CA if it does not "
+                                "exist yet; one of %s (default: %%(default)s)"
+                                % (", ".join(ca.KEY_ALGORITHMS),)),
+                          default=ca.DEFAULT_KEY_ALGORITHM)
+    create_p.add_argument("--compress-user-data", action="store_true",
+                          help=("create nodes with a small cloud-config "
+                                "which unpacks their gzip-compressed "
+                                "cloud-config"),
+                          default=False)
 
     create_p.set_defaults(func=create_cluster)
 
@@ -99,6 +146,11 @@ def main():
 
     env_p = subp.add_parser("env", description=cluster_env.__doc__)
     env_p.add_argument("name", metavar="NAME", help="cluster name")
+    env_p.add_argument("--refresh", action="store_true",
+                       help=("look up node addresses through the provider "
+                             "instead of using those recorded when the "
+                             "cluster was last started or provisioned"),
+                       default=False)
     env_p.set_defaults(func=cluster_env)
 
     ssh_p = subp.add_parser("ssh", description=ssh.__doc__)
@@ -115,19 +167,38 @@ def main():
         log_level = "normal"
     configure_logging(log_level)
 
+    if args.trace:
+        trace.enable()
+    started = time.time()
+    status = "failed"
     try:
-        return args.func(args)
+        ret = args.func(args)
+        if not ret:
+            status = "done"
+        return ret
     except Exception as exc:
         logging.exception("Command `%s` failed: %s",
-                          " ".join(sys.argv), exc.message)
+                          " ".join(sys.argv), exc)
         return 1
+    finally:
+        COMMAND_SECONDS.observe(time.time() - started, command=args.command,
+                                status=status)
+        if args.trace:
+            trace.write(args.trace)
+        if args.metrics_file:
+            metrics.write_textfile(args.metrics_file)
 
 
 def create_cluster(args):
     """Create a cluster and start all its nodes.
 
     """
-    conf = config.Config()
+    import ipaddress
+
+    from containercluster import core
+
+    conf = config.Config(ca_key_algorithm=args.key_algorithm,
+                         store=args.state_store)
     if args.name in conf.clusters:
         logging.error("Cluster `%s` already exists", args.name)
         return 1
@@ -168,7 +239,9 @@ def create_cluster(args):
                         args.num_workers, args.size_workers, provider,
                         args.location, network, subnet_length, subnet_min,
                         subnet_max, services_ip_range, dns_service_ip,
-                        kubernetes_service_ip, conf)
+                        kubernetes_service_ip, conf, args.max_workers,
+                        args.single_wave, args.key_algorithm,
+                        args.compress_user_data)
     cluster_up(args)
     return provision_cluster(args)
 
@@ -177,23 +250,27 @@ def provision_cluster(args):
     """Configures all nodes in a cluster.
 
     """
-    conf = config.Config()
+    from containercluster import core
+
+    conf = config.Config(store=args.state_store)
     if args.name not in conf.clusters:
         logging.error("Unknown cluster '%s'", args.name)
         return 1
-    provider = conf.clusters[args.name]["provider"]
-    return core.provision_cluster(args.name, provider, conf)
+    provider = get_provider(conf.clusters[args.name]["provider"])
+    return core.provision_cluster(args.name, provider, conf, args.max_workers)
 
 
 def destroy_cluster(args):
     """Destroy a cluster.
 
     """
-    conf = config.Config()
+    from containercluster import core
+
+    conf = config.Config(store=args.state_store)
     if args.name not in conf.clusters:
         logging.error("Unknown cluster '%s'", args.name)
         return 1
-    provider = conf.clusters[args.name]["provider"]
+    provider = get_provider(conf.clusters[args.name]["provider"])
     return core.destroy_cluster(args.name, provider, conf)
 
 
@@ -201,12 +278,14 @@ def cluster_up(args):
     """Ensure all nodes of an existing cluster are up.
 
     """
-    conf = config.Config()
+    from containercluster import core
+
+    conf = config.Config(store=args.state_store)
     if args.name not in conf.clusters:
         logging.error("Unknown cluster '%s'", args.name)
         return 1
-    provider = conf.clusters[args.name]["provider"]
-    return core.start_cluster(args.name, provider, conf)
+    provider = get_provider(conf.clusters[args.name]["provider"])
+    return core.start_cluster(args.name, provider, conf, args.max_workers)
 
 
 def cluster_down(args):
@@ -219,24 +298,28 @@ def cluster_env(args):
     """Prints the command-line environment for accessing a cluster.
 
     """
-    conf = config.Config()
+    from containercluster import core
+
+    conf = config.Config(store=args.state_store)
     if args.name not in conf.clusters:
         logging.error("Unknown cluster '%s'", args.name)
         return 1
-    provider = conf.clusters[args.name]["provider"]
-    for k, v in core.cluster_env(args.name, provider, conf):
-        print "export %s=%s" % (k, v)
+    provider = get_provider(conf.clusters[args.name]["provider"])
+    for k, v in core.cluster_env(args.name, provider, conf, args.refresh):
+        print("export %s=%s" % (k, v))
 
 
 def ssh(args):
     """Open a `screen(1)` session connected to all cluster nodes.
 
     """
-    conf = config.Config()
+    from containercluster import core
+
+    conf = config.Config(store=args.state_store)
     if args.name not in conf.clusters:
         logging.error("Unknown cluster '%s'", args.name)
         return 1
-    provider = conf.clusters[args.name]["provider"]
+    provider = get_provider(conf.clusters[args.name]["provider"])
     return core.ssh_session(args.name, provider, conf)
 
 
@@ -1,39 +1,88 @@
+import contextlib
+import errno
+import hashlib
+import importlib
 import logging
 import os
 import platform
 import pwd
 import threading
+import time
 
 import ipaddress
-import requests
 import yaml
 
-from containercluster import ca, utils
+from containercluster import ca, metrics, utils
+
+try:
+    from yaml import CDumper as Dumper, CLoader as Loader, \
+        CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import Dumper, Loader, SafeDumper, SafeLoader
 
 
 __all__ = [
     "Config",
-    "SSHKeyPair"
+    "SSHKeyPair",
+    "Store",
+    "YamlStore",
+    "store_names",
 ]
 
 
+# Definitions keep addresses as strings, so that they can be read back with
+# the safe YAML loader.
+IP_NETWORK_KEYS = ("network", "subnet_min", "subnet_max", "services_ip_range")
+
+IP_ADDRESS_KEYS = ("dns_service_ip", "kubernetes_service_ip")
+
+STORES = {
+    "yaml": ("containercluster.config", "YamlStore"),
+    "sqlite": ("containercluster.sqlitestore", "SqliteStore"),
+}
+
+DEFAULT_STORE = "yaml"
+
+OPERATION_SECONDS = metrics.histogram(
+    "containercluster_operation_seconds",
+    "Duration of operations on clusters, such as creating or provisioning "
+    "them.",
+    ("operation", "status"))
+
+
+def store_names():
+    return sorted(STORES.keys())
+
+
 class Config(object):
 
     dir_lock = threading.RLock()
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, home=None):
+    def __init__(self, home=None, ca_key_algorithm=ca.DEFAULT_KEY_ALGORITHM,
+                 store=DEFAULT_STORE):
         if home is None:
             self.home = os.path.expanduser("~")
         else:
             self.home = home
-        self._clusters = {}
+        if store not in STORES:
+            raise ValueError("Invalid state store `%s`" % (store,))
+        self.ca_key_algorithm = ca_key_algorithm
+        self.store_name = store
+        self._store = None
+        self._clusters = None
+        self._changed = set()
+        self._ca = None
+        self._kubeconfigs = {}
 
     def add_cluster(self, name, channel, n_etcd, size_etcd, n_workers,
                     size_worker, provider, location, network, subnet_length,
                     subnet_min, subnet_max, services_ip_range, dns_service_ip,
-                    kubernetes_service_ip):
+                    kubernetes_service_ip, single_wave=False,
+                    key_algorithm=ca.DEFAULT_KEY_ALGORITHM,
+                    compress_user_data=False):
+        ca.check_key_algorithm(key_algorithm)
         cluster = {
             "provider": provider,
             "channel": channel,
@@ -46,6 +95,9 @@ class Config(object):
             "services_ip_range": services_ip_range,
             "dns_service_ip": dns_service_ip,
             "kubernetes_service_ip": kubernetes_service_ip,
+            "single_wave": single_wave,
+            "key_algorithm": key_algorithm,
+            "compress_user_data": compress_user_data,
             "nodes": [],
         }
         for i in range(n_etcd):
@@ -65,42 +117,102 @@ class Config(object):
                 "type": "worker",
                 "size": size_worker,
             })
-        self._clusters[name] = cluster
+        self._load_clusters()[name] = cluster
+        self._changed.add(name)
 
     def remove_cluster(self, name):
-        try:
-            del self._clusters[name]
-        except KeyError:
-            pass
+        self._load_clusters().pop(name, None)
+        self._changed.add(name)
+
+    def record_env(self, cluster_name, env):
+        """Record ``env``, the addresses and certificate paths needed to
+        access ``cluster_name``, in its definition, and save it.
+
+        """
+        self.store.record_env(self._load_clusters(), cluster_name, env)
 
     def save(self):
-        fname = self.clusters_yaml_path
-        self.log.debug("Saving clusters definitions to %s", fname)
-        clusters = dict(self._clusters)
-        for c in clusters.values():
-            c = dict(c)
-            for k in ("network", "subnet_min", "subnet_max"):
-                c[k] = str(c[k])
-        with open(fname, "wt") as f:
-            yaml.dump(clusters, f)
+        """Save the clusters added or removed since they were loaded.
+
+        """
+        self.store.save(self._load_clusters(), sorted(self._changed))
+        self._changed.clear()
 
     def __repr__(self):
         return "<Config %r>" % (self._clusters,)
 
     @property
     def clusters(self):
-        if not self._clusters:
-            fname = self.clusters_yaml_path
-            if os.access(fname, os.F_OK):
-                self.log.debug("Loading clusters definitions from %s", fname)
-                with open(fname, "rt") as f:
-                    self._clusters = yaml.load(f)
-                for c in self._clusters.values():
-                    for k in ("network", "subnet_min", "subnet_max"):
-                        c[k] = ipaddress.ip_network(c[k])
-            else:
-                self._clusters = {}
-        return dict(self._clusters)
+        """Read-only view of the cluster definitions, indexed by name.
+
+        """
+        return utils.ReadOnlyDict(self._load_clusters())
+
+    def _load_clusters(self):
+        if self._clusters is None:
+            self._clusters = self.store.load()
+        return self._clusters
+
+    @property
+    def store(self):
+        with self.dir_lock:
+            if self._store is None:
+                mod_name, class_name = STORES[self.store_name]
+                mod = importlib.import_module(mod_name)
+                self._store = getattr(mod, class_name)(self)
+            return self._store
+
+    def node_cluster(self, node_name):
+        """Return the name of the cluster of the node ``node_name``, or
+        ``None``.
+
+        """
+        return self.store.node_cluster(self._load_clusters(), node_name)
+
+    def list_nodes(self):
+        """Return the nodes of all clusters.
+
+        Nodes are dictionaries like those in cluster definitions, with the
+        name of their cluster in ``cluster``, and their provider ID and
+        addresses in ``provider_id``, ``public_ips`` and ``private_ips`` if
+        the store keeps them.
+
+        """
+        return self.store.list_nodes(self._load_clusters())
+
+    def record_node(self, node_name, provider_id, public_ips, private_ips):
+        self.store.record_node(node_name, provider_id, public_ips,
+                               private_ips)
+
+    @contextlib.contextmanager
+    def operation(self, cluster_name, operation):
+        """Context manager recording ``operation`` in the history of
+        ``cluster_name``, if the store keeps one, and in the operation
+        metrics.
+
+        """
+        started = time.time()
+        status = "failed"
+        try:
+            yield
+            status = "done"
+        finally:
+            finished = time.time()
+            OPERATION_SECONDS.observe(finished - started, operation=operation,
+                                      status=status)
+            self.store.record_operation(cluster_name, operation, status,
+                                        started, finished)
+
+    def cluster_path(self, name):
+        return os.path.join(self.clusters_dir, "%s.yaml" % (name,))
+
+    @property
+    def clusters_dir(self):
+        return self._ensure_dir(os.path.join(self.config_dir, "clusters"))
+
+    @property
+    def state_db_path(self):
+        return os.path.join(self.config_dir, "state.db")
 
     @property
     def clusters_yaml_path(self):
@@ -122,9 +234,16 @@ class Config(object):
     def ssh_dir(self):
         return self._ensure_dir(os.path.join(self.config_dir, ".ssh"))
 
+    @property
+    def ca(self):
+        with self.dir_lock:
+            if self._ca is None:
+                self._ca = ca.CA(self.ca_dir, self.ca_key_algorithm)
+            return self._ca
+
     @property
     def ca_cert_path(self):
-        return ca.CA(self.ca_dir).cert_path
+        return self.ca.cert_path
 
     @property
     def admin_cert_path(self):
@@ -136,11 +255,18 @@ class Config(object):
         _, fname = self._ensure_admin_tls()
         return fname
 
-    def node_tls_paths(self, node_name, alt_names=None):
-        return ca.CA(self.ca_dir).generate_cert(node_name, alt_names)
+    def node_tls_paths(self, node_name, alt_names=None, key_algorithm=None):
+        cert_path, key_path = self.ca.generate_cert(node_name, alt_names,
+                                                    key_algorithm)
+        self.store.record_certificate(node_name,
+                                      self.ca.cert_info(cert_path))
+        return cert_path, key_path
+
+    def admin_tls_paths(self, key_algorithm=None):
+        return self.node_tls_paths(u"admin", key_algorithm=key_algorithm)
 
     def _ensure_admin_tls(self):
-        return self.node_tls_paths(u"admin")
+        return self.admin_tls_paths()
 
     @property
     def ssh_key_pair(self):
@@ -153,7 +279,25 @@ class Config(object):
                 os.makedirs(dname)
             return dname
 
-    def kubeconfig_path(self, cluster_name, master_ip):
+    def kubeconfig_path(self, cluster_name, master_ip, admin_tls_paths=None):
+        """Return the path of the kubeconfig file of ``cluster_name``.
+
+        The file is only written when its contents change, that is, when
+        the address of the master or the paths of the certificates change.
+        ``admin_tls_paths`` are the paths of the admin certificate and key,
+        which are looked up if not given.
+
+        """
+        if admin_tls_paths is None:
+            cluster = self.clusters.get(cluster_name, {})
+            admin_tls_paths = self.admin_tls_paths(
+                cluster.get("key_algorithm"))
+        admin_cert_path, admin_key_path = admin_tls_paths
+        fname = os.path.join(self.config_dir, "kubeconfig-%s" % (cluster_name,))
+        inputs = (master_ip, self.ca_cert_path, admin_cert_path,
+                  admin_key_path)
+        if self._kubeconfigs.get(fname) == inputs:
+            return fname
         kubeconfig = {
             "apiVersion": "v1",
             "kind": "Config",
@@ -170,8 +314,8 @@ class Config(object):
                 {
                     "name": "admin",
                     "user": {
-                        "client-certificate": self.admin_cert_path,
-                        "client-key": self.admin_key_path,
+                        "client-certificate": admin_cert_path,
+                        "client-key": admin_key_path,
                     },
                 },
             ],
@@ -186,9 +330,11 @@ class Config(object):
             ],
             "current-context": cluster_name,
         }
-        fname = os.path.join(self.config_dir, "kubeconfig-%s" % (cluster_name,))
-        with open(fname, "wt") as f:
-            yaml.dump(kubeconfig, f)
+        data = yaml.dump(kubeconfig, Dumper=Dumper)
+        if _file_digest(fname) != _digest(data):
+            self.log.debug("Writing %s", fname)
+            _write_atomically(fname, data)
+        self._kubeconfigs[fname] = inputs
         return fname
 
 
@@ -230,10 +376,233 @@ class SSHKeyPair(object):
         return fname
 
 
+class Store(object):
+    """Where cluster definitions are kept.
+
+    Stores return cluster definitions from :meth:`load` in a mutable
+    mapping, indexed by cluster name, which :meth:`save` is given back along
+    with the names of the clusters to save (or delete, if missing from the
+    mapping). The remaining methods have defaults for stores which do not
+    keep anything besides cluster definitions.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, config):
+        self.config = config
+
+    def load(self):
+        raise NotImplementedError("load")
+
+    def save(self, clusters, names):
+        raise NotImplementedError("save")
+
+    def node_cluster(self, clusters, node_name):
+        for name, cluster in clusters.items():
+            for n in cluster["nodes"]:
+                if n["name"] == node_name:
+                    return name
+        return None
+
+    def list_nodes(self, clusters):
+        nodes = []
+        for name, cluster in sorted(clusters.items()):
+            for n in cluster["nodes"]:
+                n = dict(n, cluster=name)
+                n.setdefault("provider_id", None)
+                n.setdefault("public_ips", [])
+                n.setdefault("private_ips", [])
+                nodes.append(n)
+        return nodes
+
+    def record_node(self, node_name, provider_id, public_ips, private_ips):
+        pass
+
+    def record_env(self, clusters, cluster_name, env):
+        cluster = dict(clusters[cluster_name])
+        cluster["env"] = env
+        clusters[cluster_name] = cluster
+        self.save(clusters, [cluster_name])
+
+    def record_certificate(self, name, entry):
+        pass
+
+    def record_operation(self, cluster_name, operation, status, started,
+                         finished):
+        pass
+
+
+class YamlStore(Store):
+    """Keeps every cluster definition in its own YAML file.
+
+    Files are replaced atomically while holding an advisory lock, so that
+    concurrent runs working on different clusters never get in each other's
+    way.
+
+    """
+
+    def load(self):
+        self._migrate_clusters_yaml()
+        return _clusters_cache.load_dir(self.config.clusters_dir)
+
+    def save(self, clusters, names):
+        for name in names:
+            fname = self.config.cluster_path(name)
+            with utils.file_lock(self._lock_path(name)):
+                if name in clusters:
+                    self.log.debug("Saving cluster definition to %s", fname)
+                    _write_cluster(fname, clusters[name])
+                else:
+                    self.log.debug("Removing %s", fname)
+                    try:
+                        os.unlink(fname)
+                    except OSError as exc:
+                        if exc.errno != errno.ENOENT:
+                            raise
+
+    def _lock_path(self, name):
+        return os.path.join(self.config.clusters_dir, ".%s.lock" % (name,))
+
+    def _migrate_clusters_yaml(self):
+        # Older versions kept all clusters in a single file.
+        legacy_path = self.config.clusters_yaml_path
+        if not os.access(legacy_path, os.F_OK):
+            return
+        clusters_dir = self.config.clusters_dir
+        with utils.file_lock(os.path.join(clusters_dir, ".migrate.lock")):
+            if not os.access(legacy_path, os.F_OK):
+                return
+            self.log.info("Migrating %s to %s", legacy_path, clusters_dir)
+            for name, cluster in sorted(load_clusters_yaml(legacy_path)
+                                        .items()):
+                fname = self.config.cluster_path(name)
+                with utils.file_lock(self._lock_path(name)):
+                    if not os.access(fname, os.F_OK):
+                        _write_cluster(fname, cluster)
+            os.rename(legacy_path, legacy_path + ".migrated")
+
+
+class ClustersCache(object):
+    """Parsed cluster definition files, shared by all :class:`Config`
+    instances.
+
+    Files are parsed again only when their modification time or size
+    changes. Cached definitions must not be modified.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def load_dir(self, dname):
+        """Return the definitions of all clusters in ``dname``.
+
+        """
+        clusters = {}
+        for fname in sorted(os.listdir(dname)):
+            if fname.endswith(".yaml") and not fname.startswith("."):
+                cluster = self.load(os.path.join(dname, fname))
+                if cluster is not None:
+                    clusters[fname[:-len(".yaml")]] = cluster
+        return clusters
+
+    def load(self, fname):
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        stamp = (st.st_mtime, st.st_size)
+        with self._lock:
+            entry = self._entries.get(fname)
+            if entry is not None and entry[0] == stamp:
+                return entry[1]
+        self.log.debug("Loading cluster definition from %s", fname)
+        with open(fname, "rt") as f:
+            cluster = parse_cluster(yaml.load(f, Loader=SafeLoader))
+        with self._lock:
+            self._entries[fname] = (stamp, cluster)
+        return cluster
+
+    def store(self, fname, cluster):
+        st = os.stat(fname)
+        with self._lock:
+            self._entries[fname] = ((st.st_mtime, st.st_size), cluster)
+
+
+_clusters_cache = ClustersCache()
+
+
+def parse_cluster(cluster):
+    if "provider" in cluster:
+        cluster["provider"] = provider_name(cluster["provider"])
+    for keys, parse in ((IP_NETWORK_KEYS, ipaddress.ip_network),
+                        (IP_ADDRESS_KEYS, ipaddress.ip_address)):
+        for k in keys:
+            if k in cluster:
+                cluster[k] = parse(u"%s" % (cluster[k],))
+    return cluster
+
+
+def dump_cluster(cluster):
+    data = dict(cluster)
+    if "provider" in data:
+        data["provider"] = provider_name(data["provider"])
+    for k in IP_NETWORK_KEYS + IP_ADDRESS_KEYS:
+        if k in data:
+            data[k] = str(data[k])
+    return data
+
+
+def provider_name(provider):
+    # Older versions saved provider objects instead of their names.
+    return getattr(provider, "name", provider)
+
+
+def load_clusters_yaml(fname):
+    with open(fname, "rt") as f:
+        # Older versions saved addresses as Python objects, which only the
+        # full loader can read back.
+        clusters = yaml.load(f, Loader=Loader) or {}
+    return dict((name, parse_cluster(c)) for name, c in clusters.items())
+
+
+def _write_cluster(fname, cluster):
+    # The safe dumper fails on values which the safe loader cannot read back.
+    _write_atomically(fname, yaml.dump(dump_cluster(cluster),
+                                       Dumper=SafeDumper))
+    _clusters_cache.store(fname, cluster)
+
+
+def _write_atomically(fname, data):
+    tmp_path = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmp_path, "wt") as f:
+        f.write(data)
+    os.rename(tmp_path, fname)
+
+
+def _digest(data):
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _file_digest(fname):
+    try:
+        with open(fname, "rt") as f:
+            return _digest(f.read())
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return None
+
+
 LOG = logging.getLogger(__name__)
 
 
 def make_discovery_token(size):
+    import requests
     res = requests.get("https://discovery.etcd.io/new?size=%d" % (size,))
     res.raise_for_status()
     token = res.content[len("https://discovery.etcd.io/"):]
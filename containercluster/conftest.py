@@ -1,3 +1,4 @@
+import itertools
 import logging
 import tempfile
 
@@ -16,24 +17,99 @@ logging.basicConfig(level=logging.DEBUG,
                     format="%(asctime)s %(threadName)s %(name)s %(message)s")
 
 
+# clusters.yaml as saved by the first versions, with addresses and providers
+# dumped as Python objects.
+LEGACY_CLUSTERS_YAML = """\
+old-cluster:
+  channel: alpha
+  discovery_token: 0123456789abcdef
+  dns_service_ip: !!python/object/apply:ipaddress.IPv4Address
+  - 2886795274
+  kubernetes_service_ip: !!python/object/apply:ipaddress.IPv4Address
+  - 2886795265
+  location: lon1
+  network: !!python/object/apply:ipaddress.IPv4Network
+  - 172.16.0.0/16
+  nodes:
+  - name: old-cluster-etcd0
+    size: 512mb
+    type: etcd
+  - name: old-cluster-master
+    size: 1gb
+    type: master
+  - name: old-cluster-worker0
+    size: 1gb
+    type: worker
+  provider: !!python/object:containercluster.digitalocean.DigitalOceanProvider
+    _node_objs: {}
+    images: {}
+    locations: {}
+    sizes: {}
+  services_ip_range: !!python/object/apply:ipaddress.IPv4Network
+  - 172.17.0.0/24
+  subnet_length: 24
+  subnet_max: !!python/object/apply:ipaddress.IPv4Network
+  - 172.16.254.0/24
+  subnet_min: !!python/object/apply:ipaddress.IPv4Network
+  - 172.16.1.0/24
+"""
+
+
 @fixture
 def config(scope="function"):
     home = tempfile.mkdtemp(prefix="container-cluster-test-")
     return Config(home)
 
 
-@yield_fixture
-def mock_cluster(scope="function"):
+@fixture
+def legacy_config(scope="function"):
     home = tempfile.mkdtemp(prefix="container-cluster-test-")
     conf = Config(home)
+    with open(conf.clusters_yaml_path, "wt") as f:
+        f.write(LEGACY_CLUSTERS_YAML)
+    return conf
+
+
+def create_mock_cluster(name, store="yaml", **kwargs):
+    home = tempfile.mkdtemp(prefix="container-cluster-test-")
+    conf = Config(home, store=store)
     provider = providers.get_provider("mockprovider")
-    cluster = core.create_cluster("test-cluster1", "alpha", 3, "512mb", 4,
-                                  "1gb", provider, "lon1",
-                                  ipaddress.ip_network(u"172.16.0.0/16"), 24,
-                                  ipaddress.ip_network(u"172.16.1.0"),
-                                  ipaddress.ip_network(u"172.16.254.0"),
-                                  ipaddress.ip_network(u"172.17.0.0/24"),
-                                  ipaddress.ip_address(u"172.17.0.10"),
-                                  ipaddress.ip_address(u"172.17.0.1"), conf)
+    return core.create_cluster(name, "alpha", 3, "512mb", 4,
+                               "1gb", provider, "lon1",
+                               ipaddress.ip_network(u"172.16.0.0/16"), 24,
+                               ipaddress.ip_network(u"172.16.1.0"),
+                               ipaddress.ip_network(u"172.16.254.0"),
+                               ipaddress.ip_network(u"172.17.0.0/24"),
+                               ipaddress.ip_address(u"172.17.0.10"),
+                               ipaddress.ip_address(u"172.17.0.1"), conf,
+                               **kwargs)
+
+
+@yield_fixture
+def mock_cluster(scope="function"):
+    cluster = create_mock_cluster("test-cluster1")
     with cluster.provider.ssh_server:
         yield cluster
+
+
+_mock_cluster_ids = itertools.count(1)
+
+
+@yield_fixture
+def make_mock_cluster(scope="function"):
+    """Factory of mock clusters, each with a name of its own, taking the
+    store to keep them in and the options of ``core.create_cluster``.
+
+    """
+    servers = []
+
+    def make(store="yaml", **kwargs):
+        name = "mock-cluster%d" % (next(_mock_cluster_ids),)
+        cluster = create_mock_cluster(name, store, **kwargs)
+        cluster.provider.ssh_server.__enter__()
+        servers.append(cluster.provider.ssh_server)
+        return cluster
+
+    yield make
+    for server in reversed(servers):
+        server.__exit__(None, None, None)
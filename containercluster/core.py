@@ -1,17 +1,21 @@
+import base64
+import gzip
+import io
 import logging
 import json
 import os
+import posixpath
 import subprocess
 import tempfile
+import time
 
 try:
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlparse
 
-from libcloud.compute.types import NodeState
-
-from containercluster import utils
+from containercluster import (engine, metrics, providers, render, trace,
+                              utils)
 
 
 __all__ = [
@@ -31,6 +35,15 @@ class Node(object):
     ssh_port = 22
     sudo_cmd = "sudo"
     certs_dir = "/home/core/tls"
+    cloud_config_path = "/var/lib/coreos-install/user_data"
+    cloudinit_cmd = "coreos-cloudinit --from-file=%s"
+
+    # Whether the cloud-config of this node type depends on the addresses of
+    # other nodes.
+    needs_cluster_addresses = False
+
+    # The variables used by the cloud-config template of this node type.
+    cloud_config_keys = ("certs_dir", "discovery_token", "node_name")
 
     log = logging.getLogger(__name__)
 
@@ -40,35 +53,95 @@ class Node(object):
         self.cluster = cluster
         self.config = config
 
-    def provision(self):
+    def provision(self, wait=True):
+        """Install the files of this node.
+
+        Unless ``wait`` is false, waits for the node to be running and to
+        accept SSH connections first.
+
+        """
+        with trace.span("Node.provision", node=self.name), \
+                NODE_PHASE_SECONDS.time(phase="provision"):
+            self._provision(wait)
+
+    def _provision(self, wait):
         self.log.debug("Provisioning node %s", self.name)
-        self.provider.wait_until_running(self)
+        if wait:
+            self.provider.wait_until_running(self)
 
         ssh_host = self.public_ips[0]
         try:
-            self.log.debug("Waiting for SSH on %s:%d", ssh_host, self.ssh_port)
-            utils.wait_for_port_open(ssh_host, self.ssh_port, check_interval=1.0)
+            if wait:
+                self.log.debug("Waiting for SSH on %s:%d", ssh_host,
+                               self.ssh_port)
+                utils.wait_for_port_open(ssh_host, self.ssh_port,
+                                         check_interval=1.0)
 
             with self.ssh_session as s:
-                s.exec_command("%s mkdir -p %s" % (self.sudo_cmd, self.certs_dir))
-                s.exec_command("%s chown -R %s %s" %
-                               (self.sudo_cmd, self.ssh_uid, self.certs_dir))
-                try:
-                    sftp = s.open_sftp()
-                    sftp.put(self.config.ca_cert_path,
-                             os.path.join(self.certs_dir, "ca.pem"))
-                    sftp.put(self.tls_cert_path,
-                             os.path.join(self.certs_dir, "node.pem"))
-                    sftp.put(self.tls_key_path,
-                             os.path.join(self.certs_dir, "node-key.pem"))
-                finally:
-                    s.exec_command("%s chown -R root: %s" %
-                                   (self.sudo_cmd, self.certs_dir))
+                self.push_files(s)
         except:
             msg = "Provisioning '%s' failed" % (self.name,)
             self.log.debug(msg, exc_info=True)
             raise Exception(msg)
 
+    def push_files(self, s):
+        """Install the files of this node with a single remote command.
+
+        Late-bound nodes get their full cloud-config too, which is then
+        applied by the same command.
+
+        """
+        files = self.files
+        post_cmd = None
+        if self.late_bound:
+            self.log.debug("Applying cloud-config on node %s", self.name)
+            data = self.cloud_config_data
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            files.append((self.cloud_config_path, data, 0o600))
+            post_cmd = self.cloudinit_cmd % (self.cloud_config_path,)
+        cmd, data = utils.push_files_command(files, self.sudo_cmd, post_cmd)
+        self.log.debug("Pushing %d file(s) (%d bytes) to node %s",
+                       len(files), len(data), self.name)
+        with trace.span("Node.push_files", node=self.name, files=len(files),
+                        bytes=len(data)), \
+                NODE_PHASE_SECONDS.time(phase="push_files"):
+            self.run_command(s, cmd, data)
+
+    @property
+    def files(self):
+        """The files to install on this node, as tuples
+        ``(path, data, mode)``.
+
+        """
+        return [
+            self._pem_file("ca.pem", self.config.ca_cert_path, 0o644),
+            self._pem_file("node.pem", self.tls_cert_path, 0o644),
+            self._pem_file("node-key.pem", self.tls_key_path, 0o600),
+        ]
+
+    def _pem_file(self, fname, local_path, mode):
+        data = self.config.ca.read_pem(local_path)
+        if not isinstance(data, bytes):
+            data = data.encode("ascii")
+        return (posixpath.join(self.certs_dir, fname), data, mode)
+
+    def run_command(self, s, cmd, data=None, check=True):
+        """Run ``cmd`` in the SSH session ``s`` and wait for it to finish.
+
+        Commands must not be left running, since the connection behind ``s``
+        is shared with other users.
+
+        """
+        status, stderr = s.run(cmd, data)
+        if status:
+            msg = ("Command `%s` failed on node %s (status %d): %s" %
+                   (cmd, self.name, status,
+                    stderr.decode("utf-8", "replace").strip()))
+            if check:
+                raise Exception(msg)
+            self.log.warn(msg)
+
     def destroy(self):
         for fname in self.tls_paths:
             self.log.debug("Removing %s", fname)
@@ -94,40 +167,58 @@ class Node(object):
 
     @property
     def cloud_config_template(self):
-        fname = os.path.join(os.path.dirname(__file__),
-                             "%s-cloud-config.yaml" % (self.node_type,))
-        if not os.access(fname, os.F_OK):
-            raise Exception("No cloud-config template for node type '%s'" %
-                            (self.node_type,))
-
-        with open(fname, "rt") as f:
-            return f.read()
+        return render.load_template(self.node_type,
+                                    self.cloud_config_keys).text
 
     @property
     def cloud_config_vars(self):
-        cluster = self.config.clusters[self.cluster.name]
+        vars = self.cluster.cloud_config_vars(
+            k for k in self.cloud_config_keys if k not in NODE_CONFIG_KEYS
+        )
+        vars.update(self.node_config_vars)
+        return vars
+
+    @property
+    def node_config_vars(self):
+        """The cloud-config variables which differ between nodes.
+
+        """
         return {
             "certs_dir": self.certs_dir,
-            "discovery_token": cluster["discovery_token"],
-            "kubernetes_version": "v1.1.2",
-            "network_config": json.dumps(
-                {
-                    "Network": str(cluster["network"]),
-                    "SubnetLen": cluster["subnet_length"],
-                    "SubnetMin": str(cluster["subnet_min"].network_address),
-                    "SubnetMax": str(cluster["subnet_max"].network_address),
-                    "Backend": {
-                        "Type": "vxlan",
-                        "VNI": 1,
-                        "Port": 8472,
-                    }
-                }),
             "node_name": self.name,
         }
 
     @property
     def cloud_config_data(self):
-        return self.cloud_config_template % self.cloud_config_vars
+        template = self.cluster.cloud_config_template(self.node_type,
+                                                      self.cloud_config_keys)
+        return template.render(self.node_config_vars)
+
+    @property
+    def late_bound(self):
+        """Whether this node gets its cloud-config at provisioning time.
+
+        In single-wave clusters, nodes whose cloud-config depends on the
+        addresses of other nodes are created with a minimal cloud-config, so
+        that all nodes may be created at once.
+
+        """
+        cluster = self.config.clusters[self.cluster.name]
+        return (self.needs_cluster_addresses and
+                cluster.get("single_wave", False))
+
+    @property
+    def user_data(self):
+        """The cloud-config data to create this node with.
+
+        """
+        if self.late_bound:
+            return BOOT_CLOUD_CONFIG
+        if self.cluster.compress_user_data:
+            return compress_cloud_config(self.cloud_config_data,
+                                         self.cloud_config_path,
+                                         self.cloudinit_cmd)
+        return self.cloud_config_data
 
     @property
     def ssh_session(self):
@@ -146,8 +237,7 @@ class Node(object):
 
     @property
     def tls_cert(self):
-        with open(self.tls_cert_path, "rt") as f:
-            return f.read()
+        return self.config.ca.read_pem(self.tls_cert_path)
 
     @property
     def tls_key_path(self):
@@ -156,14 +246,14 @@ class Node(object):
 
     @property
     def tls_key(self):
-        with open(self.tls_key_path, "rt") as f:
-            return f.read()
+        return self.config.ca.read_pem(self.tls_key_path)
 
     def _ensure_tls(self):
         alt_names = [u"127.0.0.1"]
         alt_names.extend(u"%s" % (ip,) for ip in self.public_ips)
         alt_names.extend(u"%s" % (ip,)for ip in self.private_ips)
-        return self.config.node_tls_paths(self.name, alt_names)
+        return self.config.node_tls_paths(self.name, alt_names,
+                                          self.cluster.key_algorithm)
 
 
 class EtcdNode(Node):
@@ -175,55 +265,31 @@ class WorkerNode(Node):
 
     node_type = "worker"
 
-    @property
-    def cloud_config_vars(self):
-        cluster = self.config.clusters[self.cluster.name]
-        vars = dict(super(WorkerNode, self).cloud_config_vars)
-        vars.update({
-            "cluster_name": self.cluster.name,
-            "dns_service_ip": str(cluster["dns_service_ip"]),
-            "etcd_endpoint": self.cluster.etcd_endpoint,
-            "master_address": self.cluster.master_ip,
-        })
-        return vars
+    needs_cluster_addresses = True
+
+    cloud_config_keys = ("certs_dir", "cluster_name", "dns_service_ip",
+                         "etcd_endpoint", "kubernetes_version",
+                         "master_address", "network_config")
 
 
 class MasterNode(Node):
 
     node_type = "master"
 
-    @property
-    def cloud_config_vars(self):
-        cluster = self.config.clusters[self.cluster.name]
-        etcd_url = urlparse(self.cluster.etcd_endpoint.split(",")[0])
-        etcd_host, etcd_port = etcd_url.netloc.split(":")
-        vars = dict(super(MasterNode, self).cloud_config_vars)
-        vars.update({
-            "cluster_name": self.cluster.name,
-            "dns_service_ip": str(cluster["dns_service_ip"]),
-            "etcd_endpoint": self.cluster.etcd_endpoint,
-            "etcd_endpoint_list": ", ".join('"%s"' % (e,) for e in self.cluster.etcd_endpoint.split(",")),
-            "etcd_endpoint_host": etcd_host,
-            "etcd_endpoint_port": etcd_port,
-            "services_ip_range": str(cluster["services_ip_range"]),
-        })
-        return vars
+    needs_cluster_addresses = True
 
-    def provision(self):
-        super(MasterNode, self).provision()
+    cloud_config_keys = ("certs_dir", "cluster_name", "dns_service_ip",
+                         "etcd_endpoint", "etcd_endpoint_host",
+                         "etcd_endpoint_port", "kubernetes_version",
+                         "network_config", "services_ip_range")
 
-        with self.ssh_session as s:
-            s.exec_command("%s chown -R %s %s" %
-                           (self.sudo_cmd, self.ssh_uid, self.certs_dir))
-            try:
-                sftp = s.open_sftp()
-                sftp.put(self.apiserver_cert_path,
-                         os.path.join(self.certs_dir, "apiserver.pem"))
-                sftp.put(self.apiserver_key_path,
-                         os.path.join(self.certs_dir, "apiserver-key.pem"))
-            finally:
-                s.exec_command("%s chown -R root: %s" %
-                               (self.sudo_cmd, self.certs_dir))
+    @property
+    def files(self):
+        return super(MasterNode, self).files + [
+            self._pem_file("apiserver.pem", self.apiserver_cert_path, 0o644),
+            self._pem_file("apiserver-key.pem", self.apiserver_key_path,
+                           0o600),
+        ]
 
     @property
     def tls_paths(self):
@@ -237,8 +303,7 @@ class MasterNode(Node):
 
     @property
     def apiserver_cert(self):
-        with open(self.apiserver_cert_path, "rt") as f:
-            return f.read()
+        return self.config.ca.read_pem(self.apiserver_cert_path)
 
     @property
     def apiserver_key_path(self):
@@ -247,8 +312,7 @@ class MasterNode(Node):
 
     @property
     def apiserver_key(self):
-        with open(self.apiserver_key_path, "rt") as f:
-            return f.read()
+        return self.config.ca.read_pem(self.apiserver_key_path)
 
     def _ensure_apiserver_tls(self):
         cluster = self.config.clusters[self.cluster.name]
@@ -261,15 +325,118 @@ class MasterNode(Node):
         ]
         alt_names.extend(u"%s" % (ip,) for ip in self.public_ips)
         alt_names.extend(u"%s" % (ip,) for ip in self.private_ips)
-        return self.config.node_tls_paths(u"kube-apiserver", alt_names)
+        return self.config.node_tls_paths(u"%s-kube-apiserver" %
+                                          (self.cluster.name,), alt_names,
+                                          self.cluster.key_algorithm)
+
+
+BOOT_CLOUD_CONFIG = "#cloud-config\n"
+
+KUBERNETES_VERSION = "v1.1.2"
+
+# Cloud-config variables which differ between nodes of a cluster. All others
+# are shared by the whole cluster.
+NODE_CONFIG_KEYS = frozenset(["certs_dir", "node_name"])
 
 
 NODE_TYPES = dict((cls.node_type, cls) for cls in
                   (EtcdNode, MasterNode, WorkerNode))
 
+NODE_PHASE_SECONDS = metrics.histogram(
+    "containercluster_node_phase_seconds",
+    "Time spent by nodes in each phase of their creation and provisioning.",
+    ("phase",))
+
+
+def timed_phase(phase, target):
+    """Observe the time until the :class:`utils.WaitTarget` ``target`` is
+    done as the duration of ``phase``, and return ``target``.
+
+    """
+    start = time.time()
+    target.add_callback(lambda _: NODE_PHASE_SECONDS.observe(
+        time.time() - start, phase=phase))
+    return target
+
+
+# Writes the compressed cloud-config of a node to disk, and applies it from a
+# service once the boot cloud-config has been applied.
+COMPRESSED_CLOUD_CONFIG = """#cloud-config
+
+write_files:
+  - path: %(path)s
+    permissions: "0600"
+    owner: root
+    encoding: gzip+base64
+    content: %(content)s
+
+coreos:
+  units:
+    - name: apply-user-data.service
+      command: start
+      content: |
+        [Unit]
+        Description=Apply the compressed cloud-config
+
+        [Service]
+        Type=oneshot
+        ExecStart=/usr/bin/%(cmd)s
+"""
+
+
+def compress_cloud_config(data, path, cloudinit_cmd):
+    """Return a cloud-config which writes ``data`` gzip-compressed to
+    ``path`` and runs ``cloudinit_cmd`` to apply it.
+
+    """
+    buf = io.BytesIO()
+    # A fixed modification time makes the output depend on data only.
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as f:
+        f.write(data.encode("utf-8"))
+    return COMPRESSED_CLOUD_CONFIG % {
+        "path": path,
+        "content": base64.b64encode(buf.getvalue()).decode("ascii"),
+        "cmd": cloudinit_cmd % (path,),
+    }
+
+
+def user_data_sizes(nodes):
+    """Return the size of the cloud-config of each node type in ``nodes``,
+    as tuples ``(node_type, size, compressed_size)``.
+
+    Late-bound nodes, whose cloud-config is pushed when provisioning them,
+    are left out.
+
+    """
+    sizes = {}
+    for node in nodes:
+        if node.late_bound or node.node_type in sizes:
+            continue
+        data = node.cloud_config_data
+        compressed = compress_cloud_config(data, node.cloud_config_path,
+                                           node.cloudinit_cmd)
+        sizes[node.node_type] = (len(data.encode("utf-8")),
+                                 len(compressed.encode("utf-8")))
+    return [(t,) + sizes[t] for t in sorted(sizes)]
+
+
+def make_network_config(cluster):
+    return json.dumps({
+        "Network": str(cluster["network"]),
+        "SubnetLen": cluster["subnet_length"],
+        "SubnetMin": str(cluster["subnet_min"].network_address),
+        "SubnetMax": str(cluster["subnet_max"].network_address),
+        "Backend": {
+            "Type": "vxlan",
+            "VNI": 1,
+            "Port": 8472,
+        }
+    })
+
 
 def make_etcd_endpoint(nodes):
-    return ",".join("https://%s:2379" % (n.public_ips[0],) for n in nodes)
+    return ",".join("https://%s:2379" % (n.public_ips[0],) for n in nodes
+                    if isinstance(n, EtcdNode))
 
 
 def make_master_ip(nodes):
@@ -283,68 +450,67 @@ class Cluster(object):
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, name, provider, config):
+    def __init__(self, name, provider, config,
+                 max_workers=utils.DEFAULT_MAX_WORKERS):
         self.name = name
         self.provider = provider
         self.config = config
+        self.pool = utils.Pool(max_workers, name=name)
+        self.engine = engine.Engine(self.pool)
         self._nodes = []
         self._node_names = None
         self._master_ip = None
         self._etcd_endpoint = None
+        self._templates = {}
 
     @property
     def nodes(self):
         if not self._nodes:
-            self.log.debug("Creating nodes for cluster '%s'", self.name)
-            etcd_nodes = []
-            master_node = None
-            worker_nodes = []
-            nodes_data = self.config.clusters[self.name]["nodes"]
-            for n in nodes_data:
-                node_type = n["type"]
-                if node_type == "etcd":
-                    etcd_nodes.append(n)
-                elif node_type == "master":
-                    master_node = n
-                elif node_type == "worker":
-                    worker_nodes.append(n)
-                else:
-                    raise TypeError("Invalid node type '%s' for node %s" %
-                                    (node_type, n))
-
-            # Start first the `etcd` nodes, since the etcd endpoint is needed in
-            # all other nodes, and it will not be known until the `etcd` nodes
-            # are up.
-            self._nodes = utils.parallel((self.provider.ensure_node,
-                                          n["name"],
-                                          NODE_TYPES[n["type"]],
-                                          n["size"],
-                                          self,
-                                          self.config)
-                                         for n in etcd_nodes)
-            self._etcd_endpoint = make_etcd_endpoint(self._nodes)
+            with trace.span("Cluster.nodes", cluster=self.name):
+                self._create_nodes()
+        return self._nodes
 
-            # Start now the master node, since its address is needed in all
-            # worker nodes, and it will not be known until the master node is
-            # up.
-            n = master_node
-            self._nodes.append(self.provider.ensure_node(n["name"],
-                                                         MasterNode,
-                                                         n["size"],
-                                                         self,
-                                                         self.config))
+    def _create_nodes(self):
+        self.log.debug("Creating nodes for cluster '%s'", self.name)
+        etcd_nodes = []
+        master_node = None
+        worker_nodes = []
+        nodes_data = self.config.clusters[self.name]["nodes"]
+        for n in nodes_data:
+            node_type = n["type"]
+            if node_type == "etcd":
+                etcd_nodes.append(n)
+            elif node_type == "master":
+                master_node = n
+            elif node_type == "worker":
+                worker_nodes.append(n)
+            else:
+                raise TypeError("Invalid node type '%s' for node %s" %
+                                (node_type, n))
+
+        if self.config.clusters[self.name].get("single_wave", False):
+            # Master and worker nodes get the etcd endpoint and the master
+            # address when they are provisioned, so all nodes may be
+            # created at once.
+            self._nodes = self._ensure_nodes(nodes_data)
+            self._etcd_endpoint = make_etcd_endpoint(self._nodes)
             self._master_ip = make_master_ip(self._nodes)
+            return
 
-            # Start now all worker nodes.
-            self._nodes.extend(utils.parallel((self.provider.ensure_node,
-                                               n["name"],
-                                               NODE_TYPES[n["type"]],
-                                               n["size"],
-                                               self,
-                                               self.config)
-                                              for n in worker_nodes))
+        # Start first the `etcd` nodes, since the etcd endpoint is needed in
+        # all other nodes, and it will not be known until the `etcd` nodes
+        # are up.
+        self._nodes = self._ensure_nodes(etcd_nodes)
+        self._etcd_endpoint = make_etcd_endpoint(self._nodes)
 
-        return self._nodes
+        # Start now the master node, since its address is needed in all
+        # worker nodes, and it will not be known until the master node is
+        # up.
+        self._nodes.extend(self._ensure_nodes([master_node]))
+        self._master_ip = make_master_ip(self._nodes)
+
+        # Start now all worker nodes.
+        self._nodes.extend(self._ensure_nodes(worker_nodes))
 
     @property
     def etcd_nodes(self):
@@ -359,13 +525,11 @@ class Cluster(object):
     @property
     def exisiting_nodes(self):
         ret = []
-        driver_nodes = dict((n.name, n) for n in self.provider.list_nodes())
         for n in self.config.clusters[self.name]["nodes"]:
             name = n["name"]
-            if name in driver_nodes:
+            if self.provider.find_node(name) is not None:
                 node_class = NODE_TYPES[n["type"]]
                 node = node_class(name, self.provider, self, self.config)
-                self.provider.register_node(name, driver_nodes[name])
                 ret.append(node)
         return ret
 
@@ -389,19 +553,23 @@ class Cluster(object):
 
     def start_nodes(self):
         self.log.debug("Starting nodes for cluster '%s'", self.name)
+        connections = self.provider.connections_opened
+
+        NodeState = providers.compute_types.NodeState
 
         def restart_if_needed(node):
-            if node.state == NodeState.RUNNING:
+            state = node.state()
+            if state == NodeState.RUNNING:
                 self.log.debug("Node '%s' running", node.name)
-                return
+                return node
 
-            if node.state == NodeState.REBOOTING:
+            if state == NodeState.REBOOTING:
                 self.log.debug("Node '%s' rebooting", node.name)
-                return
+                return node
 
-            if node.state == NodeState.PENDING:
+            if state == NodeState.PENDING:
                 self.log.debug("Node '%s' is being created", node.name)
-                return
+                return node
 
             error_states = {
                 NodeState.TERMINATED,
@@ -409,25 +577,133 @@ class Cluster(object):
                 NodeState.UNKNOWN
             }
 
-            if node.state in error_states:
+            if state in error_states:
                 raise Exception("Node '%s' cannot be restarted" % (node.name,))
 
             self.log.debug("Rebooting node '%s'", node.name)
             self.provider.reboot_node(node)
+            return node
 
-        utils.parallel((restart_if_needed, node) for node in self.nodes)
-        self.log.debug("%s: Waiting for nodes ...", self.name)
-        nodes = self.provider.wait_until_running(*self.nodes)
+        nodes = self.engine.run(
+            (node, [restart_if_needed,
+                    self._wait_until_running_step(node.name),
+                    self._record_node])
+            for node in self.nodes)
         self.log.debug("start_nodes(): Nodes up: %s", nodes)
+        self.log.debug("start_nodes(): %d API connection(s) opened",
+                       self.provider.connections_opened - connections)
 
     def provision_nodes(self):
+        connections = self.provider.connections_opened
+        ssh_connections = utils.shared_ssh_pool().connections_opened
         try:
-            utils.parallel((self.provider.provision_node, n)
-                           for n in self.nodes)
+            self.engine.run((n, [self._wait_until_running_step(n.name),
+                                 self._wait_for_ssh_step(n),
+                                 self._provision_node])
+                            for n in self.nodes)
         except Exception as exc:
             self.log.debug("Cluster provisioning failed: %s", exc,
                            exc_info=True)
             raise
+        finally:
+            self.log.debug("provision_nodes(): %d API connection(s) opened",
+                           self.provider.connections_opened - connections)
+            self.log.debug("provision_nodes(): %d SSH connection(s) opened",
+                           utils.shared_ssh_pool().connections_opened -
+                           ssh_connections)
+
+    def _ensure_nodes(self, nodes_data):
+        # The listing is shared with ensure_nodes(), which needs it anyway.
+        new_names = set(n["name"] for n in nodes_data
+                        if self.provider.find_node(n["name"]) is None)
+        nodes = self.provider.ensure_nodes([(n["name"],
+                                             NODE_TYPES[n["type"]],
+                                             n["size"])
+                                            for n in nodes_data],
+                                           self, self.config, wait=False,
+                                           pool=self.pool)
+        self._log_user_data_sizes([n for n in nodes if n.name in new_names])
+        return self.engine.run((n, [self._wait_until_running_step(n.name),
+                                    self._record_node])
+                               for n in nodes)
+
+    def _log_user_data_sizes(self, nodes):
+        if self.compress_user_data:
+            log = self.log.info
+        elif self.log.isEnabledFor(logging.DEBUG):
+            log = self.log.debug
+        else:
+            return
+        for node_type, plain, compressed in user_data_sizes(nodes):
+            log("User data of %s nodes: %d bytes, %d bytes compressed (%d%%)",
+                node_type, plain, compressed, 100 * compressed // plain)
+
+    def _provision_node(self, node):
+        # The previous steps of the pipeline waited for the node.
+        return self.provider.provision_node(node, wait=False)
+
+    def _record_node(self, node):
+        self.config.record_node(node.name, self.provider.node_id(node),
+                                node.public_ips, node.private_ips)
+        return node
+
+    def _wait_until_running_step(self, name):
+        return engine.wait_for(
+            lambda n: timed_phase(
+                "wait_until_running",
+                self.provider.readiness.watch(name, timeout=600)),
+            "node '%s' running" % (name,))
+
+    def _wait_for_ssh_step(self, node):
+        # SSH ports of all nodes are watched by a single waiter thread, and
+        # every node goes on as soon as its own port is open.
+        return engine.wait_for(
+            lambda n: timed_phase(
+                "wait_for_ssh",
+                utils.shared_port_waiter().watch(
+                    n.public_ips[0], n.ssh_port, timeout=600, interval=1.0)),
+            "SSH on node '%s'" % (node.name,))
+
+    def cloud_config_vars(self, keys):
+        """Return the cluster-wide cloud-config variables in ``keys``.
+
+        """
+        cluster = self.config.clusters[self.name]
+
+        def etcd_address(i):
+            etcd_url = urlparse(self.etcd_endpoint.split(",")[0])
+            return etcd_url.netloc.split(":")[i]
+
+        getters = {
+            "cluster_name": lambda: self.name,
+            "discovery_token": lambda: cluster["discovery_token"],
+            "dns_service_ip": lambda: str(cluster["dns_service_ip"]),
+            "etcd_endpoint": lambda: self.etcd_endpoint,
+            "etcd_endpoint_host": lambda: etcd_address(0),
+            "etcd_endpoint_port": lambda: etcd_address(1),
+            "kubernetes_version": lambda: KUBERNETES_VERSION,
+            "master_address": lambda: self.master_ip,
+            "network_config": lambda: make_network_config(cluster),
+            "services_ip_range": lambda: str(cluster["services_ip_range"]),
+        }
+        return dict((k, getters[k]()) for k in keys)
+
+    def cloud_config_template(self, node_type, keys):
+        """Return the cloud-config template for ``node_type``, with the
+        cluster-wide variables already filled in.
+
+        """
+        template = self._templates.get(node_type)
+        if template is None:
+            # The variables may need the nodes of the cluster, whose
+            # creation renders templates: no lock may be held meanwhile.
+            # Threads racing here bind the same values, and the first
+            # template published wins.
+            template = render.load_template(node_type, keys).bind(
+                self.cloud_config_vars(k for k in keys
+                                       if k not in NODE_CONFIG_KEYS))
+            template = self._templates.setdefault(node_type, template)
+        return template
 
     @property
     def etcd_endpoint(self):
@@ -441,19 +717,49 @@ class Cluster(object):
             self._master_ip = make_master_ip(self.nodes)
         return self._master_ip
 
+    @property
+    def key_algorithm(self):
+        return self.config.clusters[self.name].get("key_algorithm")
+
+    @property
+    def compress_user_data(self):
+        return self.config.clusters[self.name].get("compress_user_data",
+                                                   False)
+
     @property
     def kubeconfig_path(self):
         return self.config.kubeconfig_path(self.name, self.master_ip)
 
     @property
-    def env_variables(self):
-        return (
-            ("ETCDCTL_CA_FILE", self.config.ca_cert_path),
-            ("ETCDCTL_CERT_FILE", self.config.admin_cert_path),
-            ("ETCDCTL_KEY_FILE", self.config.admin_key_path),
-            ("ETCDCTL_ENDPOINT", self.etcd_endpoint),
-            ("KUBECONFIG", self.kubeconfig_path),
+    def env(self):
+        """The addresses and certificate paths needed to access the cluster,
+        looked up through the provider.
+
+        """
+        admin_cert_path, admin_key_path = self.config.admin_tls_paths(
+            self.key_algorithm
         )
+        return {
+            "ca_cert_path": self.config.ca_cert_path,
+            "admin_cert_path": admin_cert_path,
+            "admin_key_path": admin_key_path,
+            "etcd_endpoint": self.etcd_endpoint,
+            "master_ip": self.master_ip,
+        }
+
+    @property
+    def env_variables(self):
+        return env_variables(self.name, self.env, self.config)
+
+    def record_env(self):
+        """Record :attr:`env` in the cluster state, for :func:`cluster_env`
+        to use without querying the provider, and return it.
+
+        """
+        env = self.env
+        self.log.debug("Recording environment of cluster '%s'", self.name)
+        self.config.record_env(self.name, env)
+        return env
 
 
 LOG = logging.getLogger(__name__)
@@ -462,21 +768,30 @@ LOG = logging.getLogger(__name__)
 def create_cluster(name, channel, n_etcd, size_etcd, n_workers, size_worker,
                    provider, location, network, subnet_length, subnet_min,
                    subnet_max,  services_ip_range, dns_service_ip,
-                   kubernetes_service_ip, config):
+                   kubernetes_service_ip, config,
+                   max_workers=utils.DEFAULT_MAX_WORKERS, single_wave=False,
+                   key_algorithm=None, compress_user_data=False):
     LOG.info("Creating cluster '%s' ...", name)
-    config.add_cluster(name, channel, n_etcd, size_etcd,
-                       n_workers, size_worker, provider, location, network,
-                       subnet_length, subnet_min, subnet_max, services_ip_range,
-                       dns_service_ip, kubernetes_service_ip)
-    config.save()
-    return Cluster(name, provider, config)
-
-
-def provision_cluster(name, provider, config):
+    with config.operation(name, "create"):
+        config.add_cluster(name, channel, n_etcd, size_etcd,
+                           n_workers, size_worker, provider.name, location,
+                           network, subnet_length, subnet_min, subnet_max,
+                           services_ip_range, dns_service_ip,
+                           kubernetes_service_ip, single_wave,
+                           key_algorithm or config.ca_key_algorithm,
+                           compress_user_data)
+        config.save()
+    return Cluster(name, provider, config, max_workers)
+
+
+def provision_cluster(name, provider, config,
+                      max_workers=utils.DEFAULT_MAX_WORKERS):
     LOG.info("Provisioning cluster '%s' ...", name)
-    cluster = Cluster(name, provider, config)
+    cluster = Cluster(name, provider, config, max_workers)
     try:
-        cluster.provision_nodes()
+        with config.operation(name, "provision"):
+            cluster.provision_nodes()
+            cluster.record_env()
     except:
         LOG.warn("Cluster provisioning failed. Try provisioning again "
                  "in a few minutes.")
@@ -486,19 +801,59 @@ def provision_cluster(name, provider, config):
 def destroy_cluster(name, provider, config):
     LOG.info("Destroying cluster '%s' ...", name)
     cluster = Cluster(name, provider, config)
-    cluster.destroy_nodes()
-    config.remove_cluster(name)
-    config.save()
-
-
-def start_cluster(name, provider, config):
-    cluster = Cluster(name, provider, config)
-    return cluster.start_nodes()
-
-
-def cluster_env(name, provider, config):
-    cluster = Cluster(name, provider, config)
-    return sorted(cluster.env_variables)
+    with config.operation(name, "destroy"):
+        cluster.destroy_nodes()
+        config.remove_cluster(name)
+        config.save()
+
+
+def start_cluster(name, provider, config,
+                  max_workers=utils.DEFAULT_MAX_WORKERS):
+    cluster = Cluster(name, provider, config, max_workers)
+    with config.operation(name, "start"):
+        nodes = cluster.start_nodes()
+        cluster.record_env()
+        return nodes
+
+
+def cluster_env(name, provider, config, refresh=False):
+    """Return the environment variables needed to access cluster ``name``.
+
+    They are made from the environment recorded after the cluster was last
+    started or provisioned, and only looked up through ``provider`` when
+    nothing was recorded, when the recorded certificate files are gone, or
+    when ``refresh`` is true.
+
+    """
+    env = None if refresh else recorded_env(name, config)
+    if env is None:
+        env = Cluster(name, provider, config).record_env()
+    return sorted(env_variables(name, env, config))
+
+
+def recorded_env(name, config):
+    env = config.clusters[name].get("env")
+    if env is None:
+        return None
+    for k in ("ca_cert_path", "admin_cert_path", "admin_key_path"):
+        if not os.access(env[k], os.F_OK):
+            LOG.debug("Ignoring recorded environment of cluster '%s': "
+                      "%s is missing", name, env[k])
+            return None
+    return env
+
+
+def env_variables(name, env, config):
+    kubeconfig_path = config.kubeconfig_path(name, env["master_ip"],
+                                             (env["admin_cert_path"],
+                                              env["admin_key_path"]))
+    return (
+        ("ETCDCTL_CA_FILE", env["ca_cert_path"]),
+        ("ETCDCTL_CERT_FILE", env["admin_cert_path"]),
+        ("ETCDCTL_KEY_FILE", env["admin_key_path"]),
+        ("ETCDCTL_ENDPOINT", env["etcd_endpoint"]),
+        ("KUBECONFIG", kubeconfig_path),
+    )
 
 
 def ssh_session(name, provider, config):
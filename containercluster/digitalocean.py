@@ -1,10 +1,12 @@
+import json
 import logging
 import os
 
-from libcloud.compute.types import NodeState, Provider
-from libcloud.compute.providers import get_driver
+from containercluster import providers, utils
 
-from containercluster import providers
+
+compute_providers = utils.lazy_import("libcloud.compute.providers")
+compute_types = utils.lazy_import("libcloud.compute.types")
 
 
 __all__ = []
@@ -20,10 +22,18 @@ class DigitalOceanProvider(providers.Provider):
 
     default_worker_size = "512mb"
 
+    # Maximum number of droplets created with a single API request.
+    max_create_batch = 10
+
+    # 5000 requests per hour, and at most 250 in a minute.
+    api_rate = 5000 / 3600.0
+
+    api_burst = 250
+
     log = logging.getLogger(__name__)
 
-    def __init__(self):
-        super(DigitalOceanProvider, self).__init__()
+    def __init__(self, driver_pool_size=None):
+        super(DigitalOceanProvider, self).__init__(driver_pool_size)
 
     def create_node(self, name, size, channel, location, ssh_key_id,
                     cloud_config_data):
@@ -41,8 +51,32 @@ class DigitalOceanProvider(providers.Provider):
         self.log.debug("Node %s created", name)
         return node
 
+    def create_nodes(self, names, size, channel, location, ssh_key_id,
+                     cloud_config_data, pool=None):
+        attr = {
+            "size": self.get_size(size).name,
+            "image": self.get_image(channel).id,
+            "region": self.get_location(location).id,
+            "user_data": cloud_config_data,
+            "backups": False,
+            "ipv6": False,
+            "private_networking": True,
+            "ssh_keys": [ssh_key_id],
+        }
+        nodes = []
+        for i in range(0, len(names), self.max_create_batch):
+            attr["names"] = names[i:i + self.max_create_batch]
+            with self.checkout_driver() as driver:
+                res = self.call_api("create_nodes", driver.connection.request,
+                                    "/v2/droplets", data=json.dumps(attr),
+                                    method="POST")
+                nodes.extend(driver._to_node(data=data)
+                             for data in res.object["droplets"])
+            self.log.debug("Nodes %s created", ", ".join(attr["names"]))
+        return nodes
+
     def reboot_node(self, node):
-        if node.state == NodeState.STOPPED:
+        if node.state == compute_types.NodeState.STOPPED:
             self.log.debug("Powering on node '%s'", node.name)
             self.driver.ex_power_on_node(node)
         else:
@@ -60,10 +94,11 @@ class DigitalOceanProvider(providers.Provider):
         raise Exception("Cannot find CoreOS image for channel '%s'" %
                         (channel,))
 
-    @property
-    def driver(self):
+    def make_driver(self):
         try:
             token = os.environ["DIGITALOCEAN_ACCESS_TOKEN"]
         except KeyError as e:
-            raise Exception("Environment variable '%s' not set" % (e.message,))
-        return get_driver(Provider.DIGITAL_OCEAN)(token, api_version="v2")
+            raise Exception("Environment variable '%s' not set" % (e.args[0],))
+        cls = compute_providers.get_driver(
+            compute_types.Provider.DIGITAL_OCEAN)
+        return cls(token, api_version="v2")
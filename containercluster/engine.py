@@ -0,0 +1,271 @@
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from containercluster import trace, utils
+
+
+__all__ = [
+    "Engine",
+    "NotReady",
+    "Waiting",
+    "poll",
+    "wait_for",
+]
+
+
+LOG = logging.getLogger(__name__)
+
+
+class NotReady(Exception):
+    """Raised by a step to be run again after ``delay`` seconds.
+
+    """
+
+    def __init__(self, delay):
+        super(NotReady, self).__init__(delay)
+        self.delay = delay
+
+
+class Waiting(Exception):
+    """Raised by a step to be run again once some event has happened.
+
+    ``subscribe`` is called with a function of no arguments, which must be
+    called, from any thread, when the step may run again.
+
+    """
+
+    def __init__(self, subscribe):
+        super(Waiting, self).__init__(subscribe)
+        self.subscribe = subscribe
+
+
+def poll(check, description, interval=1.0, max_interval=10.0, timeout=None):
+    """Return a step which waits until ``check(value)`` is true.
+
+    The step is re-scheduled by the engine with growing intervals, up to
+    ``max_interval`` seconds, so no thread is blocked while waiting. The step
+    returns its input value unchanged.
+
+    """
+    state = {}
+
+    def step(value):
+        now = time.time()
+        start = state.setdefault("start", now)
+        if check(value):
+            LOG.debug("%s ready after %g s", description, now - start)
+            return value
+        if timeout is not None and now - start > timeout:
+            raise Exception("Timeout waiting for %s" % (description,))
+        delay = state.get("delay", interval)
+        state["delay"] = min(delay * 1.5, max_interval)
+        raise NotReady(delay)
+
+    step.__name__ = "poll(%s)" % (description,)
+    return step
+
+
+def wait_for(watch, description):
+    """Return a step which waits for a :class:`utils.WaitTarget`.
+
+    The target is obtained by calling ``watch(value)`` the first time the
+    step runs, and the step runs again as soon as the target is done, without
+    blocking a thread meanwhile. The step returns its input value unchanged.
+
+    """
+    targets = []
+
+    def step(value):
+        if not targets:
+            target = watch(value)
+            span = trace.begin("wait_for", description=description,
+                               node=getattr(value, "name", None))
+            target.add_callback(lambda t: span.end(result=t.result))
+            targets.append(target)
+        target = targets[0]
+        if not target.done:
+            raise Waiting(lambda ready: target.add_callback(
+                lambda _: ready()))
+        if not target.result:
+            raise Exception("Timeout waiting for %s" % (description,))
+        return value
+
+    step.__name__ = "wait_for(%s)" % (description,)
+    return step
+
+
+def step_name(step):
+    return getattr(step, "__name__", None) or repr(step)
+
+
+class Engine(object):
+    """Runs per-node pipelines of steps from a single scheduler thread.
+
+    A pipeline is a pair ``(value, steps)``. Every step is called with the
+    result of the previous one (the first step gets ``value``), and the
+    result of the last step is the result of the pipeline. Steps run on the
+    worker threads of ``pool``, one at a time per pipeline, so all pipelines
+    progress independently of each other. A step raising :class:`NotReady`
+    is run again later from a timer instead of blocking a worker thread, and
+    one raising :class:`Waiting` is run again once its event has happened.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def run(self, pipelines, fail_fast=True):
+        """Run ``pipelines`` and return their results in submission order.
+
+        Errors are reported as in :meth:`utils.Pool.run`: with ``fail_fast``,
+        no further steps are started once a step has failed.
+
+        """
+        pipelines = [(value, list(steps)) for value, steps in pipelines]
+        if self.pool.in_worker:
+            return self._run_inline(pipelines, fail_fast)
+        return _Run(self.pool, pipelines, fail_fast).wait()
+
+    def _run_inline(self, pipelines, fail_fast):
+        # Called from a worker of our own pool: scheduling steps on the pool
+        # and waiting for them could deadlock, so run them right here.
+        results = []
+        errors = []
+        tasks = []
+        for value, steps in pipelines:
+            if errors and fail_fast:
+                break
+            try:
+                for step in steps:
+                    while True:
+                        try:
+                            with trace.span(step_name(step),
+                                            node=getattr(value, "name",
+                                                         None)):
+                                value = step(value)
+                            break
+                        except NotReady as exc:
+                            time.sleep(exc.delay)
+                        except Waiting as exc:
+                            event = threading.Event()
+                            exc.subscribe(event.set)
+                            event.wait()
+                results.append(value)
+            except:
+                self.log.debug("Caught error in %s", steps, exc_info=True)
+                errors.append(sys.exc_info()[1])
+                tasks.append((value, steps))
+        if errors:
+            raise utils.MultipleError(*errors, tasks=tasks,
+                                      cancelled=len(pipelines) - len(results) -
+                                      len(errors))
+        return results
+
+
+class _Run(object):
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, pool, pipelines, fail_fast):
+        self.pool = pool
+        self.pipelines = pipelines
+        self.fail_fast = fail_fast
+        self.values = [value for value, _ in pipelines]
+        self.positions = [0] * len(pipelines)
+        self.errors = {}
+        self.cancelled = 0
+        self.running = 0
+        self.waiting = set()
+        self.events = queue.Queue()
+        self.timers = []
+        self.timer_seq = itertools.count()
+
+    def wait(self):
+        for i in range(len(self.pipelines)):
+            self._advance(i)
+        while self.running or self.timers or self._waiting_for_events():
+            timeout = None
+            if self.timers:
+                timeout = max(self.timers[0][0] - time.time(), 0)
+            try:
+                i, status, payload = self.events.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                if status == "ready":
+                    if i in self.waiting:
+                        self.waiting.remove(i)
+                        self._advance(i)
+                else:
+                    self.running -= 1
+                    self._handle(i, status, payload)
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, i = heapq.heappop(self.timers)
+                self._advance(i)
+
+        if self.errors:
+            self.cancelled += len(self.waiting)
+            indices = sorted(self.errors)
+            raise utils.MultipleError(*[self.errors[i] for i in indices],
+                                      tasks=[self.pipelines[i]
+                                             for i in indices],
+                                      cancelled=self.cancelled)
+        return self.values
+
+    def _waiting_for_events(self):
+        # Pipelines waiting for events are cancelled, rather than waited
+        # for, once a step has failed.
+        return self.waiting and not (self.fail_fast and self.errors)
+
+    def _handle(self, i, status, payload):
+        if status == "done":
+            self.values[i] = payload
+            self.positions[i] += 1
+            self._advance(i)
+        elif status == "not-ready":
+            heapq.heappush(self.timers,
+                           (time.time() + payload, next(self.timer_seq), i))
+        elif status == "waiting":
+            self.waiting.add(i)
+        else:
+            self.errors[i] = payload
+
+    def _advance(self, i):
+        _, steps = self.pipelines[i]
+        if self.positions[i] == len(steps):
+            return
+        if self.fail_fast and self.errors:
+            self.cancelled += 1
+            return
+        self.running += 1
+        self.pool.submit(self._execute, i, steps[self.positions[i]],
+                         self.values[i])
+
+    def _execute(self, i, step, value):
+        try:
+            with trace.span(step_name(step),
+                            node=getattr(value, "name", None)):
+                result = step(value)
+        except NotReady as exc:
+            self.events.put((i, "not-ready", exc.delay))
+        except Waiting as exc:
+            self.events.put((i, "waiting", None))
+            exc.subscribe(lambda: self.events.put((i, "ready", None)))
+        except:
+            self.log.debug("Caught error in %s(%s)", step, value,
+                           exc_info=True)
+            self.events.put((i, "error", sys.exc_info()[1]))
+        else:
+            self.events.put((i, "done", result))
@@ -0,0 +1,245 @@
+import bisect
+import contextlib
+import logging
+import os
+import threading
+import time
+
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "Registry",
+    "counter",
+    "gauge",
+    "histogram",
+    "write_textfile",
+]
+
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the default histogram buckets. They go from
+# single API calls to whole cluster operations.
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+
+class Metric(object):
+
+    type_name = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("Metric %s has labels %s, not %s" %
+                             (self.name, ", ".join(self.labels),
+                              ", ".join(sorted(labels))))
+        return tuple(str(labels[k]) for k in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % (",".join('%s="%s"' % (k, _escape(v))
+                                  for k, v in pairs),)
+
+    def exposition(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.type_name),
+        ]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._samples(items))
+        return lines
+
+
+class Counter(Metric):
+    """A count which only goes up, such as a number of calls.
+
+    """
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self, items):
+        return ["%s%s %s" % (self.name, self._label_text(key),
+                             _format(value))
+                for key, value in items]
+
+
+class Gauge(Metric):
+    """A value which goes up and down, such as a remaining quota.
+
+    """
+
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def _samples(self, items):
+        return ["%s%s %s" % (self.name, self._label_text(key),
+                             _format(value))
+                for key, value in items]
+
+
+class Histogram(Metric):
+    """Distribution of observed values, such as durations, in buckets.
+
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key,
+                                             ([0] * (len(self.buckets) + 1),
+                                              0.0))
+            counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Context manager observing the time spent in its block.
+
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def _samples(self, items):
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append("%s_bucket%s %d" % (
+                    self.name,
+                    self._label_text(key, [("le", _format(bound))]),
+                    cumulative))
+            lines.append("%s_sum%s %s" % (self.name, self._label_text(key),
+                                          _format(total)))
+            lines.append("%s_count%s %d" % (self.name, self._label_text(key),
+                                            cumulative))
+        return lines
+
+
+class Registry(object):
+    """Metrics of the process, by name.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def get(self, cls, name, help, labels=(), **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels,
+                                                   **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric %s is a %s" %
+                                 (name, metric.type_name))
+            return metric
+
+    def exposition(self):
+        """Return the metrics in the Prometheus text exposition format.
+
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines.extend(metric.exposition())
+        return "".join("%s\n" % (line,) for line in lines)
+
+    def write_textfile(self, path):
+        """Write the metrics to ``path``, for the textfile collector of the
+        Prometheus node exporter.
+
+        The file is replaced atomically, so that the collector never reads
+        a partial file.
+
+        """
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wt") as f:
+            f.write(self.exposition())
+        os.rename(tmp_path, path)
+        LOG.debug("Wrote metrics to %s", path)
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    """Return the counter ``name`` of the process, creating it if needed.
+
+    """
+    return REGISTRY.get(Counter, name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    """Return the gauge ``name`` of the process, creating it if needed.
+
+    """
+    return REGISTRY.get(Gauge, name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    """Return the histogram ``name`` of the process, creating it if needed.
+
+    """
+    return REGISTRY.get(Histogram, name, help, labels, buckets=buckets)
+
+
+def write_textfile(path):
+    REGISTRY.write_textfile(path)
+
+
+def _escape(value):
+    return (value.replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
@@ -1,11 +1,17 @@
 import logging
+import os
+import subprocess
 import tempfile
+import threading
 
 from libcloud.compute.base import (KeyPair, Node, NodeImage, NodeLocation,
                                    NodeSize)
 from libcloud.compute.types import NodeState
 
 import mockssh
+import mockssh.server
+
+from mockssh.streaming import StreamTransfer
 
 from containercluster import providers
 
@@ -13,6 +19,47 @@ from containercluster import providers
 __all__ = []
 
 
+class MockSshHandler(mockssh.server.Handler):
+
+    def run(self):
+        # Same as the base class, but never replaces a command queue which
+        # check_channel_exec_request() may have already created.
+        self.transport.start_server(server=self)
+        while True:
+            channel = self.transport.accept()
+            if channel is None:
+                break
+            self.command_queues.setdefault(channel.chanid,
+                                           mockssh.server.Queue())
+            t = threading.Thread(target=self.handle_client, args=(channel,))
+            t.daemon = True
+            t.start()
+
+    def handle_client(self, channel):
+        # Same as the base class, but leaves closing the channel to the
+        # client. Fast commands could otherwise close it before the server
+        # has acknowledged the exec request, which clients report as an
+        # error. This is frequent when many sessions share a connection.
+        try:
+            command = self.command_queues[channel.chanid].get(block=True)
+            self.log.debug("Executing %s", command)
+            p = subprocess.Popen(command, shell=True,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            StreamTransfer(channel, p).run()
+            channel.send_exit_status(p.returncode)
+            channel.shutdown_write()
+        except Exception:
+            self.log.error("Error handling client (channel: %s)", channel,
+                           exc_info=True)
+
+
+class MockSshServer(mockssh.Server):
+
+    handler_cls = MockSshHandler
+
+
 class MockDriver(object):
 
     name = type = "mock"
@@ -55,9 +102,6 @@ class MockDriver(object):
         self._key_pairs[name] = k = KeyPair(name, "XXXX", "XXXX", self)
         return k
 
-    def wait_until_running(self, nodes, **kwargs):
-        return [(n, n.public_ips) for n in nodes]
-
 
 class MockProvider(providers.Provider):
 
@@ -75,9 +119,23 @@ class MockProvider(providers.Provider):
 
     def __init__(self):
         super(MockProvider, self).__init__()
-        self.ssh_server = mockssh.Server({})
+        self.ssh_server = MockSshServer({})
 
-    def provision_node(self, node, vars):
+    def ensure_nodes(self, specs, cluster, config, wait=True, pool=None):
+        nodes = super(MockProvider, self).ensure_nodes(specs, cluster, config,
+                                                       wait, pool)
+
+        # Patch node objects for provisioning
+        for node in nodes:
+            node.ssh_port = self.ssh_server.port
+            node.certs_dir = tempfile.mkdtemp()
+            node.sudo_cmd = ""
+            node.cloud_config_path = os.path.join(node.certs_dir, "user_data")
+            node.cloudinit_cmd = "test -s %s"
+
+        return nodes
+
+    def provision_node(self, node, wait=True):
         self.log.debug("MockProvider: Entering provision_node()")
         uid = node.ssh_uid
         private_key_path = node.config.ssh_key_pair.private_key_path
@@ -85,12 +143,7 @@ class MockProvider(providers.Provider):
                        private_key_path, uid)
         self.ssh_server.add_user(uid, private_key_path)
 
-        # Patch node object for provisioning
-        node.ssh_port = self.ssh_server.port
-        node.certs_dir = tempfile.mkdtemp()
-        node.sudo_cmd = ""
-
-        return super(MockProvider, self).provision_node(node, vars)
+        return super(MockProvider, self).provision_node(node, wait)
 
     def create_node(self, name, size, channel, location, ssh_key_id,
                     cloud_config_data):
@@ -1,12 +1,26 @@
+import contextlib
 import importlib
 import logging
+import random
 import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from containercluster import metrics, trace, utils
 
 
 __all__ = [
+    "DriverPool",
+    "MeteredDriver",
     "Provider",
+    "ReadinessPoller",
     "default_provider",
     "get_provider",
+    "get_provider_class",
     "provider_names",
 ]
 
@@ -20,11 +34,55 @@ def provider_names():
     return sorted(PROVIDERS.keys())
 
 
+DEFAULT_PROVIDER = "digitalocean"
+
+# Providers only import libcloud when they talk to their cloud.
+compute_types = utils.lazy_import("libcloud.compute.types")
+
+API_CALLS = metrics.counter(
+    "containercluster_provider_api_calls_total",
+    "Calls to the API of cloud providers.",
+    ("provider", "method"))
+
+API_ERRORS = metrics.counter(
+    "containercluster_provider_api_errors_total",
+    "Calls to the API of cloud providers which failed.",
+    ("provider", "method"))
+
+API_CALL_SECONDS = metrics.histogram(
+    "containercluster_provider_api_call_seconds",
+    "Duration of calls to the API of cloud providers.",
+    ("provider", "method"))
+
+API_RETRIES = metrics.counter(
+    "containercluster_provider_api_retries_total",
+    "Calls to the API of cloud providers which were retried.",
+    ("provider", "method", "reason"))
+
+API_THROTTLED_SECONDS = metrics.counter(
+    "containercluster_provider_api_throttled_seconds_total",
+    "Time spent waiting for the rate limit of cloud providers.",
+    ("provider",))
+
+API_QUOTA_REMAINING = metrics.gauge(
+    "containercluster_provider_api_quota_remaining",
+    "Requests left in the rate limit window of cloud providers.",
+    ("provider",))
+
+# Driver methods which may be retried after transient errors, as they do not
+# change anything.
+IDEMPOTENT_PREFIXES = ("list_", "get_", "ex_list_", "ex_get_")
+
+
 def default_provider():
-    return get_provider("digitalocean")
+    return get_provider(DEFAULT_PROVIDER)
 
 
 def get_provider(name):
+    return get_provider_class(name)()
+
+
+def get_provider_class(name):
     try:
         mod_name, class_name = PROVIDERS[name]
     except KeyError:
@@ -34,80 +92,222 @@ def get_provider(name):
     if cls is None:
         raise Exception("Invalid provider %s: Module %s has no attribute %s" %
                         (name, mod, class_name))
-    return cls()
+    return cls
 
 
 class Provider(object):
 
     create_key_pair_lock = threading.Lock()
 
+    inventory_ttl = 5.0
+
+    running_timeout = 600
+
+    # Requests per second, and bursts of requests, let through to the API.
+    # Providers set them to the limits of their API.
+    api_rate = 10.0
+
+    api_burst = 20
+
+    # Attempts at a call to the API, and the delay before the first retry,
+    # which doubles with every retry up to ``api_max_backoff`` seconds.
+    api_attempts = 5
+
+    api_backoff = 1.0
+
+    api_max_backoff = 60.0
+
+    # Drivers shared by all threads, unless given when creating providers.
+    driver_pool_size = 4
+
     log = logging.getLogger(__name__)
 
-    def __init__(self):
+    def __init__(self, driver_pool_size=None):
         self.sizes = {}
         self.images = {}
         self.locations = {}
+        self.connections_opened = 0
         self._node_objs = {}
+        self._inventory = None
+        self._inventory_time = 0
+        self._inventory_lock = threading.Lock()
+        self._connections_lock = threading.Lock()
+        self.rate_limiter = utils.TokenBucket(self.api_rate, self.api_burst)
+        # (remaining, limit, reset time) of the API rate limit, as last
+        # reported by the provider.
+        self.quota = None
+        if driver_pool_size is None:
+            driver_pool_size = self.driver_pool_size
+        self._driver_pool = DriverPool(self._new_driver, driver_pool_size)
+        self.readiness = ReadinessPoller(self)
+
+    def inventory(self, max_age=None):
+        """Return a dictionary of driver node objects, indexed by name.
+
+        All nodes are fetched with a single listing, which is shared by all
+        callers until it is older than ``max_age`` seconds (by default,
+        ``inventory_ttl``) or until :meth:`invalidate_inventory` is called.
+        The returned dictionary must not be modified.
+
+        """
+        if max_age is None:
+            max_age = self.inventory_ttl
+        with self._inventory_lock:
+            now = time.time()
+            if (self._inventory is None or
+                    now - self._inventory_time > max_age):
+                self.log.debug("Refreshing node inventory")
+                with trace.span("Provider.inventory"):
+                    nodes = self.driver.list_nodes()
+                self._inventory = dict((n.name, n) for n in nodes)
+                self._inventory_time = now
+            return self._inventory
+
+    def invalidate_inventory(self):
+        with self._inventory_lock:
+            self._inventory = None
+
+    def find_node(self, name, max_age=None):
+        """Return the driver node object named ``name``, or ``None``.
+
+        """
+        n = self.inventory(max_age).get(name)
+        if n is not None:
+            self.register_node(name, n)
+        return n
+
+    def ensure_node(self, name, node_class, size, cluster, config, wait=True):
+        with trace.span("Provider.ensure_node", node=name):
+            return self.ensure_nodes([(name, node_class, size)], cluster,
+                                     config, wait)[0]
 
-    def ensure_node(self, name, node_class, size, cluster, config):
+    def ensure_nodes(self, specs, cluster, config, wait=True, pool=None):
+        """Ensure the nodes described by ``specs`` exist.
+
+        ``specs`` is a sequence of tuples ``(name, node_class, size)``. Nodes
+        which do not exist yet are grouped by size and user data, and
+        every group is created with :meth:`create_nodes`. Returns the node
+        objects in the order of ``specs``.
+
+        """
+        with trace.span("Provider.ensure_nodes",
+                        nodes=", ".join(name for name, _, _ in specs)):
+            return self._ensure_nodes(specs, cluster, config, wait, pool)
+
+    def _ensure_nodes(self, specs, cluster, config, wait, pool):
         cluster_config = config.clusters[cluster.name]
         channel = cluster_config["channel"]
         location = cluster_config["location"]
-        self.log.debug("Creating node %s (%s, %s, %s, %s)", name, node_class,
-                       size, channel, location)
-        node = node_class(name, self, cluster, config)
 
-        for n in self.driver.list_nodes():
-            if n.name == name:
+        nodes = []
+        groups = {}
+        for name, node_class, size in specs:
+            self.log.debug("Creating node %s (%s, %s, %s, %s)", name,
+                           node_class, size, channel, location)
+            node = node_class(name, self, cluster, config)
+            nodes.append(node)
+            if self.find_node(name) is not None:
                 self.log.debug("Node '%s' already created", name)
-                self.register_node(name, n)
-                break
-        else:
-            channels = {"stable", "beta", "alpha"}
-            if channel not in channels:
-                raise ValueError("Unsupported CoreOS chanel '%s'."
-                                 "Valid values: %s" %
-                                 (channel, sorted(channels)))
-
-            public_ssh_key = self.get_public_ssh_key(config.ssh_key_pair)
-            n = self.create_node(name, size, channel, location,
-                                 public_ssh_key.fingerprint,
-                                 node.cloud_config_data)
-            self.register_node(name, n)
-            self.wait_until_running(n)
+                continue
+            key = (size, node.user_data)
+            groups.setdefault(key, []).append(name)
+
+        if not groups:
+            return nodes
 
-        return node
+        channels = {"stable", "beta", "alpha"}
+        if channel not in channels:
+            raise ValueError("Unsupported CoreOS chanel '%s'."
+                             "Valid values: %s" %
+                             (channel, sorted(channels)))
+
+        public_ssh_key = self.get_public_ssh_key(config.ssh_key_pair)
+        created = []
+        try:
+            for (size, cloud_config_data), names in sorted(groups.items()):
+                self.log.debug("Creating %d node(s) of size %s: %s",
+                               len(names), size, ", ".join(names))
+                with trace.span("Provider.create_nodes",
+                                nodes=", ".join(names), size=size):
+                    created.extend(self.create_nodes(
+                        names, size, channel, location,
+                        public_ssh_key.fingerprint, cloud_config_data, pool))
+        finally:
+            self.invalidate_inventory()
+        for n in created:
+            self.register_node(n.name, n)
+        if wait:
+            self.wait_until_running(*created)
+
+        return nodes
+
+    def create_nodes(self, names, size, channel, location, ssh_key_id,
+                     cloud_config_data, pool=None):
+        """Create nodes which only differ in their names.
+
+        Providers which may create several nodes with one API call override
+        this method. By default, nodes are created in parallel with
+        :meth:`create_node`, using ``pool`` if given.
+
+        """
+        return utils.parallel(((self.create_node, name, size, channel,
+                                location, ssh_key_id, cloud_config_data)
+                               for name in names), pool)
 
     def destroy_node(self, node):
         n = self._node_objs[node.name]
         self.log.debug("Destroying node '%s'", node.name)
         try:
-            n.destroy()
+            self.driver.destroy_node(n)
         except:
             self.log.warn("Cannot destroy node %s", node.name, exc_info=True)
+        self.invalidate_inventory()
         del self._node_objs[node.name]
 
     def register_node(self, name, node_driver_obj):
         self._node_objs[name] = node_driver_obj
 
-    def provision_node(self, node):
-        return node.provision()
+    def provision_node(self, node, wait=True):
+        return node.provision(wait)
 
     def reboot_node(self, node):
         self.log.debug("Rebooting node '%s'", node.name)
-        self._node_objs[node.name].reboot()
+        self.driver.reboot_node(self._node_objs[node.name])
 
     def list_nodes(self):
-        return self.driver.list_nodes()
+        return list(self.inventory().values())
 
     def wait_until_running(self, *nodes):
-        res = self.driver.wait_until_running(self._node_objs[n.name]
-                                             for n in nodes)
-        for node, _ in res:
-            self._node_objs[node.name] = node
+        """Wait until all ``nodes`` are running and have public addresses.
+
+        """
+        targets = [self.readiness.watch(n.name, self.running_timeout)
+                   for n in nodes]
+        with trace.span("Provider.wait_until_running",
+                        nodes=", ".join(n.name for n in nodes)):
+            for target in targets:
+                if not target.wait():
+                    raise Exception("Timeout waiting for node '%s' running" %
+                                    (target.name,))
+
+    def is_running(self, node):
+        """Refresh ``node`` and tell whether it is running and reachable.
+
+        """
+        n = self.find_node(node.name)
+        if n is None:
+            raise Exception("Node '%s' does not exist" % (node.name,))
+        return (n.state == compute_types.NodeState.RUNNING and
+                bool(n.public_ips))
 
     def node_state(self, node):
-        return self._node_objs[node.name].state
+        n = self.find_node(node.name)
+        if n is None:
+            n = self._node_objs[node.name]
+        return n.state
+
+    def node_id(self, node):
+        return self._node_objs[node.name].id
 
     def node_public_ips(self, node):
         return self._node_objs[node.name].public_ips
@@ -162,7 +362,159 @@ class Provider(object):
 
     @property
     def driver(self):
-        raise NotImplementedError("driver")
+        """The libcloud driver of the provider.
+
+        Drivers, and their keep-alive HTTP connections, are not safe to use
+        from several threads at once: this is a :class:`DriverPool` of at
+        most ``driver_pool_size`` drivers, which live as long as the
+        provider and are shared by all threads.
+
+        """
+        return self._driver_pool
+
+    @contextlib.contextmanager
+    def checkout_driver(self):
+        """Context manager giving exclusive use of a driver.
+
+        Needed for multi-step operations on a driver, like direct requests
+        on its connection, which cannot go through a :class:`DriverPool`.
+
+        """
+        with self._driver_pool.checkout() as driver:
+            yield driver
+
+    def make_driver(self):
+        raise NotImplementedError("make_driver")
+
+    @contextlib.contextmanager
+    def api_call(self, method):
+        """Context manager around a call to the provider API.
+
+        Method calls on drivers returned by :attr:`driver` go through here.
+        Direct requests on their connections must use it too, so that every
+        call is counted and timed.
+
+        """
+        API_CALLS.inc(provider=self.name, method=method)
+        start = time.time()
+        try:
+            with trace.span("Provider.api_call", method=method):
+                yield
+        except Exception as e:
+            API_ERRORS.inc(provider=self.name, method=method)
+            headers = getattr(e, "headers", None)
+            if headers:
+                self.observe_rate_limit(headers)
+            raise
+        finally:
+            API_CALL_SECONDS.observe(time.time() - start,
+                                     provider=self.name, method=method)
+
+    def call_api(self, method, func, *args, **kwargs):
+        """Call ``func`` through :meth:`api_call`, retrying on failure.
+
+        Calls rejected by the rate limit of the API are retried once it
+        allows them, and calls of idempotent methods failing with transient
+        errors are retried after a jittered exponential backoff, up to
+        ``api_attempts`` times in all.
+
+        """
+        attempt = 1
+        while True:
+            try:
+                with self.api_call(method):
+                    return func(*args, **kwargs)
+            except Exception as e:
+                delay, reason = self.retry_delay(method, e, attempt)
+                if delay is None or attempt >= self.api_attempts:
+                    raise
+            self.log.warn("Call %s failed (%s), retrying in %.1f s",
+                          method, reason, delay)
+            API_RETRIES.inc(provider=self.name, method=method, reason=reason)
+            if reason == "rate_limit":
+                # Hold back the calls of all threads, not just this one.
+                self.rate_limiter.hold(time.time() + delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def retry_delay(self, method, error, attempt):
+        """Return the delay before retrying a call of ``method`` which failed
+        with ``error``, and the reason for retrying it, or ``(None, None)``
+        if it must not be retried.
+
+        """
+        backoff = min(self.api_backoff * 2 ** (attempt - 1),
+                      self.api_max_backoff)
+        backoff *= random.uniform(0.5, 1.0)
+        code = getattr(error, "code", None)
+        if code == 429:
+            # Rejected calls had no effect, so all of them can be retried.
+            retry_after = getattr(error, "retry_after", None) or 0
+            return max(retry_after, backoff), "rate_limit"
+        if not method.startswith(IDEMPOTENT_PREFIXES):
+            return None, None
+        if isinstance(code, int) and code >= 500:
+            return backoff, "server_error"
+        if code is None and isinstance(error, IOError):
+            return backoff, "connection_error"
+        return None, None
+
+    def observe_rate_limit(self, headers):
+        """Update the rate limiter and :attr:`quota` from the rate limit
+        headers of an API response, if any.
+
+        """
+        headers = dict((k.lower(), v) for k, v in headers.items())
+
+        def header(name):
+            value = headers.get(name, headers.get("x-" + name))
+            try:
+                return int(float(value))
+            except (TypeError, ValueError):
+                return None
+
+        remaining = header("ratelimit-remaining")
+        if remaining is None:
+            return
+        limit = header("ratelimit-limit")
+        reset = header("ratelimit-reset")
+        self.quota = (remaining, limit, reset)
+        API_QUOTA_REMAINING.set(remaining, provider=self.name)
+        self.rate_limiter.limit(remaining)
+        if remaining <= 0:
+            until = reset if reset is not None else time.time() + 60
+            self.log.warn("API quota of %s used up until %s", self.name,
+                          time.ctime(until))
+            self.rate_limiter.hold(until)
+        elif limit and remaining < limit // 10:
+            self.log.debug("%d of %d API calls left", remaining, limit)
+
+    def _new_driver(self):
+        driver = self.make_driver()
+        connection = driver.connection
+        connect = connection.connect
+        request = connection.request
+
+        def counting_connect(*args, **kwargs):
+            with self._connections_lock:
+                self.connections_opened += 1
+            return connect(*args, **kwargs)
+
+        def limited_request(*args, **kwargs):
+            # Every HTTP request counts against the rate limit, including
+            # those of paginated listings.
+            waited = self.rate_limiter.acquire()
+            if waited:
+                API_THROTTLED_SECONDS.inc(waited, provider=self.name)
+            response = request(*args, **kwargs)
+            headers = getattr(response, "headers", None)
+            if headers:
+                self.observe_rate_limit(headers)
+            return response
+
+        connection.connect = counting_connect
+        connection.request = limited_request
+        return MeteredDriver(driver, self)
 
     def create_node(self, name, size, channel, location, ssh_key_id,
                     cloud_config_data):
@@ -170,3 +522,175 @@ class Provider(object):
 
     def get_image(self, channel):
         raise NotImplementedError("get_image")
+
+
+class MeteredDriver(object):
+    """Wraps a libcloud driver, so that calls to its public methods go
+    through :meth:`Provider.call_api`.
+
+    """
+
+    def __init__(self, driver, provider):
+        self.driver = driver
+        self.provider = provider
+
+    def __getattr__(self, name):
+        attr = getattr(self.driver, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.provider.call_api(name, attr, *args, **kwargs)
+
+        return call
+
+
+class DriverPool(object):
+    """Pool of driver objects shared by several threads.
+
+    Every method call made through the pool checks out an idle driver for the
+    duration of the call, creating new ones with ``factory`` until there are
+    ``size`` of them.
+
+    """
+
+    def __init__(self, factory, size):
+        if size < 1:
+            raise ValueError("Invalid driver pool size: %r" % (size,))
+        self.factory = factory
+        self.size = size
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        with self.checkout() as driver:
+            attr = getattr(driver, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self.checkout() as driver:
+                return getattr(driver, name)(*args, **kwargs)
+
+        return call
+
+    @contextlib.contextmanager
+    def checkout(self):
+        driver = self._checkout()
+        try:
+            yield driver
+        finally:
+            self._checkin(driver)
+
+    def _checkout(self):
+        with self._lock:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                if self._created < self.size:
+                    self._created += 1
+                    return self.factory()
+        return self._idle.get()
+
+    def _checkin(self, driver):
+        self._idle.put(driver)
+
+
+class NodeTarget(utils.WaitTarget):
+    """A node watched by a :class:`ReadinessPoller`.
+
+    """
+
+    def __init__(self, name, deadline):
+        super(NodeTarget, self).__init__(deadline)
+        self.name = name
+
+    def __repr__(self):
+        return "NodeTarget(%r)" % (self.name,)
+
+
+class ReadinessPoller(object):
+    """Waits for nodes of a provider to be running.
+
+    Nodes are watched by a single background thread, which fetches the state
+    of all of them with one listing per tick while any is pending. Polling
+    is fast right after a node starts being watched, and slows down as its
+    wait grows longer, from ``min_interval`` up to ``max_interval`` seconds.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, provider, min_interval=1.0, max_interval=15.0):
+        self.provider = provider
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._pending = []
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def watch(self, name, timeout=None):
+        """Start watching the node ``name`` and return its
+        :class:`NodeTarget`.
+
+        The target expires after ``timeout`` seconds, if given.
+
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        target = NodeTarget(name, deadline)
+        with self._lock:
+            self._pending.append(target)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="readiness-poller")
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+        return target
+
+    def interval(self, pending, now):
+        # The youngest wait sets the pace: nodes which were just created may
+        # be up in seconds, while those taking long are not in a hurry.
+        age = now - max(t.start for t in pending)
+        return min(max(age / 4.0, self.min_interval), self.max_interval)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._pending = [t for t in self._pending if not t.done]
+                pending = list(self._pending)
+                if not pending:
+                    self._thread = None
+                    return
+                self._wakeup.clear()
+            self._poll(pending)
+            pending = [t for t in pending if not t.done]
+            if pending:
+                self._wakeup.wait(self.interval(pending, time.time()))
+
+    def _poll(self, pending):
+        try:
+            # Listings made less than a tick ago by other callers are good
+            # enough, so bursts of new watches cost a single listing.
+            inventory = self.provider.inventory(self.min_interval / 2)
+        except:
+            self.log.warn("Cannot list nodes", exc_info=True)
+            inventory = {}
+        now = time.time()
+        for target in pending:
+            n = inventory.get(target.name)
+            if (n is not None and
+                    n.state == compute_types.NodeState.RUNNING and
+                    n.public_ips):
+                self.provider.register_node(target.name, n)
+                self.log.debug("Node '%s' running after %g s", target.name,
+                               now - target.start)
+                target.resolve(True)
+            elif target.expired(now):
+                self.log.debug("Timeout waiting for node '%s' running",
+                               target.name)
+                target.resolve(False)
@@ -0,0 +1,145 @@
+import logging
+import os
+import re
+import threading
+
+
+__all__ = [
+    "Template",
+    "TemplateError",
+    "load_template",
+]
+
+
+TEMPLATES_DIR = os.path.dirname(__file__)
+
+LOG = logging.getLogger(__name__)
+
+
+class TemplateError(Exception):
+    pass
+
+
+# `%(key)s` placeholders and `%%` escapes are the only supported directives.
+_DIRECTIVE = re.compile(r"%(?:\((\w+)\)s|(%))?")
+
+
+class Template(object):
+    """A template using ``%(key)s`` placeholders, parsed once.
+
+    Rendering joins the literal parts of the template with the values of its
+    keys, without parsing the template again. :meth:`bind` fills in some of
+    the keys ahead of time, so that templates rendered many times with
+    mostly the same values only get the values which differ.
+
+    """
+
+    def __init__(self, name, literals, keys):
+        self.name = name
+        self._literals = literals
+        self._keys = keys
+        self.keys = frozenset(keys)
+
+    @classmethod
+    def parse(cls, name, text):
+        literals = []
+        keys = []
+        pending = []
+        pos = 0
+        for m in _DIRECTIVE.finditer(text):
+            pending.append(text[pos:m.start()])
+            pos = m.end()
+            if m.group(1) is not None:
+                literals.append("".join(pending))
+                keys.append(m.group(1))
+                pending = []
+            elif m.group(2) is not None:
+                pending.append("%")
+            else:
+                line = text.count("\n", 0, m.start()) + 1
+                raise TemplateError("%s, line %d: Unsupported directive %r" %
+                                    (name, line,
+                                     text[m.start():m.start() + 2]))
+        pending.append(text[pos:])
+        literals.append("".join(pending))
+        return cls(name, literals, keys)
+
+    @property
+    def text(self):
+        """The template, with keys bound by :meth:`bind` filled in.
+
+        """
+        parts = [self._literals[0].replace("%", "%%")]
+        for key, literal in zip(self._keys, self._literals[1:]):
+            parts.append("%%(%s)s" % (key,))
+            parts.append(literal.replace("%", "%%"))
+        return "".join(parts)
+
+    def check(self, keys):
+        """Raise :class:`TemplateError` unless the template uses exactly
+        ``keys``.
+
+        """
+        keys = frozenset(keys)
+        errors = []
+        missing = self.keys - keys
+        if missing:
+            errors.append("Missing values for %s" %
+                          (", ".join(sorted(missing)),))
+        unused = keys - self.keys
+        if unused:
+            errors.append("Unused values for %s" %
+                          (", ".join(sorted(unused)),))
+        if errors:
+            raise TemplateError("%s: %s" % (self.name, "; ".join(errors)))
+
+    def bind(self, values):
+        """Return a template with the keys in ``values`` filled in.
+
+        """
+        literals = [self._literals[0]]
+        keys = []
+        for key, literal in zip(self._keys, self._literals[1:]):
+            if key in values:
+                literals[-1] = "%s%s%s" % (literals[-1], values[key], literal)
+            else:
+                keys.append(key)
+                literals.append(literal)
+        return Template(self.name, literals, keys)
+
+    def render(self, values):
+        parts = [self._literals[0]]
+        for key, literal in zip(self._keys, self._literals[1:]):
+            parts.append("%s" % (values[key],))
+            parts.append(literal)
+        return "".join(parts)
+
+
+_templates = {}
+
+_templates_lock = threading.Lock()
+
+
+def load_template(name, keys):
+    """Return the cloud-config template ``name``, which must use exactly the
+    keys in ``keys``.
+
+    Templates are read, parsed and checked once per process.
+
+    """
+    keys = frozenset(keys)
+    with _templates_lock:
+        try:
+            return _templates[name, keys]
+        except KeyError:
+            pass
+        fname = os.path.join(TEMPLATES_DIR, "%s-cloud-config.yaml" % (name,))
+        if not os.access(fname, os.F_OK):
+            raise TemplateError("No cloud-config template for node type "
+                                "'%s'" % (name,))
+        LOG.debug("Loading template %s", fname)
+        with open(fname, "rt") as f:
+            template = Template.parse(os.path.basename(fname), f.read())
+        template.check(keys)
+        _templates[name, keys] = template
+        return template
@@ -0,0 +1,376 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+import yaml
+
+from containercluster import config
+
+
+__all__ = [
+    "SqliteStore",
+]
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clusters (
+    name TEXT PRIMARY KEY,
+    provider TEXT NOT NULL,
+    definition TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS nodes (
+    name TEXT PRIMARY KEY,
+    cluster TEXT NOT NULL REFERENCES clusters (name) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    size TEXT NOT NULL,
+    provider_id TEXT,
+    public_ips TEXT NOT NULL DEFAULT '[]',
+    private_ips TEXT NOT NULL DEFAULT '[]'
+);
+
+CREATE INDEX IF NOT EXISTS nodes_cluster ON nodes (cluster, position);
+
+CREATE TABLE IF NOT EXISTS certificates (
+    name TEXT PRIMARY KEY,
+    cluster TEXT,
+    cert TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    not_after TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS certificates_cluster ON certificates (cluster);
+
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cluster TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS operations_cluster ON operations (cluster, id);
+"""
+
+
+class SqliteStore(config.Store):
+    """Keeps cluster definitions, and more, in an SQLite database.
+
+    Besides definitions, the database has the provider IDs and addresses of
+    nodes, the certificates issued for them and the history of operations
+    on every cluster. Nodes are indexed by name, so that finding the cluster
+    of a node does not depend on the number of clusters. Definitions are
+    only parsed when used.
+
+    When the database is created, the definitions kept by the YAML store are
+    imported into it.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, config):
+        super(SqliteStore, self).__init__(config)
+        self.path = config.state_db_path
+        self._lock = threading.Lock()
+        self._fingerprints = {}
+        created = not os.access(self.path, os.F_OK)
+        self._db = sqlite3.connect(self.path, timeout=30,
+                                   check_same_thread=False)
+        with self._transaction() as c:
+            c.execute("PRAGMA foreign_keys = ON")
+            c.executescript(SCHEMA)
+        if created:
+            self._import_yaml_store()
+
+    def load(self):
+        return SqliteClusters(self)
+
+    def save(self, clusters, names):
+        with self._transaction() as c:
+            for name in names:
+                if name not in clusters:
+                    c.execute("DELETE FROM nodes WHERE cluster = ?", (name,))
+                    c.execute("DELETE FROM clusters WHERE name = ?", (name,))
+                    self.log.debug("Removed cluster %s from %s", name,
+                                   self.path)
+                    continue
+                self._update_cluster(c, name, clusters[name])
+                self.log.debug("Saved cluster %s to %s", name, self.path)
+        clusters.mark_saved(names)
+
+    def load_cluster(self, name):
+        with self._lock:
+            row = self._db.execute("SELECT definition FROM clusters "
+                                   "WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            nodes = self._db.execute("SELECT name, type, size FROM nodes "
+                                     "WHERE cluster = ? ORDER BY position",
+                                     (name,)).fetchall()
+        cluster = config.parse_cluster(yaml.load(row[0],
+                                                 Loader=config.SafeLoader))
+        cluster["nodes"] = [{"name": n, "type": t, "size": s}
+                            for n, t, s in nodes]
+        return cluster
+
+    def has_cluster(self, name):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM clusters WHERE name = ?",
+                                    (name,)).fetchone() is not None
+
+    def cluster_names(self):
+        with self._lock:
+            return [name for name, in
+                    self._db.execute("SELECT name FROM clusters "
+                                     "ORDER BY name")]
+
+    def node_cluster(self, clusters, node_name):
+        # Definitions added or removed since they were loaded come first.
+        pending = clusters.pending
+        name = super(SqliteStore, self).node_cluster(pending, node_name)
+        if name is not None:
+            return name
+        with self._lock:
+            row = self._db.execute("SELECT cluster FROM nodes WHERE name = ?",
+                                   (node_name,)).fetchone()
+        if row is None or row[0] in clusters.removed or row[0] in pending:
+            return None
+        return row[0]
+
+    def list_nodes(self, clusters):
+        pending = clusters.pending
+        nodes = super(SqliteStore, self).list_nodes(pending)
+        with self._lock:
+            rows = self._db.execute("SELECT name, cluster, type, size, "
+                                    "provider_id, public_ips, private_ips "
+                                    "FROM nodes "
+                                    "ORDER BY cluster, position").fetchall()
+        for name, cluster, type_, size, provider_id, public_ips, \
+                private_ips in rows:
+            if cluster in clusters.removed or cluster in pending:
+                continue
+            nodes.append({
+                "name": name,
+                "cluster": cluster,
+                "type": type_,
+                "size": size,
+                "provider_id": provider_id,
+                "public_ips": json.loads(public_ips),
+                "private_ips": json.loads(private_ips),
+            })
+        return sorted(nodes, key=lambda n: n["cluster"])
+
+    def record_node(self, node_name, provider_id, public_ips, private_ips):
+        with self._transaction() as c:
+            c.execute("UPDATE nodes SET provider_id = ?, public_ips = ?, "
+                      "private_ips = ? WHERE name = ?",
+                      (provider_id, json.dumps(list(public_ips)),
+                       json.dumps(list(private_ips)), node_name))
+
+    def record_env(self, clusters, cluster_name, env):
+        # Only the env is written: other changes to the definition stay
+        # pending until saved.
+        with self._transaction() as c:
+            row = c.execute("SELECT definition FROM clusters WHERE name = ?",
+                            (cluster_name,)).fetchone()
+            if row is not None:
+                definition = yaml.load(row[0], Loader=config.SafeLoader)
+                definition["env"] = env
+                c.execute("UPDATE clusters SET definition = ? "
+                          "WHERE name = ?",
+                          (yaml.dump(definition, Dumper=config.SafeDumper),
+                           cluster_name))
+        if row is None:
+            super(SqliteStore, self).record_env(clusters, cluster_name, env)
+        else:
+            clusters.set_env(cluster_name, env)
+
+    def record_certificate(self, name, entry):
+        if entry is None:
+            return
+        fingerprint = entry["fingerprint"]
+        with self._lock:
+            if self._fingerprints.get(name) == fingerprint:
+                return
+        with self._transaction() as c:
+            row = c.execute("SELECT fingerprint FROM certificates "
+                            "WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] == fingerprint:
+                self._fingerprints[name] = fingerprint
+                return
+            row = c.execute("SELECT cluster FROM nodes WHERE name = ?",
+                            (name,)).fetchone()
+            c.execute("INSERT OR REPLACE INTO certificates "
+                      "(name, cluster, cert, key, fingerprint, not_after) "
+                      "VALUES (?, ?, ?, ?, ?, ?)",
+                      (name, row[0] if row is not None else None,
+                       entry["cert"], entry["key"], fingerprint,
+                       entry["not_after"].isoformat()))
+            self._fingerprints[name] = fingerprint
+
+    def record_operation(self, cluster_name, operation, status, started,
+                         finished):
+        with self._transaction() as c:
+            c.execute("INSERT INTO operations "
+                      "(cluster, operation, status, started, finished) "
+                      "VALUES (?, ?, ?, ?, ?)",
+                      (cluster_name, operation, status, started, finished))
+
+    def operations(self, cluster_name):
+        """Return the history of operations on ``cluster_name``, oldest
+        first, as tuples ``(operation, status, started, finished)``.
+
+        """
+        with self._lock:
+            return self._db.execute("SELECT operation, status, started, "
+                                    "finished FROM operations "
+                                    "WHERE cluster = ? ORDER BY id",
+                                    (cluster_name,)).fetchall()
+
+    def _insert_cluster(self, c, name, cluster):
+        definition = config.dump_cluster(cluster)
+        nodes = definition.pop("nodes")
+        c.execute("INSERT INTO clusters (name, provider, definition) "
+                  "VALUES (?, ?, ?)",
+                  (name, definition["provider"],
+                   yaml.dump(definition, Dumper=config.SafeDumper)))
+        c.executemany("INSERT INTO nodes (name, cluster, position, type, "
+                      "size) VALUES (?, ?, ?, ?, ?)",
+                      [(n["name"], name, i, n["type"], n["size"])
+                       for i, n in enumerate(nodes)])
+
+    def _update_cluster(self, c, name, cluster):
+        # Rows of nodes still in the definition are updated in place, so
+        # that the provider IDs and addresses recorded for them are kept.
+        definition = config.dump_cluster(cluster)
+        nodes = definition.pop("nodes")
+        provider = definition["provider"]
+        definition = yaml.dump(definition, Dumper=config.SafeDumper)
+        c.execute("UPDATE clusters SET provider = ?, definition = ? "
+                  "WHERE name = ?", (provider, definition, name))
+        if c.execute("SELECT changes()").fetchone()[0] == 0:
+            c.execute("INSERT INTO clusters (name, provider, definition) "
+                      "VALUES (?, ?, ?)", (name, provider, definition))
+        names = set()
+        for i, n in enumerate(nodes):
+            names.add(n["name"])
+            c.execute("UPDATE nodes SET cluster = ?, position = ?, type = ?, "
+                      "size = ? WHERE name = ?",
+                      (name, i, n["type"], n["size"], n["name"]))
+            if c.execute("SELECT changes()").fetchone()[0] == 0:
+                c.execute("INSERT INTO nodes (name, cluster, position, "
+                          "type, size) VALUES (?, ?, ?, ?, ?)",
+                          (n["name"], name, i, n["type"], n["size"]))
+        for node_name, in c.execute("SELECT name FROM nodes "
+                                    "WHERE cluster = ?", (name,)).fetchall():
+            if node_name not in names:
+                c.execute("DELETE FROM nodes WHERE name = ?", (node_name,))
+
+    def _import_yaml_store(self):
+        clusters = config.YamlStore(self.config).load()
+        if not clusters:
+            return
+        self.log.info("Importing %d cluster definition(s) into %s",
+                      len(clusters), self.path)
+        with self._transaction() as c:
+            for name, cluster in sorted(clusters.items()):
+                self._insert_cluster(c, name, cluster)
+
+    def _transaction(self):
+        return _Transaction(self._db, self._lock)
+
+
+class _Transaction(object):
+
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self.db.__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            return self.db.__exit__(*exc_info)
+        finally:
+            self.lock.release()
+
+
+class SqliteClusters(MutableMapping):
+    """Cluster definitions of a :class:`SqliteStore`, loaded on first use.
+
+    Definitions set or deleted are kept in memory until they are saved.
+
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.removed = set()
+        self._loaded = {}
+        self._set = {}
+
+    @property
+    def pending(self):
+        """The definitions set since they were loaded.
+
+        """
+        return self._set
+
+    def mark_saved(self, names):
+        for name in names:
+            if name in self._set:
+                self._loaded[name] = self._set.pop(name)
+            self.removed.discard(name)
+
+    def set_env(self, name, env):
+        for d in (self._set, self._loaded):
+            if name in d:
+                d[name] = dict(d[name], env=env)
+
+    def __getitem__(self, name):
+        if name in self.removed:
+            raise KeyError(name)
+        for d in (self._set, self._loaded):
+            if name in d:
+                return d[name]
+        cluster = self.store.load_cluster(name)
+        if cluster is None:
+            raise KeyError(name)
+        self._loaded[name] = cluster
+        return cluster
+
+    def __setitem__(self, name, cluster):
+        self.removed.discard(name)
+        self._set[name] = cluster
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._set.pop(name, None)
+        self._loaded.pop(name, None)
+        self.removed.add(name)
+
+    def __contains__(self, name):
+        if name in self.removed:
+            return False
+        return (name in self._set or name in self._loaded or
+                self.store.has_cluster(name))
+
+    def __iter__(self):
+        names = set(self.store.cluster_names()) | set(self._set)
+        return iter(sorted(names - self.removed))
+
+    def __len__(self):
+        return len(list(iter(self)))
@@ -1,14 +1,20 @@
+import datetime
+import os
 import tempfile
+import threading
 
 import ipaddress
+import yaml
 
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 
-from pytest import fixture
+from pytest import fixture, raises
 
-from containercluster.ca import CA
+from containercluster import ca as ca_module
+from containercluster.ca import CA, KEY_ALGORITHMS, KeyPool
 
 
 @fixture(scope="function")
@@ -52,3 +58,203 @@ def test_cert_alt_names(ca):
     ext = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
     assert ext.get_values_for_type(x509.DNSName) == [u"www.example.com"]
     assert ext.get_values_for_type(x509.IPAddress) == [ipaddress.IPv4Address(u"1.2.3.4")]
+
+
+def test_key_pool():
+    pool = KeyPool(size=2, processes=1, key_algorithm="ecdsa-p256")
+    try:
+        keys = [pool.get() for _ in range(3)]
+    finally:
+        pool.close()
+    assert len(set(k.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo
+    ) for k in keys)) == 3
+
+
+def test_key_pool_spill():
+    spill_dir = tempfile.mkdtemp()
+    pool = KeyPool(size=2, processes=1, spill_dir=spill_dir, key_algorithm="ecdsa-p256")
+    pool.get()
+    pool.close(wait=True)
+    assert len(os.listdir(spill_dir)) == 1
+
+    pool = KeyPool(size=2, processes=1, spill_dir=spill_dir, key_algorithm="ecdsa-p256")
+    try:
+        pool.get()
+        assert not os.listdir(spill_dir)
+    finally:
+        pool.close()
+
+
+def test_key_pool_generates_on_demand():
+    pool = KeyPool(size=4, processes=1, key_algorithm="ecdsa-p256")
+    try:
+        pending = []
+        for _ in range(6):
+            pool.get()
+            pending.append(len(pool._pending))
+    finally:
+        pool.close()
+    assert pending == [1, 2, 3, 4, 4, 4]
+
+
+def test_key_pool_spilled_key_claimed_once(monkeypatch):
+    spill_dir = tempfile.mkdtemp()
+    pool = KeyPool(size=1, processes=1, spill_dir=spill_dir,
+                   key_algorithm="ecdsa-p256")
+    pool._spill(b"pem")
+    listing = os.listdir(spill_dir)
+    assert pool._unspill() == b"pem"
+    # Another process listed the key before it was claimed.
+    monkeypatch.setattr(os, "listdir", lambda dname: listing)
+    assert pool._unspill() is None
+
+
+class FakeResult(object):
+
+    def __init__(self, pem):
+        self.pem = pem
+
+    def ready(self):
+        return self.pem is not None
+
+    def get(self):
+        assert self.pem is not None, "Waited for a key at exit"
+        return self.pem
+
+
+def test_key_pool_close_spills_ready_keys():
+    spill_dir = tempfile.mkdtemp()
+    pool = KeyPool(size=1, processes=1, spill_dir=spill_dir,
+                   key_algorithm="ecdsa-p256")
+    pool.get()
+    pool._pending.clear()
+    pool._pending.extend([FakeResult(b"pem"), FakeResult(None)])
+    pool.close()
+    assert len(os.listdir(spill_dir)) == 1
+
+
+def test_ca_key_loaded_once(ca):
+    ca.generate_cert(u"one.example.com")
+    os.unlink(ca.key_path)
+    assert ca.generate_cert(u"two.example.com")
+    assert not os.access(ca.key_path, os.F_OK)
+
+
+def test_concurrent_generate_cert(ca):
+    paths = []
+
+    def generate(name):
+        paths.append(ca.generate_cert(name))
+
+    threads = [threading.Thread(target=generate, args=(u"host%d" % (i % 3),))
+               for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(paths)) == 3
+
+
+def test_key_algorithms(ca):
+    for algorithm in KEY_ALGORITHMS:
+        cert_path, key_path = ca.generate_cert(u"example.com",
+                                               [u"www.example.com"],
+                                               algorithm)
+        with open(cert_path, "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+        with open(key_path, "rb") as f:
+            key = serialization.load_pem_private_key(f.read(),
+                                                     password=None,
+                                                     backend=default_backend())
+        assert cert.issuer == ca.issuer
+        assert (cert.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo
+        ) == key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo
+        ))
+        usage = cert.extensions.get_extension_for_class(x509.KeyUsage).value
+        assert usage.key_encipherment == isinstance(key, rsa.RSAPrivateKey)
+
+
+def test_key_algorithm_file_names(ca):
+    rsa_paths = ca.generate_cert(u"example.com")
+    ec_paths = ca.generate_cert(u"example.com", key_algorithm="ecdsa-p256")
+    assert rsa_paths != ec_paths
+    assert os.path.basename(ec_paths[0]) == "example.com.ecdsa-p256.pem"
+
+
+def test_ca_key_algorithm():
+    ca = CA(tempfile.mkdtemp(), "ecdsa-p256")
+    with open(ca.key_path, "rb") as f:
+        key = serialization.load_pem_private_key(f.read(),
+                                                 password=None,
+                                                 backend=default_backend())
+    assert isinstance(key, ec.EllipticCurvePrivateKey)
+    assert ca.generate_cert(u"example.com")
+
+
+def test_invalid_key_algorithm(ca):
+    with raises(ValueError):
+        ca.generate_cert(u"example.com", key_algorithm="dsa-1024")
+
+
+def test_cert_index(ca):
+    cert_path, _ = ca.generate_cert(u"example.com",
+                                    [u"www.example.com", u"1.2.3.4"])
+    with open(ca.index_path, "rt") as f:
+        index = yaml.safe_load(f)
+    entry = index["example.com"]
+    assert entry["cert"] == os.path.basename(cert_path)
+    assert entry["alt_names"] == [u"1.2.3.4", u"www.example.com"]
+    assert entry["mtime"] == os.stat(cert_path).st_mtime
+    assert entry["not_after"] > datetime.datetime.utcnow()
+    assert len(entry["fingerprint"]) == 64
+
+
+def test_cert_not_reissued(ca):
+    cert_path, _ = ca.generate_cert(u"example.com",
+                                    [u"www.example.com", u"1.2.3.4"])
+    with open(cert_path, "rb") as f:
+        pem = f.read()
+    ca.generate_cert(u"example.com", [u"1.2.3.4", u"www.example.com"])
+    ca = CA(ca.ca_dir)
+    ca.generate_cert(u"example.com", [u"1.2.3.4", u"www.example.com"])
+    with open(cert_path, "rb") as f:
+        assert f.read() == pem
+
+
+def test_cert_reissued_on_alt_names_change(ca):
+    cert_path, key_path = ca.generate_cert(u"example.com", [u"1.2.3.4"])
+    with open(key_path, "rb") as f:
+        key_pem = f.read()
+    ca.generate_cert(u"example.com", [u"5.6.7.8"])
+    with open(cert_path, "rb") as f:
+        cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+    ext = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    assert ext.get_values_for_type(x509.IPAddress) == [ipaddress.IPv4Address(u"5.6.7.8")]
+    with open(key_path, "rb") as f:
+        assert f.read() == key_pem
+
+
+def test_cert_reissued_before_expiry(ca, monkeypatch):
+    cert_path, _ = ca.generate_cert(u"example.com")
+    with open(cert_path, "rb") as f:
+        pem = f.read()
+    later = datetime.datetime.utcnow() + ca_module.VALIDITY
+    monkeypatch.setattr(ca_module, "utcnow", lambda: later)
+    ca.generate_cert(u"example.com")
+    with open(cert_path, "rb") as f:
+        assert f.read() != pem
+
+
+def test_read_pem(ca):
+    cert_path, _ = ca.generate_cert(u"example.com")
+    with open(cert_path, "rt") as f:
+        pem = f.read()
+    assert ca.read_pem(cert_path) == pem
+    ca.generate_cert(u"example.com", [u"www.example.com"])
+    assert ca.read_pem(cert_path) != pem
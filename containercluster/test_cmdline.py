@@ -0,0 +1,26 @@
+import subprocess
+import sys
+
+import pytest
+
+
+HEAVY_MODULES = ("cryptography", "libcloud", "paramiko", "requests")
+
+
+def test_lazy_imports():
+    out = subprocess.check_output([
+        sys.executable, "-c",
+        "import sys\n"
+        "from containercluster import cmdline, core\n"
+        "print(' '.join(sorted(sys.modules)))"
+    ])
+    modules = set(m.split(".")[0] for m in out.decode("utf-8").split())
+    assert not modules & set(HEAVY_MODULES)
+
+
+@pytest.mark.parametrize("command", [[], ["create"], ["env"]])
+def test_help(command):
+    out = subprocess.check_output([sys.executable, "-m",
+                                   "containercluster.cmdline"] + command +
+                                  ["--help"])
+    assert out.decode("utf-8").startswith("usage: container-cluster")
@@ -1,8 +1,10 @@
 import os
 
 import ipaddress
+import pytest
 import yaml
 
+from containercluster import config as config_module
 from containercluster.config import Config
 
 
@@ -50,6 +52,122 @@ def test_save(config):
     new_config = Config(config.home)
     assert config.clusters == new_config.clusters
 
+    with open(config.cluster_path("test-cluster")) as f:
+        data = yaml.safe_load(f)
+    assert data["services_ip_range"] == "172.17.0.0/16"
+    assert data["dns_service_ip"] == "172.17.0.10"
+    assert data["kubernetes_service_ip"] == "172.17.0.1"
+
+
+def add_test_cluster(config):
+    config.add_cluster("test-cluster", "alpha", 3, "512mb", 4, "1gb",
+                       "digitalocean", "lon1",
+                       ipaddress.ip_network(u"172.16.0.0/16"), 24,
+                       ipaddress.ip_network(u"172.16.1.0"),
+                       ipaddress.ip_network(u"172.16.254.0"),
+                       ipaddress.ip_network(u"172.17.0.0/16"),
+                       ipaddress.ip_address(u"172.17.0.10"),
+                       ipaddress.ip_address(u"172.17.0.1"))
+
+
+def test_clusters_read_only(config):
+    add_test_cluster(config)
+    cluster = config.clusters["test-cluster"]
+    with pytest.raises(TypeError):
+        cluster["channel"] = "beta"
+    with pytest.raises(AttributeError):
+        cluster["nodes"].append({})
+    assert cluster["nodes"][0]["type"] == "etcd"
+
+
+def test_clusters_cache(config, monkeypatch):
+    add_test_cluster(config)
+    config.save()
+
+    loads = []
+    load = yaml.load
+    monkeypatch.setattr(yaml, "load",
+                        lambda *args, **kwargs: loads.append(args) or
+                        load(*args, **kwargs))
+    for _ in range(3):
+        assert "test-cluster" in Config(config.home).clusters
+    assert not loads
+
+    config.remove_cluster("test-cluster")
+    config.save()
+    assert "test-cluster" not in Config(config.home).clusters
+
+    # Changes made by other processes are seen too.
+    with open(config.cluster_path("other-cluster"), "wt") as f:
+        yaml.dump({"network": "10.0.0.0/8",
+                   "subnet_min": "10.0.1.0/24",
+                   "subnet_max": "10.0.254.0/24"}, f)
+    assert list(Config(config.home).clusters) == ["other-cluster"]
+    assert len(loads) == 1
+
+
+def test_save_one_cluster(config):
+    add_test_cluster(config)
+    config.save()
+    fname = config.cluster_path("test-cluster")
+    mtime = os.stat(fname).st_mtime
+
+    other_config = Config(config.home)
+    other_config.remove_cluster("other-cluster")
+    other_config.save()
+    assert os.stat(fname).st_mtime == mtime
+    assert sorted(os.listdir(config.clusters_dir)) == [".other-cluster.lock",
+                                                       ".test-cluster.lock",
+                                                       "test-cluster.yaml"]
+
+
+def test_migrate_clusters_yaml(config):
+    # Older versions saved addresses as Python objects.
+    cluster = {
+        "channel": "alpha",
+        "network": ipaddress.ip_network(u"172.16.0.0/16"),
+        "subnet_min": ipaddress.ip_network(u"172.16.1.0/24"),
+        "subnet_max": ipaddress.ip_network(u"172.16.254.0/24"),
+        "dns_service_ip": ipaddress.ip_address(u"172.17.0.10"),
+    }
+    with open(config.clusters_yaml_path, "wt") as f:
+        yaml.dump({"old-cluster": cluster}, f)
+    assert Config(config.home).clusters == {
+        "old-cluster": cluster
+    }
+
+    # The single file of older versions is split into one file per cluster.
+    assert not os.access(config.clusters_yaml_path, os.F_OK)
+    assert os.access(config.clusters_yaml_path + ".migrated", os.F_OK)
+    assert os.access(config.cluster_path("old-cluster"), os.F_OK)
+    assert Config(config.home).clusters == {
+        "old-cluster": cluster
+    }
+
+
+def test_migrate_legacy_clusters_yaml(legacy_config, monkeypatch):
+    cluster = Config(legacy_config.home).clusters["old-cluster"]
+    assert cluster["provider"] == "digitalocean"
+    assert cluster["dns_service_ip"] == ipaddress.ip_address(u"172.17.0.10")
+
+    with open(legacy_config.cluster_path("old-cluster")) as f:
+        data = yaml.safe_load(f)
+    assert data["provider"] == "digitalocean"
+    assert data["services_ip_range"] == "172.17.0.0/24"
+
+    # As in the next run, which reads the migrated file again.
+    monkeypatch.setattr(config_module, "_clusters_cache",
+                        config_module.ClustersCache())
+    assert Config(legacy_config.home).clusters["old-cluster"] == cluster
+
+
+def test_save_unsafe_values(config):
+    add_test_cluster(config)
+    cluster = dict(config.clusters["test-cluster"], bad=object())
+    with pytest.raises(yaml.YAMLError):
+        config_module._write_cluster(config.cluster_path("test-cluster"),
+                                     cluster)
+
 
 def test_node_tls_paths(config):
     cert_path, key_path = config.node_tls_paths(u"some-node-name",
@@ -63,9 +181,27 @@ def test_admin_tls_paths(config):
         assert os.stat(fname).st_size
 
 
+def test_cluster_key_algorithm(config):
+    config.add_cluster("test-cluster", "alpha", 3, "512mb", 4, "1gb",
+                       "digitalocean", "lon1",
+                       ipaddress.ip_network(u"172.16.0.0/16"), 24,
+                       ipaddress.ip_network(u"172.16.1.0/24"),
+                       ipaddress.ip_network(u"172.16.254.0"),
+                       ipaddress.ip_network(u"172.17.0.0/16"),
+                       ipaddress.ip_address(u"172.17.0.10"),
+                       ipaddress.ip_address(u"172.17.0.1"),
+                       key_algorithm="ecdsa-p256")
+    assert config.clusters["test-cluster"]["key_algorithm"] == "ecdsa-p256"
+    with open(config.kubeconfig_path("test-cluster", "1.2.3.4")) as f:
+        kubeconfig = yaml.safe_load(f)
+    cert_path, _ = config.admin_tls_paths("ecdsa-p256")
+    assert (kubeconfig["users"][0]["user"]["client-certificate"] ==
+            cert_path)
+
+
 def test_kubeconfig_structure(config):
     with open(config.kubeconfig_path("test-cluster", "1.2.3.4")) as f:
-        kubeconfig = yaml.load(f)
+        kubeconfig = yaml.safe_load(f)
 
     current_context = kubeconfig["current-context"]
 
@@ -88,3 +224,25 @@ def test_kubeconfig_structure(config):
             break
     else:
         raise AssertionError("Missing user '%s'" % (current_user,))
+
+
+def test_kubeconfig_written_once(config, monkeypatch):
+    writes = []
+    write_atomically = config_module._write_atomically
+
+    def record_write(fname, data):
+        writes.append(fname)
+        write_atomically(fname, data)
+
+    monkeypatch.setattr(config_module, "_write_atomically", record_write)
+    fname = config.kubeconfig_path("test-cluster", "1.2.3.4")
+    assert writes == [fname]
+    assert config.kubeconfig_path("test-cluster", "1.2.3.4") == fname
+    assert Config(config.home).kubeconfig_path("test-cluster",
+                                               "1.2.3.4") == fname
+    assert writes == [fname]
+    config.kubeconfig_path("test-cluster", "1.2.3.5")
+    assert writes == [fname, fname]
+    with open(fname) as f:
+        kubeconfig = yaml.safe_load(f)
+    assert kubeconfig["clusters"][0]["cluster"]["server"] == "https://1.2.3.5"
@@ -1,14 +1,19 @@
+import base64
+import gzip
+import io
 import json
 import os
 import platform
 import pwd
+import threading
 
 from itertools import chain
 
 import yaml
 
 
-from containercluster import core
+from containercluster import ca, core, trace, utils
+from containercluster.config import Config
 
 
 HOSTNAME = platform.node()
@@ -69,6 +74,30 @@ def test_env_variables(mock_cluster):
     assert env["ETCDCTL_ENDPOINT"].split(",")
 
 
+def test_recorded_env(mock_cluster):
+    name = mock_cluster.name
+    config = mock_cluster.config
+    assert config.clusters[name].get("env") is None
+    env = mock_cluster.record_env()
+    assert config.clusters[name]["env"] == env
+    assert Config(config.home).clusters[name]["env"] == env
+    # No provider needed for the recorded environment.
+    assert (core.cluster_env(name, None, config) ==
+            sorted(mock_cluster.env_variables))
+    assert (core.cluster_env(name, mock_cluster.provider, config,
+                             refresh=True) ==
+            sorted(mock_cluster.env_variables))
+
+
+def test_recorded_env_missing_files(mock_cluster):
+    env = mock_cluster.record_env()
+    os.unlink(env["admin_cert_path"])
+    assert core.recorded_env(mock_cluster.name, mock_cluster.config) is None
+    env_vars = dict(core.cluster_env(mock_cluster.name, mock_cluster.provider,
+                                     mock_cluster.config))
+    assert os.access(env_vars["ETCDCTL_CERT_FILE"], os.F_OK)
+
+
 def test_cloud_config_vars(mock_cluster):
     for node in mock_cluster.nodes:
         vars = node.cloud_config_vars
@@ -83,12 +112,215 @@ def test_cloud_config_vars(mock_cluster):
             assert "Backend" in network_config
 
 
+def test_cloud_config_template_reentrant(mock_cluster, monkeypatch):
+    etcd, worker = mock_cluster.nodes[0], mock_cluster.nodes[-1]
+    cloud_config_vars = mock_cluster.cloud_config_vars
+
+    def reentrant_vars(keys):
+        # As when getting the nodes of the cluster renders their templates.
+        monkeypatch.setattr(mock_cluster, "cloud_config_vars",
+                            cloud_config_vars)
+        etcd.cloud_config_data
+        return cloud_config_vars(keys)
+
+    mock_cluster._templates.clear()
+    monkeypatch.setattr(mock_cluster, "cloud_config_vars", reentrant_vars)
+    t = threading.Thread(target=lambda: worker.cloud_config_data)
+    t.daemon = True
+    t.start()
+    t.join(10)
+    assert not t.is_alive(), "Deadlock rendering templates"
+    assert worker.cloud_config_data.startswith("#cloud-config\n")
+
+
 def test_cloud_config_data(mock_cluster):
     for node in mock_cluster.nodes:
         assert node.cloud_config_data.startswith("#cloud-config\n")
-        cloud_config = yaml.load(node.cloud_config_data)
+        cloud_config = yaml.safe_load(node.cloud_config_data)
         assert "coreos" in cloud_config
 
 
+def test_compress_cloud_config(mock_cluster):
+    for node in mock_cluster.nodes:
+        data = core.compress_cloud_config(node.cloud_config_data,
+                                          node.cloud_config_path,
+                                          node.cloudinit_cmd)
+        assert data.startswith("#cloud-config\n")
+        cloud_config = yaml.safe_load(data)
+        f, = cloud_config["write_files"]
+        assert f["path"] == node.cloud_config_path
+        assert f["encoding"] == "gzip+base64"
+        content = gzip.GzipFile(fileobj=io.BytesIO(
+            base64.b64decode(f["content"]))).read()
+        assert content.decode("utf-8") == node.cloud_config_data
+        unit, = cloud_config["coreos"]["units"]
+        assert node.cloud_config_path in unit["content"]
+
+
+def test_user_data_sizes(mock_cluster):
+    sizes = core.user_data_sizes(mock_cluster.nodes)
+    assert [t for t, _, _ in sizes] == ["etcd", "master", "worker"]
+    for _, size, compressed in sizes:
+        assert compressed < size
+
+
+def test_compressed_user_data(mock_cluster, make_mock_cluster):
+    assert not mock_cluster.compress_user_data
+    cluster = make_mock_cluster(compress_user_data=True)
+    assert cluster.compress_user_data
+    for node in cluster.nodes:
+        if node.late_bound:
+            continue
+        user_data = yaml.safe_load(node.user_data)
+        f, = user_data["write_files"]
+        content = gzip.GzipFile(fileobj=io.BytesIO(
+            base64.b64decode(f["content"]))).read()
+        assert content.decode("utf-8") == node.cloud_config_data
+
+
+def test_user_data_sizes_logged_for_new_nodes(make_mock_cluster,
+                                              monkeypatch):
+    cluster = make_mock_cluster(compress_user_data=True)
+    logged = []
+    monkeypatch.setattr(core, "user_data_sizes",
+                        lambda nodes: logged.append(nodes) or [])
+    worker = cluster.nodes[-1]
+    cluster._nodes = []
+    cluster.nodes
+    assert logged[-1] == []
+
+    cluster.provider.driver.destroy_node(
+        cluster.provider.find_node(worker.name))
+    cluster.provider.invalidate_inventory()
+    cluster._nodes = []
+    cluster.nodes
+    assert [n.name for n in logged[-1]] == [worker.name]
+
+
 def test_master_ip(mock_cluster):
     assert mock_cluster.master_ip == "127.0.0.1"
+
+
+def test_provision_cluster(mock_cluster):
+    mock_cluster.provision_nodes()
+    for node in mock_cluster.nodes:
+        assert os.access(os.path.join(node.certs_dir, "node.pem"), os.F_OK)
+
+
+def test_provision_waits_once(mock_cluster, monkeypatch):
+    waits = []
+    monkeypatch.setattr(mock_cluster.provider, "wait_until_running",
+                        lambda *nodes: waits.append(nodes))
+    monkeypatch.setattr(utils, "wait_for_port_open",
+                        lambda *args, **kwargs: waits.append(args))
+    mock_cluster.provision_nodes()
+    # The engine steps waited for the nodes before provisioning them.
+    assert not waits
+
+
+def test_provision_ssh_connections(mock_cluster):
+    pool = utils.shared_ssh_pool()
+    opened = pool.connections_opened
+    mock_cluster.provision_nodes()
+    mock_cluster.provision_nodes()
+    # All mock nodes listen on the same address and port.
+    assert pool.connections_opened - opened == 1
+
+
+def test_node_listings(mock_cluster, monkeypatch):
+    driver = mock_cluster.provider.driver
+    calls = []
+
+    def list_nodes():
+        calls.append(None)
+        return driver._nodes.values()
+
+    monkeypatch.setattr(driver, "list_nodes", list_nodes)
+    mock_cluster.provider.invalidate_inventory()
+    assert len(mock_cluster.nodes) == 8
+    assert len(mock_cluster.exisiting_nodes) == 8
+    for node in mock_cluster.nodes:
+        node.state()
+    assert len(calls) <= 3
+
+
+def test_batch_node_creation(mock_cluster, monkeypatch):
+    provider = mock_cluster.provider
+    monkeypatch.setattr(provider.driver, "_nodes", {})
+    provider.invalidate_inventory()
+    batches = []
+    create_nodes = provider.create_nodes
+
+    def record_create_nodes(names, *args):
+        batches.append(sorted(names))
+        return create_nodes(names, *args)
+
+    monkeypatch.setattr(provider, "create_nodes", record_create_nodes)
+    assert len(mock_cluster.nodes) == 8
+    workers = sorted(n.name for n in mock_cluster.nodes
+                     if isinstance(n, core.WorkerNode))
+    assert workers in batches
+    assert len(batches) == 5
+
+
+def test_single_wave_creation(make_mock_cluster, monkeypatch):
+    cluster = make_mock_cluster(single_wave=True)
+    provider = cluster.provider
+    calls = []
+    ensure_nodes = provider.ensure_nodes
+
+    def record_ensure_nodes(specs, *args, **kwargs):
+        calls.append(specs)
+        return ensure_nodes(specs, *args, **kwargs)
+
+    monkeypatch.setattr(provider, "ensure_nodes", record_ensure_nodes)
+    assert len(cluster.nodes) == 8
+    assert len(calls) == 1
+    for node in cluster.nodes:
+        if isinstance(node, core.EtcdNode):
+            assert node.user_data == node.cloud_config_data
+        else:
+            assert node.user_data == core.BOOT_CLOUD_CONFIG
+    assert cluster.etcd_endpoint.count("https://") == 3
+    assert cluster.master_ip == "127.0.0.1"
+
+
+def test_single_wave_provisioning(make_mock_cluster):
+    cluster = make_mock_cluster(single_wave=True)
+    cluster.provision_nodes()
+    for node in cluster.nodes:
+        if node.late_bound:
+            with open(node.cloud_config_path, "rt") as f:
+                assert f.read() == node.cloud_config_data
+        else:
+            assert not os.access(node.cloud_config_path, os.F_OK)
+
+
+def test_trace_provisioning(mock_cluster):
+    tracer = trace.enable()
+    try:
+        mock_cluster.provision_nodes()
+    finally:
+        trace.disable()
+    names = set(e["name"] for e in tracer.events())
+    for name in ("Cluster.nodes", "Provider.ensure_nodes", "wait_for",
+                 "Node.provision", "Node.push_files", "CA.generate_cert",
+                 "CA.lock"):
+        assert name in names
+    provisioned = set(e["args"]["node"] for e in tracer.events()
+                      if e["name"] == "Node.provision")
+    assert provisioned == set(n.name for n in mock_cluster.nodes)
+
+
+def test_provisioning_metrics(mock_cluster):
+    connects = utils.SSH_CONNECTS.value()
+    uploaded = utils.SSH_BYTES_UPLOADED.value()
+    pushes = core.NODE_PHASE_SECONDS.count(phase="push_files")
+    mock_cluster.provision_nodes()
+    n_nodes = len(mock_cluster.nodes)
+    assert utils.SSH_CONNECTS.value() > connects
+    assert utils.SSH_BYTES_UPLOADED.value() > uploaded
+    assert core.NODE_PHASE_SECONDS.count(phase="push_files") == \
+        pushes + n_nodes
+    assert core.NODE_PHASE_SECONDS.count(phase="wait_for_ssh") >= n_nodes
+    assert ca.CERTS_ISSUED.value(key_algorithm="rsa-2048") >= n_nodes
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+from containercluster import engine, utils
+
+
+@pytest.yield_fixture(scope="function")
+def pool():
+    with utils.Pool(max_workers=2) as p:
+        yield p
+
+
+def test_pipeline_results_order(pool):
+    def add(n):
+        def step(value):
+            time.sleep(0.01 * n)
+            return value + n
+        return step
+
+    e = engine.Engine(pool)
+    assert e.run((i, [add(5 - i), add(1)]) for i in range(5)) == [6] * 5
+
+
+def test_not_ready_does_not_block_workers(pool):
+    polls = []
+    ready = threading.Event()
+
+    def check(value):
+        polls.append(value)
+        return ready.is_set()
+
+    def release(value):
+        ready.set()
+        return value
+
+    e = engine.Engine(pool)
+    waiters = [(i, [engine.poll(check, "ready", interval=0.01)])
+               for i in range(4)]
+    # Four pollers and a single releasing step share two worker threads.
+    results = e.run(waiters + [("release", [release])])
+    assert results == [0, 1, 2, 3, "release"]
+    assert polls
+
+
+def test_poll_timeout(pool):
+    e = engine.Engine(pool)
+    step = engine.poll(lambda value: False, "never", interval=0.01,
+                       timeout=0.05)
+    with pytest.raises(utils.MultipleError) as err:
+        e.run([(None, [step])])
+    assert [str(exc) for exc in err.value] == ["Timeout waiting for never"]
+
+
+def test_fail_fast(pool):
+    steps = []
+
+    def fail(value):
+        raise ValueError("failed")
+
+    def record(value):
+        steps.append(value)
+        return value
+
+    e = engine.Engine(pool)
+    with pytest.raises(utils.MultipleError) as err:
+        e.run([(0, [fail])] +
+              [(i, [engine.poll(lambda value: True, "slow", interval=0.01),
+                    record]) for i in range(1, 4)])
+    assert err.value.tasks[0][0] == 0
+    assert len(steps) + err.value.cancelled == 3
+
+
+def test_nested_run(pool):
+    e = engine.Engine(pool)
+
+    def inner(n):
+        return sum(e.run((i, [abs]) for i in range(n)))
+
+    assert e.run((n, [inner]) for n in range(4)) == [0, 0, 1, 3]
+
+
+def test_waiting(pool):
+    events = dict((i, threading.Event()) for i in range(3))
+    subscribers = []
+
+    def wait_for_event(i):
+        if not events[i].is_set():
+            raise engine.Waiting(subscribers.append)
+        return i
+
+    def release(value):
+        for event in events.values():
+            event.set()
+        for ready in subscribers:
+            ready()
+        return value
+
+    subscribed = engine.poll(lambda value: len(subscribers) == 3,
+                             "subscribers", interval=0.01)
+    e = engine.Engine(pool)
+    results = e.run([(i, [wait_for_event]) for i in range(3)] +
+                    [("release", [subscribed, release])])
+    assert results == [0, 1, 2, "release"]
+
+
+def test_waiting_cancelled(pool):
+    def wait_forever(value):
+        raise engine.Waiting(lambda ready: None)
+
+    def fail(value):
+        raise ValueError("failed")
+
+    e = engine.Engine(pool)
+    with pytest.raises(utils.MultipleError) as err:
+        e.run([(0, [wait_forever]), (1, [fail])])
+    assert err.value.cancelled == 1
@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+import pytest
+
+from containercluster import metrics
+
+
+def test_counter():
+    registry = metrics.Registry()
+    c = registry.get(metrics.Counter, "test_calls_total", "Calls.",
+                     ("method",))
+    c.inc(method="list_nodes")
+    c.inc(2, method="list_nodes")
+    c.inc(method="create_node")
+    assert c.value(method="list_nodes") == 3
+    assert registry.exposition() == (
+        "# HELP test_calls_total Calls.\n"
+        "# TYPE test_calls_total counter\n"
+        'test_calls_total{method="create_node"} 1.0\n'
+        'test_calls_total{method="list_nodes"} 3.0\n'
+    )
+    with pytest.raises(ValueError):
+        c.inc(provider="digitalocean")
+
+
+def test_histogram():
+    registry = metrics.Registry()
+    h = registry.get(metrics.Histogram, "test_seconds", "Durations.",
+                     buckets=(0.5, 1.0))
+    for value in (0.1, 0.5, 0.7, 3.0):
+        h.observe(value)
+    assert h.count() == 4
+    assert registry.exposition().splitlines()[2:] == [
+        'test_seconds_bucket{le="0.5"} 2',
+        'test_seconds_bucket{le="1.0"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        "test_seconds_sum 4.3",
+        "test_seconds_count 4",
+    ]
+
+
+def test_registry_types():
+    registry = metrics.Registry()
+    c = registry.get(metrics.Counter, "test_total", "Things.")
+    assert registry.get(metrics.Counter, "test_total", "Things.") is c
+    with pytest.raises(ValueError):
+        registry.get(metrics.Histogram, "test_total", "Things.")
+
+
+def test_label_escaping():
+    registry = metrics.Registry()
+    c = registry.get(metrics.Counter, "test_total", "Things.", ("name",))
+    c.inc(name='a "b"\\c\n')
+    assert registry.exposition().splitlines()[-1] == \
+        'test_total{name="a \\"b\\"\\\\c\\n"} 1.0'
+
+
+def test_write_textfile():
+    registry = metrics.Registry()
+    registry.get(metrics.Counter, "test_total", "Things.").inc()
+    dname = tempfile.mkdtemp()
+    path = os.path.join(dname, "container-cluster.prom")
+    registry.write_textfile(path)
+    with open(path, "rt") as f:
+        assert f.read() == registry.exposition()
+    assert os.listdir(dname) == ["container-cluster.prom"]
@@ -0,0 +1,252 @@
+import collections
+import threading
+import time
+
+import pytest
+
+from libcloud.compute.types import NodeState
+
+from containercluster import providers
+
+
+FakeResponse = collections.namedtuple("FakeResponse", "headers")
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.headers = {}
+
+    def connect(self):
+        pass
+
+    def request(self, path, **kwargs):
+        return FakeResponse(self.headers)
+
+
+class FakeDriver(object):
+
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.lock = threading.Lock()
+
+    def list_nodes(self):
+        self.connection.connect()
+        assert self.lock.acquire(False), "Driver used concurrently"
+        try:
+            time.sleep(0.01)
+            return []
+        finally:
+            self.lock.release()
+
+
+class FakeProvider(providers.Provider):
+
+    name = "fake"
+
+    def __init__(self, driver_pool_size=None):
+        super(FakeProvider, self).__init__(driver_pool_size)
+        self.drivers = []
+
+    def make_driver(self):
+        driver = FakeDriver()
+        self.drivers.append(driver)
+        return driver
+
+
+def run_threads(func, n):
+    threads = [threading.Thread(target=func) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_drivers_outlive_threads():
+    provider = FakeProvider(driver_pool_size=2)
+    provider.driver.list_nodes()
+    assert len(provider.drivers) == 1
+
+    # Drivers are kept when the threads which used them exit.
+    for _ in range(3):
+        run_threads(lambda: provider.driver.list_nodes(), 4)
+    assert len(provider.drivers) == 2
+
+
+def test_driver_pool():
+    provider = FakeProvider(driver_pool_size=2)
+    errors = []
+
+    def list_nodes():
+        try:
+            provider.driver.list_nodes()
+        except AssertionError as exc:
+            errors.append(exc)
+
+    run_threads(list_nodes, 8)
+    assert not errors
+    assert len(provider.drivers) == 2
+
+
+def test_connections_opened():
+    provider = FakeProvider()
+    for _ in range(3):
+        provider.driver.list_nodes()
+    assert provider.connections_opened == 3
+
+
+def test_api_call_metrics():
+    provider = FakeProvider()
+    calls = providers.API_CALLS.value(provider="fake", method="list_nodes")
+    for _ in range(3):
+        provider.driver.list_nodes()
+    assert providers.API_CALLS.value(provider="fake",
+                                     method="list_nodes") == calls + 3
+    errors = providers.API_ERRORS.value(provider="fake", method="boom")
+    with pytest.raises(KeyError):
+        with provider.api_call("boom"):
+            raise KeyError("boom")
+    assert providers.API_ERRORS.value(provider="fake",
+                                      method="boom") == errors + 1
+
+
+class FakeHTTPError(Exception):
+
+    def __init__(self, code, retry_after=None):
+        super(FakeHTTPError, self).__init__(code)
+        self.code = code
+        self.retry_after = retry_after
+        self.headers = {}
+
+
+def failing(errors):
+    calls = []
+
+    def call():
+        calls.append(time.time())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+
+    return call, calls
+
+
+def test_retry_rate_limited_calls():
+    provider = FakeProvider()
+    provider.api_backoff = 0.001
+    call, calls = failing([FakeHTTPError(429, retry_after=0.05)])
+    assert provider.call_api("create_node", call) == "ok"
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.05
+    assert providers.API_RETRIES.value(provider="fake", method="create_node",
+                                       reason="rate_limit") >= 1
+
+
+def test_retry_idempotent_calls_only():
+    provider = FakeProvider()
+    provider.api_backoff = 0.001
+    call, calls = failing([FakeHTTPError(503), IOError("reset")])
+    assert provider.call_api("list_nodes", call) == "ok"
+    assert len(calls) == 3
+
+    call, calls = failing([FakeHTTPError(503)])
+    with pytest.raises(FakeHTTPError):
+        provider.call_api("create_node", call)
+    assert len(calls) == 1
+
+    call, calls = failing([FakeHTTPError(404)])
+    with pytest.raises(FakeHTTPError):
+        provider.call_api("list_nodes", call)
+    assert len(calls) == 1
+
+
+def test_retry_attempts():
+    provider = FakeProvider()
+    provider.api_backoff = 0.001
+    call, calls = failing([FakeHTTPError(500)] * provider.api_attempts)
+    with pytest.raises(FakeHTTPError):
+        provider.call_api("list_nodes", call)
+    assert len(calls) == provider.api_attempts
+
+
+def test_rate_limit_headers():
+    provider = FakeProvider()
+    connection = provider.driver.connection
+    connection.headers = {
+        "RateLimit-Limit": "5000",
+        "RateLimit-Remaining": "0",
+        "RateLimit-Reset": "%d" % (time.time() + 2,),
+    }
+    connection.request("/v2/droplets")
+    assert provider.quota[:2] == (0, 5000)
+    assert providers.API_QUOTA_REMAINING.value(provider="fake") == 0
+    assert provider.rate_limiter.available == 0
+
+    connection.headers = {}
+    start = time.time()
+    connection.request("/v2/droplets")
+    assert time.time() - start >= 0.5
+
+
+FakeNode = collections.namedtuple("FakeNode", "name state public_ips")
+
+
+class BootingDriver(FakeDriver):
+
+    def __init__(self, names, listings_to_boot):
+        super(BootingDriver, self).__init__()
+        self.names = names
+        self.listings_to_boot = listings_to_boot
+        self.listings = 0
+
+    def list_nodes(self):
+        with self.lock:
+            self.listings += 1
+            if self.listings > self.listings_to_boot:
+                return [FakeNode(name, NodeState.RUNNING, ["10.0.0.1"])
+                        for name in self.names]
+            return [FakeNode(name, NodeState.PENDING, [])
+                    for name in self.names]
+
+
+class BootingProvider(providers.Provider):
+
+    name = "booting"
+
+    def __init__(self, names, listings_to_boot):
+        super(BootingProvider, self).__init__()
+        self.readiness.min_interval = 0.01
+        self.booting_driver = BootingDriver(names, listings_to_boot)
+
+    def make_driver(self):
+        return self.booting_driver
+
+
+def test_wait_until_running_shares_listings():
+    names = ["node%d" % (i,) for i in range(8)]
+    provider = BootingProvider(names, 3)
+    run_threads(lambda: provider.wait_until_running(
+        *[FakeNode(name, None, []) for name in names]), 8)
+    # Eight threads waiting for eight nodes each, but no more listings than
+    # if a single thread had waited for one node.
+    assert provider.booting_driver.listings <= 5
+    assert all(provider.node_public_ips(FakeNode(name, None, [])) ==
+               ["10.0.0.1"] for name in names)
+
+
+def test_readiness_timeout():
+    provider = BootingProvider(["node"], 1000)
+    target = provider.readiness.watch("node", timeout=0.05)
+    assert target.wait(5) is False
+
+
+def test_readiness_interval():
+    poller = providers.ReadinessPoller(None, min_interval=1.0,
+                                       max_interval=15.0)
+    now = time.time()
+    old = providers.NodeTarget("old", None)
+    old.start = now - 600
+    new = providers.NodeTarget("new", None)
+    new.start = now
+    assert poller.interval([old], now) == 15.0
+    assert poller.interval([old, new], now) == 1.0
@@ -0,0 +1,45 @@
+import pytest
+
+from containercluster import core, render
+
+
+TEXT = "#cloud-config\nname: %(name)s\nload: 50%%\nurl: %(url)s/%(name)s\n"
+
+VALUES = {"name": "node0", "url": "https://example.com"}
+
+
+def test_render():
+    template = render.Template.parse("test", TEXT)
+    assert template.keys == {"name", "url"}
+    assert template.render(VALUES) == TEXT % VALUES
+    assert template.text == TEXT
+
+
+def test_bind():
+    template = render.Template.parse("test", TEXT).bind({"url": "ftp://x"})
+    assert template.keys == {"name"}
+    assert (template.render({"name": "node1"}) ==
+            TEXT % {"name": "node1", "url": "ftp://x"})
+
+
+def test_check():
+    template = render.Template.parse("test", TEXT)
+    template.check(["name", "url"])
+    with pytest.raises(render.TemplateError) as err:
+        template.check(["name", "port"])
+    assert str(err.value) == ("test: Missing values for url; "
+                              "Unused values for port")
+
+
+def test_unsupported_directive():
+    with pytest.raises(render.TemplateError) as err:
+        render.Template.parse("test", "a: 1\nb: %d\n")
+    assert str(err.value) == "test, line 2: Unsupported directive '%d'"
+
+
+def test_node_templates():
+    for node_type, node_class in core.NODE_TYPES.items():
+        template = render.load_template(node_type,
+                                        node_class.cloud_config_keys)
+        assert render.load_template(node_type,
+                                    node_class.cloud_config_keys) is template
@@ -0,0 +1,148 @@
+import os
+
+import ipaddress
+
+from containercluster.config import Config
+
+
+def add_test_cluster(config, name="test-cluster"):
+    config.add_cluster(name, "alpha", 3, "512mb", 2, "1gb",
+                       "digitalocean", "lon1",
+                       ipaddress.ip_network(u"172.16.0.0/16"), 24,
+                       ipaddress.ip_network(u"172.16.1.0"),
+                       ipaddress.ip_network(u"172.16.254.0"),
+                       ipaddress.ip_network(u"172.17.0.0/16"),
+                       ipaddress.ip_address(u"172.17.0.10"),
+                       ipaddress.ip_address(u"172.17.0.1"))
+
+
+def test_save(config):
+    sqlite_config = Config(config.home, store="sqlite")
+    add_test_cluster(sqlite_config)
+    assert "test-cluster" in sqlite_config.clusters
+    sqlite_config.save()
+
+    new_config = Config(config.home, store="sqlite")
+    assert new_config.clusters == sqlite_config.clusters
+    assert list(new_config.clusters) == ["test-cluster"]
+    assert not os.listdir(config.clusters_dir)
+
+    new_config.remove_cluster("test-cluster")
+    assert "test-cluster" not in new_config.clusters
+    new_config.save()
+    assert not Config(config.home, store="sqlite").clusters
+
+
+def test_node_lookups(config):
+    sqlite_config = Config(config.home, store="sqlite")
+    for i in range(3):
+        add_test_cluster(sqlite_config, "cluster%d" % (i,))
+    sqlite_config.save()
+
+    new_config = Config(config.home, store="sqlite")
+    assert new_config.node_cluster("cluster1-worker1") == "cluster1"
+    assert new_config.node_cluster("cluster1-worker2") is None
+    nodes = new_config.list_nodes()
+    assert len(nodes) == 18
+    assert nodes[6]["name"] == "cluster1-etcd0"
+    assert nodes[6]["cluster"] == "cluster1"
+
+    new_config.remove_cluster("cluster1")
+    assert new_config.node_cluster("cluster1-worker1") is None
+    assert len(new_config.list_nodes()) == 12
+
+
+def test_import_yaml_store(config):
+    add_test_cluster(config)
+    config.save()
+    assert list(Config(config.home, store="sqlite").clusters) == [
+        "test-cluster"
+    ]
+
+
+def test_import_legacy_yaml_store(legacy_config):
+    conf = Config(legacy_config.home, store="sqlite")
+    cluster = conf.clusters["old-cluster"]
+    assert cluster["provider"] == "digitalocean"
+    assert cluster["dns_service_ip"] == ipaddress.ip_address(u"172.17.0.10")
+    assert conf.store._db.execute("SELECT provider FROM clusters").fetchall(
+    ) == [("digitalocean",)]
+    assert [n["name"] for n in conf.list_nodes()] == [
+        "old-cluster-etcd0", "old-cluster-master", "old-cluster-worker0",
+    ]
+
+
+def test_mock_cluster(make_mock_cluster):
+    cluster = make_mock_cluster(store="sqlite")
+    cluster.provision_nodes()
+
+    conf = Config(cluster.config.home, store="sqlite")
+    for node in conf.list_nodes():
+        assert node["cluster"] == cluster.name
+        assert node["provider_id"] == node["name"]
+        assert node["public_ips"] == ["127.0.0.1"]
+    assert [op for op, status, _, _ in
+            conf.store.operations(cluster.name)] == ["create"]
+    row = conf.store._db.execute(
+        "SELECT cluster, fingerprint FROM certificates WHERE name = ?",
+        ("%s-master" % (cluster.name,),)).fetchone()
+    assert row[0] == cluster.name
+
+
+def test_recorded_env(make_mock_cluster):
+    cluster = make_mock_cluster(store="sqlite")
+    cluster.provision_nodes()
+    env = cluster.record_env()
+    conf = Config(cluster.config.home, store="sqlite")
+    assert conf.clusters[cluster.name]["env"] == env
+    assert len(conf.clusters[cluster.name]["nodes"]) == 8
+    nodes = conf.list_nodes()
+    assert len(nodes) == 8
+    for node in nodes:
+        assert node["provider_id"] == node["name"]
+        assert node["public_ips"] == ["127.0.0.1"]
+
+
+def test_partial_save(config):
+    sqlite_config = Config(config.home, store="sqlite")
+    add_test_cluster(sqlite_config, "cluster0")
+    add_test_cluster(sqlite_config, "cluster1")
+    clusters = sqlite_config._load_clusters()
+    sqlite_config.store.save(clusters, ["cluster0"])
+    assert "cluster1" in clusters.pending
+    sqlite_config.save()
+    assert list(Config(config.home, store="sqlite").clusters) == [
+        "cluster0", "cluster1",
+    ]
+
+
+def test_save_keeps_node_records(config):
+    sqlite_config = Config(config.home, store="sqlite")
+    add_test_cluster(sqlite_config)
+    sqlite_config.save()
+    sqlite_config.store.record_node("test-cluster-worker0", "id0",
+                                    ["10.0.0.1"], ["192.168.0.1"])
+
+    clusters = sqlite_config._load_clusters()
+    cluster = dict(clusters["test-cluster"])
+    cluster["nodes"] = [n for n in cluster["nodes"]
+                        if n["name"] != "test-cluster-worker1"]
+    clusters["test-cluster"] = cluster
+    sqlite_config.store.save(clusters, ["test-cluster"])
+
+    nodes = dict((n["name"], n)
+                 for n in Config(config.home, store="sqlite").list_nodes())
+    assert len(nodes) == 5
+    assert nodes["test-cluster-worker0"]["provider_id"] == "id0"
+    assert nodes["test-cluster-worker0"]["public_ips"] == ["10.0.0.1"]
+
+
+def test_recorded_env_keeps_pending_changes(make_mock_cluster):
+    cluster = make_mock_cluster(store="sqlite")
+    conf = cluster.config
+    add_test_cluster(conf, "other-cluster")
+    env = cluster.record_env()
+    assert conf.clusters[cluster.name]["env"] == env
+    assert "other-cluster" not in Config(conf.home, store="sqlite").clusters
+    conf.save()
+    assert "other-cluster" in Config(conf.home, store="sqlite").clusters
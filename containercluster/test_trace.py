@@ -0,0 +1,91 @@
+import json
+import os
+import tempfile
+import threading
+
+import pytest
+
+from pytest import yield_fixture
+
+from containercluster import trace
+
+
+@yield_fixture
+def tracer():
+    tracer = trace.enable()
+    try:
+        yield tracer
+    finally:
+        trace.disable()
+
+
+def spans(tracer, ph="X"):
+    return [e for e in tracer.events() if e["ph"] == ph]
+
+
+def test_disabled():
+    assert trace.disable() is None
+    with trace.span("nothing"):
+        pass
+    trace.begin("nothing").end()
+    with pytest.raises(ValueError):
+        trace.write(os.devnull)
+
+
+def test_span(tracer):
+    with trace.span("outer", node="node-1"):
+        with trace.span("inner", node=None):
+            pass
+    inner, outer = spans(tracer)
+    assert outer["name"] == "outer"
+    assert outer["args"] == {"node": "node-1",
+                             "thread": threading.current_thread().name}
+    assert inner["args"] == {"thread": threading.current_thread().name}
+    assert outer["ts"] <= inner["ts"]
+    assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+
+
+def test_span_error(tracer):
+    with pytest.raises(KeyError):
+        with trace.span("failing"):
+            raise KeyError("x")
+    span, = spans(tracer)
+    assert span["args"]["error"] == "KeyError"
+
+
+def test_async_span(tracer):
+    span = trace.begin("wait", node="node-1")
+    t = threading.Thread(target=span.end, kwargs={"result": True},
+                         name="waiter")
+    t.start()
+    t.join()
+    begin, = spans(tracer, "b")
+    end, = spans(tracer, "e")
+    assert begin["id"] == end["id"]
+    assert end["args"] == {"result": True, "thread": "waiter"}
+    names = [e["args"]["name"] for e in spans(tracer, "M")]
+    assert "waiter" in names
+
+
+def test_locked(tracer):
+    lock = threading.Lock()
+    with trace.locked(lock, "lock", cert="admin"):
+        assert lock.locked()
+    assert not lock.locked()
+    span, = spans(tracer)
+    assert span["name"] == "lock"
+    assert span["args"]["cert"] == "admin"
+
+
+def test_write(tracer):
+    with trace.span("span"):
+        pass
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        trace.write(fname)
+        with open(fname, "rt") as f:
+            data = json.load(f)
+    finally:
+        os.unlink(fname)
+    assert [e["ph"] for e in data["traceEvents"]] == ["M", "X"]
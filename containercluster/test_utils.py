@@ -1,7 +1,13 @@
 import codecs
+import collections
 import os
 import pwd
+import socket
+import stat
+import subprocess
 import tempfile
+import threading
+import time
 
 import mockssh
 import pytest
@@ -30,9 +36,265 @@ def test_errors_in_parallel():
         utils.parallel(((utils.run, "echo foo"),
                         (key_error, "no-such-key"),
                         (divide_by_zero, 42),
-                        (utils.run, "echo bar")))
+                        (utils.run, "echo bar")),
+                       fail_fast=False)
     errors = set(str(exc) for exc in err.value)
     assert errors == set(("'no-such-key'", divide_by_zero_err))
+    assert [task[0] for task, _ in err.value.failures] == [key_error,
+                                                          divide_by_zero]
+
+
+def test_parallel_results_order():
+    def sleep_and_return(n):
+        time.sleep(0.01 * (5 - n))
+        return n
+
+    assert utils.parallel((sleep_and_return, n)
+                          for n in range(5)) == list(range(5))
+
+
+def test_pool_max_workers():
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def task():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+
+    with utils.Pool(max_workers=3) as pool:
+        pool.run((task,) for _ in range(20))
+        assert max_running[0] == 3
+        pool.run((task,) for _ in range(5))
+
+
+def test_pool_fail_fast():
+    started = []
+
+    def fail():
+        started.append("fail")
+        raise ValueError("failed")
+
+    def succeed(n):
+        started.append(n)
+        return n
+
+    with utils.Pool(max_workers=1) as pool:
+        with pytest.raises(utils.MultipleError) as err:
+            pool.run([(fail,)] + [(succeed, n) for n in range(10)])
+    assert started == ["fail"]
+    assert err.value.cancelled == 10
+    assert [str(exc) for exc in err.value] == ["failed"]
+
+
+def test_pool_nested_run():
+    with utils.Pool(max_workers=1) as pool:
+        def outer(n):
+            return sum(pool.run((abs, -i) for i in range(n)))
+
+        assert pool.run((outer, n) for n in range(4)) == [0, 0, 1, 3]
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        pass
+
+
+class FakeSshClient(object):
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.transport.active = False
+
+
+@pytest.fixture
+def fake_ssh_pool(monkeypatch):
+    pool = utils.SshPool(max_size=2, idle_timeout=60)
+    monkeypatch.setattr(pool, "_connect", lambda *args: FakeSshClient())
+    return pool
+
+
+def test_ssh_pool_reuse(fake_ssh_pool):
+    with utils.SshSession("core", "host1", 22, "key", fake_ssh_pool) as s1:
+        with utils.SshSession("core", "host1", 22, "key",
+                              fake_ssh_pool) as s2:
+            assert s1.connection is s2.connection
+            conn = s1.connection
+    with utils.SshSession("core", "host1", 22, "key", fake_ssh_pool) as s3:
+        assert s3.connection is conn
+    assert fake_ssh_pool.connections_opened == 1
+
+    conn.client.close()
+    with utils.SshSession("core", "host1", 22, "key", fake_ssh_pool) as s4:
+        assert s4.connection is not conn
+    assert fake_ssh_pool.connections_opened == 2
+
+
+def test_ssh_pool_eviction(fake_ssh_pool):
+    conns = []
+    for host in ("host1", "host2", "host3"):
+        with utils.SshSession("core", host, 22, "key", fake_ssh_pool) as s:
+            conns.append(s.connection)
+    assert [c.active for c in conns] == [False, True, True]
+
+    with utils.SshSession("core", "host2", 22, "key", fake_ssh_pool):
+        pass
+    for c in conns:
+        c.last_used -= 3600
+    with utils.SshSession("core", "host4", 22, "key", fake_ssh_pool) as s:
+        conn = s.connection
+    assert [c.active for c in conns] == [False, False, False]
+    assert conn.active
+
+
+def test_push_files_command():
+    target_dir = tempfile.mkdtemp()
+    files = [
+        (os.path.join(target_dir, "a", "cert.pem"), b"cert\n", 0o644),
+        (os.path.join(target_dir, "b c", "key.pem"), b"key\n", 0o600),
+    ]
+    done = os.path.join(target_dir, "done")
+    cmd, data = utils.push_files_command(files, "", "touch %s" % (done,))
+    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+    p.communicate(data)
+    assert p.returncode == 0
+    for path, contents, mode in files:
+        with open(path, "rb") as f:
+            assert f.read() == contents
+        assert stat.S_IMODE(os.stat(path).st_mode) == mode
+    assert sorted(os.listdir(os.path.join(target_dir, "a"))) == ["cert.pem"]
+    assert os.access(done, os.F_OK)
+
+
+def test_push_files_command_failure():
+    target_dir = tempfile.mkdtemp()
+    path = os.path.join(target_dir, "foo")
+    cmd, data = utils.push_files_command([(path, b"foo", 0o644)], "", "false")
+    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+    p.communicate(data)
+    assert p.returncode != 0
+
+
+class FakeChannel(object):
+
+    def __init__(self):
+        self.drained = threading.Event()
+
+    def shutdown_write(self):
+        pass
+
+    def recv_exit_status(self):
+        return 3
+
+
+class FakeStdin(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        # As when the command blocks on a full stderr window instead of
+        # reading its input.
+        assert self.channel.drained.wait(5), "Blocked writing input"
+
+
+class FakeStderr(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def read(self):
+        self.channel.drained.set()
+        return b"x" * 1000000
+
+
+class FakeStdout(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def read(self):
+        return b""
+
+
+class FakeCommandClient(object):
+
+    def exec_command(self, cmd):
+        channel = FakeChannel()
+        return FakeStdin(channel), FakeStdout(channel), FakeStderr(channel)
+
+
+def test_ssh_run_reads_stderr():
+    session = utils.SshSession("core", "host1", 22, "key", pool=object())
+    session.connection = collections.namedtuple("Conn", "client")(
+        FakeCommandClient())
+    status, stderr = session.run("tar -x", b"data")
+    assert status == 3
+    assert len(stderr) == 1000000
+
+
+@pytest.yield_fixture(scope="function")
+def listening_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(5)
+    yield sock
+    sock.close()
+
+
+def unused_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_port_waiter(listening_socket):
+    waiter = utils.PortWaiter(interval=0.01, max_interval=0.05)
+    open_addr = listening_socket.getsockname()
+    closed_addr = ("127.0.0.1", unused_port())
+    results = [((t.host, t.port), t.opened)
+               for t in waiter.wait([closed_addr, open_addr], timeout=0.3)]
+    assert results == [(open_addr, True), (closed_addr, False)]
+
+
+def test_port_waiter_opened_later():
+    waiter = utils.PortWaiter(interval=0.01, max_interval=0.05)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("127.0.0.1", 0))
+        target = waiter.watch(*sock.getsockname(), timeout=10)
+        time.sleep(0.1)
+        assert target.opened is None
+        sock.listen(5)
+        assert target.wait(10)
+        assert target.attempts > 0
+    finally:
+        sock.close()
+
+
+def test_wait_for_port_open(listening_socket):
+    utils.wait_for_port_open(*listening_socket.getsockname(), timeout=5)
+    with pytest.raises(Exception) as err:
+        utils.wait_for_port_open("127.0.0.1", unused_port(), timeout=0.1)
+    assert str(err.value).startswith("Timeout for")
 
 
 def ssh_private_key_path():
@@ -71,3 +333,34 @@ def test_sftp_session(ssh_session):
 
     ssh_session.open_sftp().put(__file__, target_fname)
     assert os.access(target_fname, os.F_OK)
+
+
+def test_token_bucket_burst():
+    bucket = utils.TokenBucket(20, 3)
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.available == 0
+    start = time.time()
+    assert bucket.acquire() > 0
+    assert time.time() - start >= 0.04
+
+
+def test_token_bucket_shared():
+    bucket = utils.TokenBucket(100, 1)
+    start = time.time()
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(11)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert time.time() - start >= 0.09
+
+
+def test_token_bucket_hold_and_limit():
+    bucket = utils.TokenBucket(1000, 10)
+    bucket.hold(time.time() + 0.05)
+    assert bucket.available == 0
+    start = time.time()
+    bucket.acquire()
+    assert time.time() - start >= 0.04
+    bucket.limit(2)
+    assert bucket.available <= 2
@@ -0,0 +1,203 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+
+__all__ = [
+    "Tracer",
+    "begin",
+    "disable",
+    "enable",
+    "locked",
+    "span",
+    "write",
+]
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Tracer(object):
+    """Records spans as Chrome trace events.
+
+    Events are tagged with the name of the thread which recorded them, and
+    can be written to a file loadable by ``chrome://tracing`` or Perfetto.
+
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+        self._ids = itertools.count(1)
+
+    def record(self, ph, name, ts, args, **fields):
+        thread = threading.current_thread()
+        args = dict((k, v) for k, v in args.items() if v is not None)
+        args["thread"] = thread.name
+        event = {
+            "name": name,
+            "cat": "containercluster",
+            "ph": ph,
+            "ts": ts,
+            "pid": self.pid,
+            "tid": thread.ident,
+            "args": args,
+        }
+        event.update(fields)
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+            self._events.append(event)
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def events(self):
+        """Return the events recorded so far, preceded by the names of the
+        threads which recorded them.
+
+        """
+        with self._lock:
+            threads = sorted(self._threads.items())
+            events = list(self._events)
+        return [{"name": "thread_name", "ph": "M", "pid": self.pid,
+                 "tid": tid, "args": {"name": name}}
+                for tid, name in threads] + events
+
+    def write(self, fname):
+        events = self.events()
+        with open(fname, "wt") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        LOG.info("Wrote %d trace event(s) to %s", len(events), fname)
+
+
+def now():
+    return int(time.time() * 1000000)
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        args = self.args
+        if exc_type is not None:
+            args = dict(args, error=exc_type.__name__)
+        self.tracer.record("X", self.name, self.start, args,
+                           dur=now() - self.start)
+
+
+class _AsyncSpan(object):
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.id = tracer.next_id()
+        tracer.record("b", name, now(), args, id=self.id)
+
+    def end(self, **args):
+        self.tracer.record("e", self.name, now(), args, id=self.id)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def end(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+_tracer = None
+
+
+def enable():
+    """Start recording spans, and return the :class:`Tracer` recording them.
+
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    """Stop recording spans, and return the :class:`Tracer` which recorded
+    them, if any.
+
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def span(name, **args):
+    """Return a context manager recording the time spent in its block as
+    span ``name``, tagged with ``args``.
+
+    Spans cost next to nothing while tracing is disabled.
+
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, args)
+
+
+def begin(name, **args):
+    """Start span ``name``, tagged with ``args``, which may end in another
+    thread. Returns an object whose ``end()`` method ends the span.
+
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _AsyncSpan(tracer, name, args)
+
+
+class locked(object):
+    """Context manager holding ``lock``, recording the time spent waiting
+    for it as span ``name``.
+
+    """
+
+    def __init__(self, lock, name, **args):
+        self.lock = lock
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        with span(self.name, **self.args):
+            self.lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+def write(fname):
+    """Write the spans recorded so far to ``fname``.
+
+    """
+    tracer = _tracer
+    if tracer is None:
+        raise ValueError("Tracing is not enabled")
+    tracer.write(fname)
@@ -1,18 +1,65 @@
+import atexit
+import collections
+import contextlib
+import errno
+import fcntl
+import importlib
+import io
 import logging
+import posixpath
+import random
+import select
 import socket
 import subprocess
 import sys
+import tarfile
 import threading
 import time
 
-from paramiko.client import MissingHostKeyPolicy, SSHClient
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from containercluster import metrics, trace
 
 
 __all__ = [
     "MultipleError",
+    "Pool",
+    "PortTarget",
+    "PortWaiter",
+    "ReadOnlyDict",
+    "SshConnection",
+    "SshPool",
     "SshSession",
+    "TokenBucket",
+    "WaitTarget",
+    "file_lock",
+    "lazy_import",
+    "make_tar",
     "parallel",
+    "port_open",
+    "push_files_command",
+    "read_only",
     "run",
+    "shared_port_waiter",
+    "shared_ssh_pool",
     "wait_for_port_open",
 ]
 
@@ -20,6 +67,38 @@ __all__ = [
 LOG = logging.getLogger(__name__)
 
 
+class LazyModule(object):
+    """Stands for the module ``name``, which is only imported when one of
+    its attributes is first used.
+
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return "<lazy module %r>" % (self._name,)
+
+
+def lazy_import(name):
+    """Return a stand-in for the module ``name``, imported on first use.
+
+    Heavy dependencies are imported this way, so that commands which do not
+    need them do not pay for importing them.
+
+    """
+    return LazyModule(name)
+
+
+paramiko_client = lazy_import("paramiko.client")
+
+
 def run(cmdline, cwd=None, shell=True):
     LOG.debug("Running %s", cmdline)
     p = subprocess.Popen(cmdline, shell=shell, cwd=cwd,
@@ -32,8 +111,10 @@ def run(cmdline, cwd=None, shell=True):
 
 class MultipleError(Exception):
 
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         super(MultipleError, self).__init__(*args)
+        self.tasks = kwargs.get("tasks") or [None] * len(args)
+        self.cancelled = kwargs.get("cancelled", 0)
 
     def __str__(self):
         return "\n".join(str(err) for err in self.args)
@@ -41,96 +122,947 @@ class MultipleError(Exception):
     def __iter__(self):
         return iter(self.args)
 
+    @property
+    def failures(self):
+        """Pairs ``(task, error)`` for every failed task, in submission order.
+
+        """
+        return list(zip(self.tasks, self.args))
+
+
+DEFAULT_MAX_WORKERS = 16
+
+
+class Pool(object):
+    """Bounded pool of worker threads.
 
-def parallel(tasks):
-    results = []
-    errors = []
+    At most ``max_workers`` tasks run at the same time. Tasks are tuples
+    ``(func, arg1, arg2, ...)``, as in :func:`parallel`. Worker threads are
+    started on demand and exit after ``idle_timeout`` seconds without work, so
+    that one pool may be shared by several batches of tasks.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, name="pool",
+                 idle_timeout=5.0):
+        if max_workers < 1:
+            raise ValueError("Invalid number of workers: %r" % (max_workers,))
+        self.max_workers = max_workers
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = 0
+        self._unclaimed = 0
+        self._counter = 0
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
 
-    def _run(*args):
-        func = args[0]
-        args = args[1:]
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def run(self, tasks, fail_fast=True):
+        """Run ``tasks`` and return their results in submission order.
+
+        If any task fails, a :class:`MultipleError` is raised with the errors
+        of all failed tasks. With ``fail_fast``, tasks which have not started
+        yet when the first error happens are cancelled.
+
+        """
+        tasks = [tuple(task) for task in tasks]
+        batch = _Batch(tasks, fail_fast)
+        if self.in_worker:
+            # Waiting for other workers from within a worker could deadlock
+            # the pool, so nested batches run in the calling thread.
+            for i in range(len(tasks)):
+                batch.execute(i)
+        else:
+            for i in range(len(tasks)):
+                self.submit(batch.execute, i)
+        return batch.wait()
+
+    def submit(self, func, *args):
+        """Schedule ``func(*args)`` without waiting for its result.
+
+        Errors raised by ``func`` are logged and otherwise ignored.
+
+        """
+        with self._lock:
+            self._queue.put((func, args))
+            self._unclaimed += 1
+            if (self._unclaimed > self._idle and
+                    len(self._threads) < self.max_workers):
+                self._counter += 1
+                t = threading.Thread(target=self._work,
+                                     name="%s-%d" % (self.name, self._counter))
+                t.daemon = True
+                self._threads.append(t)
+                t.start()
+
+    @property
+    def in_worker(self):
+        """Whether the calling thread is one of the pool's workers.
+
+        """
+        return getattr(self._local, "worker", False)
+
+    def shutdown(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+            for _ in threads:
+                self._queue.put(None)
+        for t in threads:
+            t.join()
+
+    def _work(self):
+        self._local.worker = True
+        while True:
+            with self._lock:
+                self._idle += 1
+            try:
+                item = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    self._idle -= 1
+                    me = threading.current_thread()
+                    # Threads being shut down wait for their sentinel.
+                    if not self._unclaimed and me in self._threads:
+                        self._threads.remove(me)
+                        return
+                continue
+            with self._lock:
+                self._idle -= 1
+                if item is None:
+                    return
+                self._unclaimed -= 1
+            func, args = item
+            try:
+                func(*args)
+            except:
+                self.log.warning("Unhandled error in %s%s", func, args,
+                                 exc_info=True)
+
+
+class _Batch(object):
+
+    def __init__(self, tasks, fail_fast):
+        self.tasks = tasks
+        self.fail_fast = fail_fast
+        self.results = [None] * len(tasks)
+        self.errors = {}
+        self.cancelled = 0
+        self.pending = len(tasks)
+        self.cond = threading.Condition()
+
+    def execute(self, index):
+        task = self.tasks[index]
+        with self.cond:
+            cancel = self.fail_fast and self.errors
+        if cancel:
+            LOG.debug("Cancelling %s%s", task[0], task[1:])
+            with self.cond:
+                self.cancelled += 1
+                self._done()
+            return
         try:
-            results.append(func(*args))
+            result = task[0](*task[1:])
         except:
-            LOG.debug("Caught error in %s%s", func, args, exc_info=True)
+            LOG.debug("Caught error in %s%s", task[0], task[1:], exc_info=True)
             _, exc_value, _ = sys.exc_info()
-            errors.append(exc_value)
+            with self.cond:
+                self.errors[index] = exc_value
+                self._done()
+        else:
+            with self.cond:
+                self.results[index] = result
+                self._done()
+
+    def _done(self):
+        self.pending -= 1
+        if not self.pending:
+            self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+        if self.errors:
+            indices = sorted(self.errors)
+            raise MultipleError(*[self.errors[i] for i in indices],
+                                tasks=[self.tasks[i] for i in indices],
+                                cancelled=self.cancelled)
+        return self.results
 
-    threads = []
-    for task in tasks:
-        args = [task[0]]
-        args.extend(task[1:])
-        args = tuple(args)
-        threads.append(threading.Thread(target=_run, args=args))
 
-    for t in threads:
-        t.start()
+def parallel(tasks, pool=None, fail_fast=True):
+    if pool is None:
+        with Pool() as pool:
+            return pool.run(tasks, fail_fast)
+    return pool.run(tasks, fail_fast)
 
-    for t in threads:
-        t.join()
 
-    if errors:
-        raise MultipleError(*errors)
+class ReadOnlyDict(Mapping):
+    """Read-only view of a dictionary.
+
+    Nested dictionaries are returned as read-only views too, and lists as
+    tuples, so that the data behind the view cannot be modified through it.
+
+    """
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return read_only(self._data[key])
+
+    def __iter__(self):
+        return iter(self._data)
 
-    return results
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "ReadOnlyDict(%r)" % (self._data,)
+
+
+def read_only(value):
+    if isinstance(value, dict):
+        return ReadOnlyDict(value)
+    if isinstance(value, list):
+        return tuple(read_only(v) for v in value)
+    return value
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Context manager holding an exclusive advisory lock on ``path``.
+
+    The file is created if needed, and left in place afterwards.
+
+    """
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def port_open(host, port, timeout=1.0):
+    """Tell whether a TCP connection to ``host:port`` can be established.
+
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect((host, port))
+    except (socket.error, socket.timeout):
+        return False
+    else:
+        return True
+    finally:
+        sock.close()
 
 
 def wait_for_port_open(host, port, timeout=None, check_interval=0.1):
-    start = time.time()
-    while True:
+    """Wait until ``host:port`` accepts TCP connections.
+
+    Connection attempts start ``check_interval`` seconds apart, and back off
+    from there. Raises an exception after ``timeout`` seconds.
+
+    """
+    target = shared_port_waiter().watch(host, port, timeout, check_interval)
+    with trace.span("wait_for_port_open", host=host, port=port):
+        if not target.wait():
+            raise Exception("Timeout for %s:%d" % (host, port))
+
+
+class TokenBucket(object):
+    """Rate limiter letting ``rate`` requests per second through on average,
+    in bursts of up to ``burst`` requests.
+
+    The bucket is meant to be shared by all threads making requests to the
+    same service: :meth:`acquire` blocks until a request may go.
+
+    """
+
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst < 1:
+            raise ValueError("Invalid rate limit: %r requests/s, burst of %r" %
+                             (rate, burst))
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._not_before = 0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        """The number of requests which may go right now.
+
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            if now < self._not_before:
+                return 0
+            return int(self._tokens)
+
+    def acquire(self):
+        """Wait until a request may go, and return the time waited.
+
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now >= self._not_before and self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = max(self._not_before - now,
+                            (1 - self._tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def hold(self, until):
+        """Let no request go before time ``until``.
+
+        """
+        with self._lock:
+            self._not_before = max(self._not_before, until)
+
+    def limit(self, tokens):
+        """Let no more than ``tokens`` requests go without waiting, such as
+        when the service reports fewer remaining requests than the bucket
+        holds.
+
+        """
+        with self._lock:
+            self._refill(time.time())
+            self._tokens = min(self._tokens, max(tokens, 0))
+
+    def _refill(self, now):
+        # Must be called with the lock held.
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class WaitTarget(object):
+    """Something waited for by a background thread, until a deadline.
+
+    ``result`` is ``None`` while the target is being waited for, and then
+    ``True`` once it has happened, or ``False`` if the deadline passed first.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.result = None
+        self.start = time.time()
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until the target is done, and return ``result``.
+
+        """
+        self._done.wait(timeout)
+        return self.result
+
+    def add_callback(self, callback):
+        """Call ``callback(target)`` once the target is done.
+
+        The callback is called right away if the target is already done, and
+        from the thread of the waiter otherwise, so it must not block.
+
+        """
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def expired(self, now):
+        return self.deadline is not None and now >= self.deadline
+
+    def resolve(self, result):
+        with self._lock:
+            self.result = result
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                self.log.warning("Error in callback for %r", self,
+                                 exc_info=True)
+
+
+class PortTarget(WaitTarget):
+    """A ``host:port`` watched by a :class:`PortWaiter`.
+
+    """
+
+    def __init__(self, host, port, deadline, interval):
+        super(PortTarget, self).__init__(deadline)
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.attempts = 0
+        self.next_attempt = self.start
+
+    def __repr__(self):
+        return "PortTarget(%r, %r)" % (self.host, self.port)
+
+    @property
+    def opened(self):
+        return self.result
+
+    def resolve(self, result):
+        elapsed = time.time() - self.start
+        if result:
+            self.log.debug("Port %s:%d open after %g s (%d attempt(s))",
+                           self.host, self.port, elapsed, self.attempts + 1)
+        else:
+            self.log.debug("Timeout for %s:%d after %g s", self.host,
+                           self.port, elapsed)
+        super(PortTarget, self).resolve(result)
+
+
+class PortWaiter(object):
+    """Waits for TCP ports on many hosts to accept connections.
+
+    All targets are probed from a single background thread, with
+    non-blocking connections multiplexed on one selector. Failed attempts
+    are retried with exponential backoff and random jitter, up to
+    ``max_interval`` seconds apart, until the deadline of the target. An
+    attempt is abandoned after ``connect_timeout`` seconds.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, interval=0.25, max_interval=5.0, connect_timeout=2.0):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.connect_timeout = connect_timeout
+        self._new = []
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+
+    def watch(self, host, port, timeout=None, interval=None):
+        """Start watching ``host:port`` and return its :class:`PortTarget`.
+
+        The target expires after ``timeout`` seconds, if given.
+
+        """
+        if interval is None:
+            interval = self.interval
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        target = PortTarget(host, port, deadline, interval)
+        with self._lock:
+            self._new.append(target)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="port-waiter")
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup()
+        return target
+
+    def wait(self, addresses, timeout=None):
+        """Watch all ``(host, port)`` pairs in ``addresses``.
+
+        Yields their targets as soon as they are done, so that the caller
+        may act on every one of them without waiting for the others.
+
+        """
+        done = queue.Queue()
+        targets = [self.watch(host, port, timeout)
+                   for host, port in addresses]
+        for target in targets:
+            target.add_callback(done.put)
+        for _ in targets:
+            yield done.get()
+
+    def _wakeup(self):
         try:
-            LOG.debug("Trying %s:%d ...", host, port)
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(check_interval)
-            sock.connect((host, port))
-            sock.close()
+            self._wakeup_w.send(b"x")
+        except socket.error:
+            pass
+
+    def _run(self):
+        waiting = []
+        in_flight = {}
+        if selectors is not None:
+            selector = selectors.DefaultSelector()
+            selector.register(self._wakeup_r, selectors.EVENT_READ)
+        else:
+            selector = None
+        try:
+            while True:
+                with self._lock:
+                    waiting.extend(self._new)
+                    del self._new[:]
+                    if not waiting and not in_flight:
+                        self._thread = None
+                        return
+                self._step(waiting, in_flight, selector)
         except:
-            if timeout is not None:
-                elapsed = time.time() - start
-                if elapsed > timeout:
-                    raise Exception("Timeout for %s:%d" % (host, port))
+            self.log.error("Port waiter failed", exc_info=True)
+            with self._lock:
+                self._thread = None
+                waiting.extend(self._new)
+                del self._new[:]
+            for sock, (target, _) in in_flight.items():
+                sock.close()
+                target.resolve(False)
+            for target in waiting:
+                target.resolve(False)
+        finally:
+            if selector is not None:
+                selector.close()
+
+    def _step(self, waiting, in_flight, selector):
+        now = time.time()
+        for target in list(waiting):
+            if target.expired(now):
+                waiting.remove(target)
+                target.resolve(False)
+            elif target.next_attempt <= now:
+                waiting.remove(target)
+                self._connect(target, waiting, in_flight, selector)
+        for sock, (target, attempt_deadline) in list(in_flight.items()):
+            if attempt_deadline <= now:
+                self._finish(sock, False, waiting, in_flight, selector)
+
+        deadlines = [t.next_attempt for t in waiting]
+        deadlines.extend(t.deadline for t in waiting if t.deadline is not None)
+        deadlines.extend(d for _, d in in_flight.values())
+        timeout = None
+        if deadlines:
+            timeout = max(min(deadlines) - time.time(), 0)
+
+        if selector is not None:
+            ready = [key.fileobj for key, _ in selector.select(timeout)]
         else:
-            elapsed = time.time() - start
-            LOG.debug("Port %s:%d open after %g s", host, port, elapsed)
+            r, w, _ = select.select([self._wakeup_r], list(in_flight), [],
+                                    timeout)
+            ready = r + w
+        for sock in ready:
+            if sock is self._wakeup_r:
+                try:
+                    while sock.recv(4096):
+                        pass
+                except socket.error:
+                    pass
+            elif sock in in_flight:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                self._finish(sock, err == 0, waiting, in_flight, selector)
+
+    def _connect(self, target, waiting, in_flight, selector):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except socket.error:
+            self._retry(target, waiting)
             return
-        finally:
+        try:
+            sock.setblocking(False)
+            err = sock.connect_ex((target.host, target.port))
+        except socket.error:
+            sock.close()
+            self._retry(target, waiting)
+            return
+        if err == 0:
             sock.close()
+            target.resolve(True)
+        elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            in_flight[sock] = (target, time.time() + self.connect_timeout)
+            if selector is not None:
+                selector.register(sock, selectors.EVENT_WRITE)
+        else:
+            sock.close()
+            self._retry(target, waiting)
+
+    def _finish(self, sock, opened, waiting, in_flight, selector):
+        target, _ = in_flight.pop(sock)
+        if selector is not None:
+            selector.unregister(sock)
+        sock.close()
+        if opened:
+            target.resolve(True)
+        else:
+            self._retry(target, waiting)
+
+    def _retry(self, target, waiting):
+        delay = min(target.interval * 2 ** target.attempts, self.max_interval)
+        target.attempts += 1
+        target.next_attempt = time.time() + delay * random.uniform(0.5, 1.0)
+        if target.deadline is not None:
+            target.next_attempt = min(target.next_attempt, target.deadline)
+        waiting.append(target)
+
+
+_port_waiter = None
+
+_port_waiter_lock = threading.Lock()
+
 
+def shared_port_waiter():
+    """Return the process-wide :class:`PortWaiter`.
 
-class IgnoreMissingKeyPolicy(MissingHostKeyPolicy):
+    """
+    global _port_waiter
+    with _port_waiter_lock:
+        if _port_waiter is None:
+            _port_waiter = PortWaiter()
+        return _port_waiter
+
+
+def make_tar(files):
+    """Return a tar archive of ``files``.
+
+    ``files`` is a sequence of tuples ``(name, data, mode)``. All members are
+    owned by root.
+
+    """
+    now = time.time()
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode="w")
+    try:
+        for name, data, mode in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = now
+            info.uid = info.gid = 0
+            info.uname = info.gname = "root"
+            tar.addfile(info, io.BytesIO(data))
+    finally:
+        tar.close()
+    return buf.getvalue()
+
+
+def push_files_command(files, sudo_cmd="sudo", post_cmd=None):
+    """Return a remote command, and its input, installing ``files``.
+
+    ``files`` is a sequence of tuples ``(path, data, mode)``. The files are
+    sent as a tar archive on the standard input of the command, which
+    extracts them to a temporary directory and renames every one of them
+    into place, so that no file is ever seen half-written. When run as root,
+    the files are owned by root. ``post_cmd``, if given, runs after all files
+    are in place. The command fails if any step fails.
+
+    """
+    data = make_tar([("%d" % (i,), d, mode)
+                     for i, (_, d, mode) in enumerate(files)])
+    # The archive length is passed to `head`, so that the remote command does
+    # not depend on seeing the end of its standard input.
+    lines = [
+        "set -e",
+        "tmp=$(mktemp -d)",
+        "trap 'rm -rf \"$tmp\"' EXIT",
+        "head -c %d | tar -x -p -f - -C \"$tmp\"" % (len(data),),
+    ]
+    for i, (path, _, _) in enumerate(files):
+        dname, fname = posixpath.split(path)
+        staged = posixpath.join(dname, ".%s.upload" % (fname,))
+        lines.extend([
+            "mkdir -p %s" % (quote(dname),),
+            "mv -f \"$tmp/%d\" %s" % (i, quote(staged)),
+            "mv -f %s %s" % (quote(staged), quote(path)),
+        ])
+    if post_cmd:
+        lines.append(post_cmd)
+    cmd = "%s sh -c %s" % (sudo_cmd, quote("\n".join(lines)))
+    return cmd.strip(), data
+
+
+# Not derived from paramiko's MissingHostKeyPolicy, so that paramiko is only
+# imported when connecting.
+class IgnoreMissingKeyPolicy(object):
 
     def missing_host_key(self, *args):
         pass
 
 
+SSH_KEEPALIVE_INTERVAL = 30
+
+SSH_CONNECTS = metrics.counter(
+    "containercluster_ssh_connects_total",
+    "SSH connections opened.")
+
+SSH_CONNECT_SECONDS = metrics.histogram(
+    "containercluster_ssh_connect_seconds",
+    "Time taken to open SSH connections.")
+
+SSH_COMMANDS = metrics.counter(
+    "containercluster_ssh_commands_total",
+    "Commands run over SSH.")
+
+SSH_BYTES_UPLOADED = metrics.counter(
+    "containercluster_ssh_uploaded_bytes_total",
+    "Bytes sent to the standard input of commands run over SSH.")
+
+DEFAULT_SSH_POOL_SIZE = 32
+
+
+class SshConnection(object):
+    """A pooled SSH connection.
+
+    SFTP sessions opened over the connection are kept for reuse once their
+    users are done with them.
+
+    """
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.users = 0
+        self.last_used = time.time()
+        self._sftp_sessions = []
+        self._sftp_lock = threading.Lock()
+
+    @property
+    def active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def checkout_sftp(self):
+        with self._sftp_lock:
+            while self._sftp_sessions:
+                sftp = self._sftp_sessions.pop()
+                if not sftp.sock.closed:
+                    return sftp
+        return self.client.open_sftp()
+
+    def checkin_sftp(self, sftp):
+        if not sftp.sock.closed:
+            with self._sftp_lock:
+                self._sftp_sessions.append(sftp)
+
+    def close(self):
+        try:
+            self.client.close()
+        except:
+            pass
+
+
+class SshPool(object):
+    """Pool of SSH connections, indexed by user, address, port and key.
+
+    Connections are kept open with keep-alive messages and shared by all
+    users of the same key, which open their channels and SFTP sessions over
+    the same transport. Connections unused for ``idle_timeout`` seconds are
+    closed, as are the least recently used ones when there are more than
+    ``max_size`` idle connections.
+
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, max_size=DEFAULT_SSH_POOL_SIZE, idle_timeout=300.0,
+                 keepalive_interval=SSH_KEEPALIVE_INTERVAL):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connections_opened = 0
+        self._connections = collections.OrderedDict()
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, uid, addr, port, private_key_path):
+        """Return a connection, opening it if needed.
+
+        The connection must be given back with :meth:`release`.
+
+        """
+        key = (uid, addr, port, private_key_path)
+        with self._key_lock(key):
+            with self._lock:
+                conn = self._connections.pop(key, None)
+                if conn is not None and conn.active:
+                    conn.users += 1
+                    self._connections[key] = conn
+                    return conn
+            if conn is not None:
+                self.log.debug("Discarding closed connection to %s@%s:%d",
+                               uid, addr, port)
+                conn.close()
+            with SSH_CONNECT_SECONDS.time():
+                conn = SshConnection(key, self._connect(*key))
+            SSH_CONNECTS.inc()
+            with self._lock:
+                conn.users += 1
+                self._connections[key] = conn
+                self.connections_opened += 1
+            return conn
+
+    def release(self, conn):
+        with self._lock:
+            conn.users -= 1
+            conn.last_used = time.time()
+            evicted = self._evict()
+        for c in evicted:
+            c.close()
+
+    def close(self):
+        """Close all connections.
+
+        """
+        with self._lock:
+            conns = list(self._connections.values())
+            self._connections.clear()
+        for c in conns:
+            c.close()
+
+    def _key_lock(self, key):
+        with self._lock:
+            try:
+                return self._key_locks[key]
+            except KeyError:
+                lock = self._key_locks[key] = threading.Lock()
+                return lock
+
+    def _evict(self):
+        # Must be called with the lock held.
+        now = time.time()
+        idle = [c for c in self._connections.values() if not c.users]
+        evicted = [c for c in idle if now - c.last_used > self.idle_timeout]
+        excess = len(idle) - len(evicted) - self.max_size
+        if excess > 0:
+            evicted.extend([c for c in idle if c not in evicted][:excess])
+        for c in evicted:
+            self.log.debug("Closing idle connection to %s@%s:%d", *c.key[:3])
+            del self._connections[c.key]
+        return evicted
+
+    def _connect(self, uid, addr, port, private_key_path):
+        self.log.debug("Creating SSH connection to %s@%s (port %d) ...",
+                       uid, addr, port)
+        client = paramiko_client.SSHClient()
+        client.set_missing_host_key_policy(IgnoreMissingKeyPolicy())
+        client.connect(hostname=addr,
+                       port=port,
+                       username=uid,
+                       key_filename=private_key_path,
+                       allow_agent=False,
+                       look_for_keys=False)
+        client.get_transport().set_keepalive(self.keepalive_interval)
+        self.log.debug("... connected to %s@%s", uid, addr)
+        return client
+
+
+_ssh_pool = None
+
+_ssh_pool_lock = threading.Lock()
+
+
+def shared_ssh_pool():
+    """Return the process-wide SSH connection pool.
+
+    """
+    global _ssh_pool
+    with _ssh_pool_lock:
+        if _ssh_pool is None:
+            _ssh_pool = SshPool()
+            atexit.register(_ssh_pool.close)
+        return _ssh_pool
+
+
+def _read_output(f, output, name):
+    output[name] = f.read()
+
+
 class SshSession(object):
+    """Context manager for an SSH connection taken from a :class:`SshPool`.
+
+    Within the context, the session behaves like a connected
+    :class:`SSHClient`, except that :meth:`open_sftp` always returns the
+    same SFTP session.
+
+    """
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, uid, addr, port, private_key_path):
+    def __init__(self, uid, addr, port, private_key_path, pool=None):
         self.uid = uid
         self.addr = addr
         self.port = port
         self.private_key_path = private_key_path
-        self.ssh_client = c = SSHClient()
-        c.set_missing_host_key_policy(IgnoreMissingKeyPolicy())
+        if pool is None:
+            pool = shared_ssh_pool()
+        self.pool = pool
+        self.connection = None
+        self._sftp = None
 
     def __enter__(self):
-        self.log.debug("Creating SSH connection to %s@%s (port %d) ...",
-                       self.uid, self.addr, self.port)
-        self.ssh_client.connect(hostname=self.addr,
-                                port=self.port,
-                                username=self.uid,
-                                key_filename=self.private_key_path,
-                                allow_agent=False,
-                                look_for_keys=False)
-        self.log.debug("... connected to %s@%s", self.uid, self.addr)
-        return self.ssh_client
+        self.connection = self.pool.acquire(self.uid, self.addr, self.port,
+                                            self.private_key_path)
+        return self
 
     def __exit__(self, *exc_info):
-        try:
-            self.log.debug("Closing connection to %s@%s ...",
-                           self.uid, self.addr)
-            self.ssh_client.close()
-        except:
-            pass
+        conn, self.connection = self.connection, None
+        sftp, self._sftp = self._sftp, None
+        if sftp is not None:
+            conn.checkin_sftp(sftp)
+        self.pool.release(conn)
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("connection")
+        if conn is None:
+            raise AttributeError(name)
+        return getattr(conn.client, name)
+
+    def run(self, cmd, data=None):
+        """Run ``cmd``, with ``data`` as its standard input, and wait for it
+        to finish.
+
+        Returns the exit status of the command and its standard error.
+
+        """
+        stdin, stdout, stderr = self.exec_command(cmd)
+        # Both outputs are read while the input is written, since a command
+        # filling the window of either would otherwise never finish.
+        output = {}
+        readers = [threading.Thread(target=_read_output,
+                                    args=(f, output, name),
+                                    name="ssh-%s" % (name,))
+                   for name, f in (("stdout", stdout), ("stderr", stderr))]
+        for t in readers:
+            t.daemon = True
+            t.start()
+        if data is not None:
+            stdin.write(data)
+            SSH_BYTES_UPLOADED.inc(len(data))
+        stdin.channel.shutdown_write()
+        for t in readers:
+            t.join()
+        status = stdout.channel.recv_exit_status()
+        SSH_COMMANDS.inc()
+        return status, output.get("stderr", b"")
+
+    def open_sftp(self):
+        if self._sftp is None:
+            self._sftp = self.connection.checkout_sftp()
+        return self._sftp